@@ -0,0 +1,306 @@
+"""内置 HTTP API：把最新的 ip.csv 载入内存索引，按国家、端口、数据中心、速度与延迟过滤后返回
+
+只依赖标准库 asyncio。结果文件变化时在线程池中构建新快照，构建完成后一次赋值替换，
+请求处理始终读取当时的快照，不会等待写入方。常用响应（全部节点及各国家的 ips.txt / CSV）在构建快照时预先渲染并 gzip 压缩，
+其余查询的响应首次生成后缓存在该快照中。
+
+接口（GET / HEAD）:
+  /ips.txt   "IP:端口#🇯🇵 日本-1" 格式
+  /ip.csv    与 ip.csv 相同的列
+  /nodes     JSON 数组
+  /healthz   快照版本与节点数
+查询参数: country=JP,HK  port=443  colo=NRT  min_speed=5  max_latency=200  top=20
+"""
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from countries import COUNTRY_LABELS
+
+logger = logging.getLogger(__name__)
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+REFRESH_INTERVAL = 5.0
+RESPONSE_CACHE_SIZE = 1024
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 64 * 1024
+GZIP_MIN_SIZE = 256
+
+CONTENT_TYPES = {
+    "/ips.txt": "text/plain; charset=utf-8",
+    "/ip.csv": "text/csv; charset=utf-8",
+    "/nodes": "application/json",
+}
+STATUS_TEXT = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+# 当前快照，整体替换；见 build_snapshot
+_snapshot: Dict = {"version": "empty", "header": [], "records": [], "index": {}, "responses": {}}
+
+def _float(value: str) -> Optional[float]:
+    try:
+        return float(value.replace("ms", "").strip())
+    except (AttributeError, ValueError):
+        return None
+
+def load_records(csv_file: str) -> Tuple[List[str], List[Dict]]:
+    """读取 ip.csv，返回 (表头, 记录列表)；记录保留原始行用于 CSV 输出"""
+    with open(csv_file, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or []
+        columns = {name: i for i, name in enumerate(header)}
+
+        def col(name: str, default: int) -> int:
+            return columns.get(name, default)
+
+        ip_col, port_col, tls_col, colo_col = col("IP地址", 0), col("端口", 1), col("TLS", 2), col("数据中心", 3)
+        code_col, latency_col, speed_col = col("国际代码", 5), col("网络延迟", 8), col("下载速度MB/s", 9)
+        records = []
+        for row in reader:
+            if len(row) < 2 or not row[1].strip().isdigit():
+                continue
+            get = lambda i: row[i].strip() if i < len(row) else ""  # noqa: E731
+            records.append({
+                "ip": row[ip_col].strip(), "port": int(row[port_col]), "tls": get(tls_col).lower() == "true",
+                "colo": get(colo_col).upper(), "country": get(code_col).upper(),
+                "latency": _float(get(latency_col)), "speed": _float(get(speed_col)), "row": row,
+            })
+    return header, records
+
+def _render(snapshot: Dict, path: str, records: List[Dict]) -> Dict:
+    if path == "/ips.txt":
+        counts = defaultdict(int)
+        lines = []
+        for r in sorted(records, key=lambda r: r["country"] or "ZZ"):
+            counts[r["country"]] += 1
+            emoji, name = COUNTRY_LABELS.get(r["country"], ("🌐", "未知"))
+            lines.append(f"{r['ip']}:{r['port']}#{emoji} {name}-{counts[r['country']]}\n")
+        body = "".join(lines).encode("utf-8")
+    elif path == "/ip.csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(snapshot["header"])
+        writer.writerows(r["row"] for r in records)
+        body = buffer.getvalue().encode("utf-8")
+    else:
+        body = json.dumps([{key: r[key] for key in ("ip", "port", "tls", "colo", "country", "latency", "speed")}
+                           for r in records], ensure_ascii=False).encode("utf-8")
+    tag = f'{snapshot["version"]}-{hashlib.sha1(body).hexdigest()[:12]}'
+    # 压缩与未压缩的内容字节不同，强 ETag 必须区分编码
+    return {"body": body, "gzip": gzip.compress(body, 6) if len(body) >= GZIP_MIN_SIZE else None,
+            "etag": f'"{tag}"', "gzip_etag": f'"{tag}-gzip"', "content_type": CONTENT_TYPES[path]}
+
+def _query_key(path: str, query: Dict[str, List[str]]) -> Tuple:
+    return (path,) + tuple(sorted((key, ",".join(sorted(values))) for key, values in query.items()))
+
+def select_records(snapshot: Dict, query: Dict[str, List[str]]) -> List[Dict]:
+    """按查询参数过滤快照中的记录，保持 ip.csv 原有顺序（速度从高到低）；参数无效时抛出 ValueError"""
+    index = snapshot["index"]
+    positions = None
+    for field in ("country", "port", "colo"):
+        if field not in query:
+            continue
+        wanted = {value.strip().upper() for values in query[field] for value in values.split(",") if value.strip()}
+        matched = set()
+        for value in wanted:
+            matched.update(index[field].get(int(value) if field == "port" else value, ()))
+        positions = matched if positions is None else positions & matched
+    records = snapshot["records"]
+    selected = records if positions is None else [records[i] for i in sorted(positions)]
+    if "min_speed" in query:
+        min_speed = float(query["min_speed"][0])
+        selected = [r for r in selected if r["speed"] is not None and r["speed"] >= min_speed]
+    if "max_latency" in query:
+        max_latency = float(query["max_latency"][0])
+        selected = [r for r in selected if r["latency"] is not None and r["latency"] <= max_latency]
+    if "top" in query:
+        selected = selected[:max(0, int(query["top"][0]))]
+    return selected
+
+def build_snapshot(csv_file: str) -> Dict:
+    """由 ip.csv 构建只读快照：记录、国家/端口/数据中心索引，以及预先渲染的常用响应"""
+    header, records = load_records(csv_file)
+    stat = os.stat(csv_file)
+    index = {"country": defaultdict(list), "port": defaultdict(list), "colo": defaultdict(list)}
+    for i, r in enumerate(records):
+        index["country"][r["country"]].append(i)
+        index["port"][r["port"]].append(i)
+        index["colo"][r["colo"]].append(i)
+    snapshot = {"version": f"{stat.st_mtime_ns:x}", "header": header, "records": records,
+                "index": {field: dict(values) for field, values in index.items()},
+                "responses": {}, "built_at": time.time()}
+    for path in ("/ips.txt", "/ip.csv"):
+        snapshot["responses"][_query_key(path, {})] = _render(snapshot, path, records)
+        for country in snapshot["index"]["country"]:
+            query = {"country": [country]}
+            snapshot["responses"][_query_key(path, query)] = _render(snapshot, path, select_records(snapshot, query))
+    return snapshot
+
+def get_response(snapshot: Dict, path: str, query: Dict[str, List[str]]) -> Dict:
+    key = _query_key(path, query)
+    response = snapshot["responses"].get(key)
+    if response is None:
+        response = _render(snapshot, path, select_records(snapshot, query))
+        if len(snapshot["responses"]) < RESPONSE_CACHE_SIZE:
+            snapshot["responses"][key] = response
+    return response
+
+def _http_response(status: int, headers: Dict[str, str], body: bytes = b"", head_only: bool = False) -> bytes:
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+    headers = dict(headers, **{"Content-Length": str(len(body))})
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (b"" if head_only else body)
+
+def handle_request(method: str, target: str, headers: Dict[str, str]) -> bytes:
+    """根据当前快照生成完整的 HTTP 响应字节"""
+    snapshot = _snapshot
+    if method not in ("GET", "HEAD"):
+        return _http_response(405, {"Allow": "GET, HEAD"})
+    head_only = method == "HEAD"
+    url = urlsplit(target)
+    if url.path == "/healthz":
+        body = json.dumps({"version": snapshot["version"], "nodes": len(snapshot["records"])}).encode("utf-8")
+        return _http_response(200, {"Content-Type": "application/json"}, body, head_only)
+    if url.path not in CONTENT_TYPES:
+        return _http_response(404, {"Content-Type": "text/plain"}, b"not found\n", head_only)
+    try:
+        response = get_response(snapshot, url.path, parse_qs(url.query))
+    except (ValueError, KeyError) as e:
+        return _http_response(400, {"Content-Type": "text/plain"}, f"bad query: {e}\n".encode("utf-8"), head_only)
+
+    if response["gzip"] is not None and _accepts_gzip(headers.get("accept-encoding", "")):
+        body, etag, extra = response["gzip"], response["gzip_etag"], {"Content-Encoding": "gzip"}
+    else:
+        body, etag, extra = response["body"], response["etag"], {}
+    common = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(headers.get("if-none-match", ""), etag):
+        return _http_response(304, common)
+    return _http_response(200, dict(common, **{"Content-Type": response["content_type"]}, **extra), body, head_only)
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding 是否接受 gzip（q=0 表示拒绝）"""
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            q = params.strip().lower()
+            return not (q.startswith("q=") and _float(q[2:]) == 0)
+    return False
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 可以是 * 或逗号分隔的多个 ETag，按弱比较（忽略 W/ 前缀）判断"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+def _request_body_length(headers: Dict[str, str]) -> Optional[int]:
+    """请求体长度；使用 Transfer-Encoding 或 Content-Length 无效时返回 None（处理后关闭连接）"""
+    if "transfer-encoding" in headers:
+        return None
+    value = headers.get("content-length", "0").strip() or "0"
+    if not value.isdigit():
+        return None
+    return int(value)
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            parts = lines[0].split(" ")
+            if len(parts) != 3:
+                writer.write(_http_response(400, {"Connection": "close"}))
+                break
+            method, target, version = parts
+            headers = {}
+            for line in lines[1:]:
+                name, sep, value = line.partition(":")
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+            # 接口不使用请求体，但必须读掉，否则会被当作下一个请求解析；长度未知或过大时响应后关闭连接
+            body_length = _request_body_length(headers)
+            keep_alive = body_length is not None and body_length <= MAX_BODY_SIZE
+            if keep_alive and body_length:
+                await reader.readexactly(body_length)
+            response = handle_request(method, target, headers)
+            connection = headers.get("connection", "").lower()
+            if connection == "close" or (version == "HTTP/1.0" and connection != "keep-alive"):
+                keep_alive = False
+            writer.write(response)
+            if not keep_alive:
+                break
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+def swap_snapshot(csv_file: str) -> bool:
+    """重新构建快照并替换当前快照，失败时保留旧快照"""
+    global _snapshot
+    try:
+        snapshot = build_snapshot(csv_file)
+    except Exception as e:
+        logger.warning(f"无法加载 {csv_file}，继续使用旧快照: {e}")
+        return False
+    _snapshot = snapshot
+    logger.info(f"API 快照已更新: {len(snapshot['records'])} 个节点 (版本 {snapshot['version']})")
+    return True
+
+async def _watch(csv_file: str, interval: float):
+    loop = asyncio.get_running_loop()
+    last = None
+    while True:
+        try:
+            stat = os.stat(csv_file)
+            current = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            current = None
+        if current is not None and current != last:
+            if await loop.run_in_executor(None, swap_snapshot, csv_file):
+                last = current
+        await asyncio.sleep(interval)
+
+async def serve_forever(csv_file: str, host: str = SERVE_HOST, port: int = SERVE_PORT,
+                        refresh_interval: float = REFRESH_INTERVAL, ready: threading.Event = None):
+    server = await asyncio.start_server(_handle_connection, host, port, limit=MAX_HEADER_SIZE)
+    watcher = asyncio.ensure_future(_watch(csv_file, refresh_interval))
+    logger.info(f"API 服务已启动: http://{host}:{server.sockets[0].getsockname()[1]}/ (数据: {csv_file})")
+    if ready is not None:
+        ready.port = server.sockets[0].getsockname()[1]
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+def serve(csv_file: str, host: str = SERVE_HOST, port: int = SERVE_PORT, refresh_interval: float = REFRESH_INTERVAL):
+    """在当前线程运行 API 服务，直到被中断"""
+    try:
+        asyncio.run(serve_forever(csv_file, host, port, refresh_interval))
+    except KeyboardInterrupt:
+        logger.info("API 服务已停止")
+
+def start_in_thread(csv_file: str, host: str = SERVE_HOST, port: int = SERVE_PORT,
+                    refresh_interval: float = REFRESH_INTERVAL) -> threading.Thread:
+    """在后台守护线程中运行 API 服务（与 --daemon 的刷新循环并行），返回线程对象"""
+    thread = threading.Thread(target=serve, args=(csv_file, host, port, refresh_interval),
+                              name="api-server", daemon=True)
+    thread.start()
+    return thread
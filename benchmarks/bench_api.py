@@ -0,0 +1,142 @@
+"""HTTP API 压测：在子进程中启动 api_server，用 keep-alive 连接并发请求，统计每秒请求数与延迟分位数
+
+用法: python benchmarks/bench_api.py [--nodes 5000] [--connections 50] [--duration 10] [--csv ip.csv]
+
+未指定 --csv 时生成随机的 ip.csv。服务端进程用 os.sched_setaffinity 固定在一个 CPU 上（平台支持时），
+压测端在本进程内运行；请求混合预渲染的全量/按国家响应、带过滤参数的查询、gzip 与 If-None-Match 条件请求。
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import native_probe  # noqa: E402
+
+COUNTRIES = ["JP", "HK", "SG", "US", "KR", "TW", "DE", "GB"]
+COLOS = ["NRT", "KIX", "HKG", "SIN", "LAX", "SJC", "ICN", "TPE", "FRA", "LHR"]
+PORTS = [443, 2053, 2083, 2087, 2096, 8443]
+
+SERVER = ("import logging, sys; logging.basicConfig(level=logging.WARNING); import api_server; "
+          "api_server.serve(sys.argv[1], port=int(sys.argv[2]))")
+
+def write_csv(path: str, nodes: int):
+    rng = random.Random(42)
+    rows = []
+    for _ in range(nodes):
+        code = rng.choice(COUNTRIES)
+        rows.append([f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                     str(rng.choice(PORTS)), "true", rng.choice(COLOS), "", code, "", "",
+                     f"{rng.randint(20, 400)} ms", f"{rng.uniform(0.5, 40):.2f}"])
+    rows.sort(key=lambda row: -float(row[9]))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(",".join(native_probe.CSV_HEADER) + "\n")
+        f.writelines(",".join(row) + "\n" for row in rows)
+
+def make_requests() -> list:
+    targets = ["/ips.txt", "/ip.csv", "/ips.txt?country=JP", "/ip.csv?country=HK", "/nodes?top=20",
+               "/ips.txt?country=JP,HK&top=10", "/ips.txt?port=443&min_speed=10", "/ip.csv?colo=NRT&max_latency=200",
+               "/healthz"]
+    variants = []
+    for target in targets:
+        variants.append(f"GET {target} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+        variants.append(f"GET {target} HTTP/1.1\r\nHost: bench\r\nAccept-Encoding: gzip\r\n\r\n".encode())
+    return variants
+
+async def read_response(reader: asyncio.StreamReader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status, etag, length = int(head[9:12]), None, 0
+    for line in head.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.lower() == b"content-length":
+            length = int(value)
+        elif name.lower() == b"etag":
+            etag = value.strip().decode()
+    if length:
+        await reader.readexactly(length)
+    return status, etag
+
+async def client(port: int, deadline: float, requests: list, latencies: list, statuses: dict, seed: int):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    etags = {}
+    while time.perf_counter() < deadline:
+        base = request = rng.choice(requests)
+        if base in etags and rng.random() < 0.3:
+            request = base[:-2] + f"If-None-Match: {etags[base]}\r\n\r\n".encode()
+        start = time.perf_counter()
+        writer.write(request)
+        status, etag = await read_response(reader)
+        if etag:
+            etags[base] = etag
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_ready(port: int, timeout: float = 30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as s:
+                s.sendall(b"GET /healthz HTTP/1.1\r\nConnection: close\r\n\r\n")
+                if b'"nodes": 0' not in s.recv(4096):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("API 服务未能启动")
+
+async def run_load(port: int, connections: int, duration: float):
+    requests = make_requests()
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, deadline, requests, latencies, statuses, seed)
+                           for seed in range(connections)))
+    return latencies, statuses, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API 压测")
+    parser.add_argument("--csv", type=str, help="使用已有的 ip.csv（默认生成随机数据）")
+    parser.add_argument("--nodes", type=int, default=5000, help="随机生成的节点数")
+    parser.add_argument("--connections", type=int, default=50, help="并发 keep-alive 连接数")
+    parser.add_argument("--duration", type=float, default=10, help="压测秒数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_file = args.csv or os.path.join(workdir, "ip.csv")
+        if not args.csv:
+            write_csv(csv_file, args.nodes)
+        port = free_port()
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        server = subprocess.Popen([sys.executable, "-c", SERVER, csv_file, str(port)], env=env)
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(server.pid, {min(os.sched_getaffinity(0))})
+            wait_ready(port)
+            latencies, statuses, elapsed = asyncio.run(run_load(port, args.connections, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    quantile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000  # noqa: E731
+    print(f"CPU 数: {os.cpu_count()}，服务端固定在 1 个 CPU 上，{args.connections} 个连接，{elapsed:.1f} 秒")
+    print(f"请求数: {len(latencies)}，{len(latencies) / elapsed:.0f} 请求/秒，状态码: {dict(sorted(statuses.items()))}")
+    print(f"延迟: 中位数 {statistics.median(latencies) * 1000:.2f} ms，p95 {quantile(0.95):.2f} ms，"
+          f"p99 {quantile(0.99):.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""来源正文解码基准：整段 charset_normalizer.detect() 与分级解码 (encoding_detect) 对比
+
+用法: python benchmarks/bench_decode.py [--mbytes 100]
+
+生成与来源 CSV 相同格式的合成数据（含中文国家/城市名），分别以 UTF-8 与 GBK 编码，
+对每种编码测量两种方式从字节到文本的耗时，并确认解码结果一致。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import encoding_detect  # noqa: E402
+
+ROWS = [
+    ("HKG", "香港", "HK", "中国香港", "香港"),
+    ("NRT", "东京", "JP", "日本", "东京"),
+    ("SIN", "新加坡", "SG", "新加坡", "新加坡"),
+    ("LAX", "洛杉矶", "US", "美国", "洛杉矶"),
+    ("FRA", "法兰克福", "DE", "德国", "法兰克福"),
+]
+
+def build_csv(mbytes: int) -> str:
+    """生成约 mbytes MB 的 ip.csv 格式文本"""
+    rng = random.Random(42)
+    target = mbytes * 1024 * 1024
+    lines = ["IP地址,端口,TLS,数据中心,地区,国际代码,国家,城市,网络延迟,下载速度MB/s"]
+    size = len(lines[0]) + 1
+    while size < target:
+        colo, region, code, country, city = rng.choice(ROWS)
+        line = (f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)},"
+                f"{rng.choice((443, 2053, 8443))},true,{colo},{region},{code},{country},{city},"
+                f"{rng.randint(20, 400)} ms,{rng.uniform(1, 30):.2f}")
+        lines.append(line)
+        size += len(line.encode("utf-8")) + 1
+    return "\n".join(lines) + "\n"
+
+def full_detect(data: bytes) -> str:
+    """旧方式：在整段字节上运行统计检测后解码"""
+    from charset_normalizer import detect
+    encoding = detect(data).get("encoding", "utf-8") or "utf-8"
+    return data.decode(encoding, errors="replace")
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="来源正文解码基准")
+    parser.add_argument("--mbytes", type=int, default=100, help="合成 CSV 大小 (MB)")
+    parser.add_argument("--skip-full", action="store_true", help="跳过整段统计检测（数据很大时可能非常慢）")
+    args = parser.parse_args()
+
+    text = build_csv(args.mbytes)
+    for encoding in ("utf-8", "gbk"):
+        data = text.encode(encoding)
+        print(f"== {encoding}: {len(data) / 1024 / 1024:.1f} MB")
+        tiered, tiered_time = timed(encoding_detect.decode_bytes, data)
+        print(f"分级解码: {tiered_time:.2f} 秒 (编码 {tiered[1]})")
+        if not args.skip_full:
+            full, full_time = timed(full_detect, data)
+            print(f"整段检测: {full_time:.2f} 秒，加速 {full_time / tiered_time:.1f}x，结果一致: {full == tiered[0]}")
+
+if __name__ == "__main__":
+    main()
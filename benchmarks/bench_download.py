@@ -0,0 +1,73 @@
+"""内置下载测速引擎基准：本地 HTTP 替身服务器 + 测量循环 CPU 占用
+
+用法: python benchmarks/bench_download.py [--mbytes 1024]
+
+服务器运行在独立进程中，客户端线程的 CPU 时间只统计测量循环本身。
+若 CPU 时间远小于墙钟时间，说明 1 Gbit/s 量级下测量循环不是 CPU 瓶颈。
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import native_probe  # noqa: E402
+
+CHUNK = memoryview(bytes(1024 * 1024))
+
+def serve(listener: socket.socket, body_size: int, rate: float):
+    """极简 HTTP/1.1 替身：返回 Content-Length 为 body_size 的零字节正文，rate>0 时限速 (字节/秒)"""
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            conn.recv(65536)
+            conn.sendall((f"HTTP/1.1 200 OK\r\nContent-Length: {body_size}\r\n"
+                          f"CF-RAY: 0123456789abcdef-HKG\r\nConnection: close\r\n\r\n").encode())
+            sent = 0
+            start = time.perf_counter()
+            try:
+                while sent < body_size:
+                    n = min(len(CHUNK), body_size - sent)
+                    conn.sendall(CHUNK[:n])
+                    sent += n
+                    if rate > 0:
+                        ahead = sent / rate - (time.perf_counter() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            except OSError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(description="内置下载测速引擎基准")
+    parser.add_argument("--mbytes", type=int, default=1024, help="每次下载的正文大小 (MB)")
+    parser.add_argument("--rate-mbit", type=float, default=1000, help="替身服务器限速 (Mbit/s)，0 表示不限速")
+    args = parser.parse_args()
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    port = listener.getsockname()[1]
+    body_size = args.mbytes * 1024 * 1024
+    rate = args.rate_mbit * 1000 * 1000 / 8
+    server = multiprocessing.Process(target=serve, args=(listener, body_size, rate), daemon=True)
+    server.start()
+
+    url = f"127.0.0.1:{port}/__down?bytes={body_size}"
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    result = native_probe.measure_download("127.0.0.1", port, url, tls=False, duration=60)
+    wall = time.perf_counter() - wall_start
+    cpu = time.thread_time() - cpu_start
+    server.terminate()
+
+    if result['speed'] is None:
+        print(f"下载失败: {result['error']}")
+        sys.exit(1)
+    print(f"下载 {result['bytes'] / 1024 / 1024:.0f} MB，数据中心 {result['colo']}")
+    print(f"速度 {result['speed']:.2f} MB/s ({result['speed'] * 8 * 1.048576:.0f} Mbit/s)")
+    print(f"墙钟 {wall:.2f} 秒，测量线程 CPU {cpu:.2f} 秒，CPU 占用 {cpu / wall:.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""GeoIP 补全基准：单进程 lookup_countries 与多进程 lookup_countries_parallel 的吞吐量 (IP/秒)
+
+用法: python benchmarks/bench_geoip.py [--db GeoLite2-Country.mmdb] [--ips 1000000] [--workers 1 2 4 8]
+
+随机生成分布在整个 IPv4 空间的地址（模拟整段导入，网段缓存命中率低），每次从空缓存开始，
+并确认多进程结果与单进程一致。
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geo_enrich  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoIP 补全吞吐量基准")
+    parser.add_argument("--db", type=str, default="GeoLite2-Country.mmdb", help="mmdb 文件路径")
+    parser.add_argument("--ips", type=int, default=1_000_000, help="查询的 IP 数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1], help="要测量的进程数")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    ips = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+           for _ in range(args.ips)]
+    reader = geo_enrich.open_reader(args.db)
+    logging.disable(logging.CRITICAL)
+    baseline = None
+    for workers in dict.fromkeys(args.workers):
+        geo_enrich.configure_parallel(workers=workers, threshold=0)
+        start = time.perf_counter()
+        result = geo_enrich.lookup_countries_parallel(args.db, reader, ips, {})
+        elapsed = time.perf_counter() - start
+        baseline = baseline or result
+        print(f"{workers} 进程: {len(result)} 个 IP {elapsed:.2f} 秒，{len(result) / elapsed / 1e3:.0f}K IP/秒，"
+              f"结果一致: {result == baseline}")
+
+if __name__ == "__main__":
+    main()
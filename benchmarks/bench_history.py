@@ -0,0 +1,74 @@
+"""测速历史基准：在包含数百万样本的数据库上测量 best_nodes 查询与一次 record_samples 的耗时
+
+用法: python benchmarks/bench_history.py [--nodes 20000] [--runs 100] [--queries 200]
+
+先用 record_samples 写入 --warmup 轮真实流程生成汇总，再直接批量插入其余样本模拟长期积累，
+然后统计 "某国家最近 7 天最好的 20 个节点" 查询的中位数与 p99 耗时，以及写入一轮 --nodes 个节点的耗时。
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import node_history  # noqa: E402
+
+COUNTRIES = ["HK", "JP", "SG", "US", "KR", "TW", "DE", "GB"]
+COLOS = ["HKG", "NRT", "SIN", "LAX", "ICN", "TPE", "FRA", "LHR"]
+
+def make_run(rng: random.Random, nodes: list) -> list:
+    return [{'ip': ip, 'port': port, 'ok': rng.random() < 0.8, 'latency': rng.uniform(20, 400),
+             'speed': rng.uniform(0.5, 40), 'colo': COLOS[COUNTRIES.index(country)], 'country': country}
+            for ip, port, country in nodes]
+
+def main():
+    parser = argparse.ArgumentParser(description="测速历史存储基准")
+    parser.add_argument("--nodes", type=int, default=20000, help="节点数")
+    parser.add_argument("--runs", type=int, default=100, help="模拟的测速轮数（样本数 = 节点数 × 轮数）")
+    parser.add_argument("--warmup", type=int, default=3, help="通过 record_samples 写入的轮数")
+    parser.add_argument("--queries", type=int, default=200, help="查询次数")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    rng = random.Random(42)
+    nodes = [(f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+              rng.choice([443, 2053, 8443]), rng.choice(COUNTRIES)) for _ in range(args.nodes)]
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "history.sqlite3")
+        now = int(time.time())
+        start = time.perf_counter()
+        conn = node_history.connect(path)
+        with conn:
+            for run in range(args.runs - args.warmup):
+                ts = now - (args.runs - run) * 3600
+                conn.executemany("INSERT INTO samples (ip, port, ts, ok, latency, speed, colo) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 ((s['ip'], s['port'], ts, s['ok'], s['latency'], s['speed'], s['colo'])
+                                  for s in make_run(rng, nodes)))
+        conn.close()
+        for run in range(args.warmup):
+            node_history.record_samples(path, make_run(rng, nodes), ts=now - (args.warmup - run) * 3600)
+        conn = node_history.connect(path)
+        total = conn.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        conn.close()
+        print(f"准备 {total} 个样本、{args.nodes} 个节点，耗时 {time.perf_counter() - start:.1f} 秒，"
+              f"数据库 {os.path.getsize(path) / 1e6:.0f} MB")
+
+        timings = []
+        for i in range(args.queries):
+            start = time.perf_counter()
+            best = node_history.best_nodes(path, COUNTRIES[i % len(COUNTRIES)], days=7, limit=20)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"best_nodes(最近 7 天前 20): 中位数 {statistics.median(timings):.2f} ms，"
+              f"p99 {timings[int(0.99 * (len(timings) - 1))]:.2f} ms，返回 {len(best)} 个节点")
+
+        start = time.perf_counter()
+        node_history.record_samples(path, make_run(rng, nodes), ts=now)
+        print(f"record_samples({args.nodes} 个节点，含汇总更新与压缩): {time.perf_counter() - start:.2f} 秒")
+
+if __name__ == "__main__":
+    main()
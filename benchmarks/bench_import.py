@@ -0,0 +1,60 @@
+"""导入耗时基准：在全新解释器中导入 pipeline、主脚本与 collect_ips，检查是否超出预算
+
+用法: python benchmarks/bench_import.py [--repeat 5] [--budget-ms 300]
+
+每个模块在独立子进程中导入 repeat 次并取中位数，同时确认导入没有产生 speedtest.log 等副作用。
+任一模块超出预算时以非零状态退出，可用于 CI。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_MS = 300
+
+TARGETS = {
+    "pipeline": "import pipeline",
+    "ip-filter-speedtest-api.py": ("import importlib.util; "
+                                   "spec = importlib.util.spec_from_file_location('ip_filter', 'ip-filter-speedtest-api.py'); "
+                                   "spec.loader.exec_module(importlib.util.module_from_spec(spec))"),
+    "collect_ips": "import collect_ips",
+}
+
+TIMER = ("import time; _start = time.perf_counter(); {statement}; "
+         "print((time.perf_counter() - _start) * 1000)")
+
+def measure(statement: str, workdir: str) -> float:
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE="1")
+    output = subprocess.run([sys.executable, "-c", TIMER.format(statement=statement)], cwd=workdir, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="模块导入耗时基准")
+    parser.add_argument("--repeat", type=int, default=5, help="每个模块的测量次数")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS, help="单个模块导入耗时上限 (毫秒)")
+    args = parser.parse_args()
+
+    over_budget = False
+    with tempfile.TemporaryDirectory() as workdir:
+        # 主脚本按路径加载，复制一份到临时目录，以便检查导入是否在工作目录留下文件
+        for name in ("ip-filter-speedtest-api.py", "collect_ips.py"):
+            with open(os.path.join(ROOT, name), "rb") as src, open(os.path.join(workdir, name), "wb") as dst:
+                dst.write(src.read())
+        for name, statement in TARGETS.items():
+            timings = [measure(statement, workdir) for _ in range(args.repeat)]
+            median = statistics.median(timings)
+            status = "OK" if median <= args.budget_ms else "超出预算"
+            over_budget |= median > args.budget_ms
+            print(f"{name}: 中位数 {median:.1f} ms (最小 {min(timings):.1f} ms，预算 {args.budget_ms:.0f} ms) {status}")
+        leftovers = sorted(set(os.listdir(workdir)) - {"ip-filter-speedtest-api.py", "collect_ips.py"})
+        if leftovers:
+            print(f"导入产生了副作用文件: {leftovers}")
+            over_budget = True
+    sys.exit(1 if over_budget else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""来源解析基准：source_parser.parse_nodes 的单核吞吐量 (行/秒)
+
+用法: python benchmarks/bench_parse.py [--rows 1000000]
+
+生成三种常见来源格式的合成数据：带国家列表头的 CSV、无表头的 "ip:port#国家" 行、ip.csv 格式。
+国家标准化使用 countries.standardize_country。
+
+单核 vCPU 上的参考结果约为 0.15M–0.4M 行/秒。只有规整 CSV 走按列批量解析；
+"ip:port#国家" 等其余格式逐行回退，每个不同的行各调用一次 standardize_country，耗时以此为主。
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import source_parser  # noqa: E402
+from countries import standardize_country  # noqa: E402
+
+COUNTRIES = ["HK", "JP", "SG", "US", "KR", "Tokyo", "Hong Kong", "LAX"]
+
+def random_ip(rng: random.Random) -> str:
+    return f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+def build_sources(rows: int):
+    rng = random.Random(42)
+    csv_lines = ["ip,port,country"]
+    colon_lines = []
+    ipcsv_lines = ["IP地址,端口,TLS,数据中心,地区,国际代码,国家,城市,网络延迟,下载速度MB/s"]
+    for _ in range(rows):
+        ip, port, country = random_ip(rng), rng.choice((443, 2053, 8443)), rng.choice(COUNTRIES)
+        csv_lines.append(f"{ip},{port},{country}")
+        colon_lines.append(f"{ip}:{port}#{country}")
+        ipcsv_lines.append(f"{ip},{port},true,HKG,亚太,HK,中国香港,香港,{rng.randint(20, 400)} ms,{rng.uniform(1, 30):.2f}")
+    return [("CSV 带国家表头", "\n".join(csv_lines)),
+            ("ip:port#国家", "\n".join(colon_lines)),
+            ("ip.csv 格式", "\n".join(ipcsv_lines))]
+
+def main():
+    parser = argparse.ArgumentParser(description="来源解析吞吐量基准")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="每种格式的行数")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for name, content in build_sources(args.rows):
+        start = time.perf_counter()
+        nodes, invalid = source_parser.parse_nodes(content, standardize_country)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {args.rows} 行 {elapsed:.2f} 秒，{args.rows / elapsed / 1e6:.2f}M 行/秒 "
+              f"(节点 {len(nodes)}，无效 {invalid})")
+
+if __name__ == "__main__":
+    main()
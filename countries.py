@@ -0,0 +1,151 @@
+"""国家数据表与标准化：国家代码/标签、别名、城市与 IATA 代码映射，以及预先建好的规范化索引"""
+from functools import lru_cache
+
+import country_index
+
+COUNTRY_MEMO_SIZE = 65536
+
+# 国家代码和标签（保持与A脚本一致）
+COUNTRY_LABELS = {
+    'JP': ('🇯🇵', '日本'), 'KR': ('🇰🇷', '韩国'), 'SG': ('🇸🇬', '新加坡'),
+    'TW': ('🇹🇼', '台湾'), 'HK': ('🇭🇰', '香港'), 'MY': ('🇲🇾', '马来西亚'),
+    'TH': ('🇹🇭', '泰国'), 'ID': ('🇮🇩', '印度尼西亚'), 'PH': ('🇵🇭', '菲律宾'),
+    'VN': ('🇻🇳', '越南'), 'IN': ('🇮🇳', '印度'), 'MO': ('🇲🇴', '澳门'),
+    'KH': ('🇰🇭', '柬埔寨'), 'LA': ('🇱🇦', '老挝'), 'MM': ('🇲🇲', '缅甸'),
+    'MN': ('🇲🇳', '蒙古'), 'KP': ('🇵🇵', '朝鲜'), 'US': ('🇺🇸', '美国'),
+    'GB': ('🇬🇧', '英国'), 'DE': ('🇩🇪', '德国'), 'FR': ('🇫🇷', '法国'),
+    'IT': ('🇮🇹', '意大利'), 'ES': ('🇪🇸', '西班牙'), 'NL': ('🇳🇱', '荷兰'),
+    'FI': ('🇫🇮', '芬兰'), 'AU': ('🇦🇺', '澳大利亚'), 'CA': ('🇨🇦', '加拿大'),
+    'NZ': ('🇳🇿', '新西兰'), 'BR': ('🇧🇷', '巴西'), 'RU': ('🇷🇺', '俄罗斯'),
+    'PL': ('🇵🇱', '波兰'), 'UA': ('🇺🇦', '乌克兰'), 'CZ': ('🇨🇿', '捷克'),
+    'HU': ('🇭🇺', '匈牙利'), 'RO': ('🇷🇴', '罗马尼亚'), 'SA': ('🇸🇦', '沙特阿拉伯'),
+    'AE': ('🇦🇪', '阿联酋'), 'QA': ('🇶🇦', '卡塔尔'), 'IL': ('🇮🇱', '以色列'),
+    'TR': ('🇹🇷', '土耳其'), 'IR': ('🇮🇷', '伊朗'),
+    'CN': ('🇨🇳', '中国'), 'BD': ('🇧🇩', '孟加拉国'), 'PK': ('🇵🇰', '巴基斯坦'),
+    'LK': ('🇱🇰', '斯里兰卡'), 'NP': ('🇳🇵', '尼泊尔'), 'BT': ('🇧🇹', '不丹'),
+    'MV': ('🇲🇻', '马尔代夫'), 'BN': ('🇧🇳', '文莱'), 'TL': ('🇹🇱', '东帝汶'),
+    'EG': ('🇪🇬', '埃及'), 'ZA': ('🇿🇦', '南非'), 'NG': ('🇳🇬', '尼日利亚'),
+    'KE': ('🇰🇪', '肯尼亚'), 'GH': ('🇬🇭', '加纳'), 'MA': ('🇲🇦', '摩洛哥'),
+    'DZ': ('🇩🇿', '阿尔及利亚'), 'TN': ('🇹🇳', '突尼斯'), 'AR': ('🇦🇷', '阿根廷'),
+    'CL': ('🇨🇱', '智利'), 'CO': ('🇨🇴', '哥伦比亚'), 'PE': ('🇵🇪', '秘鲁'),
+    'MX': ('🇲🇽', '墨西哥'), 'VE': ('🇻🇪', '委内瑞拉'), 'SE': ('🇸🇪', '瑞典'),
+    'NO': ('🇳🇴', '挪威'), 'DK': ('🇩🇰', '丹麦'), 'CH': ('🇨🇭', '瑞士'),
+    'AT': ('🇦🇹', '奥地利'), 'BE': ('🇧🇪', '比利时'), 'IE': ('🇮🇪', '爱尔兰'),
+    'PT': ('🇵🇹', '葡萄牙'), 'GR': ('🇬🇷', '希腊'), 'BG': ('🇧🇬', '保加利亚'),
+    'SK': ('🇸🇰', '斯洛伐克'), 'SI': ('🇸🇮', '斯洛文尼亚'), 'HR': ('🇭🇷', '克罗地亚'),
+    'RS': ('🇷🇸', '塞尔维亚'), 'BA': ('🇧🇦', '波黑'), 'MK': ('🇲🇰', '北马其顿'),
+    'AL': ('🇦🇱', '阿尔巴尼亚'), 'KZ': ('🇰🇿', '哈萨克斯坦'), 'UZ': ('🇺🇿', '乌兹别克斯坦'),
+    'KG': ('🇰🇬', '吉尔吉斯斯坦'), 'TJ': ('🇹🇯', '塔吉克斯坦'), 'TM': ('🇹🇲', '土库曼斯坦'),
+    'GE': ('🇬🇪', '格鲁吉亚'), 'AM': ('🇦🇲', '亚美尼亚'), 'AZ': ('🇦🇿', '阿塞拜疆'),
+    'KW': ('🇰🇼', '科威特'), 'BH': ('🇧🇭', '巴林'), 'OM': ('🇴🇲', '阿曼'),
+    'JO': ('🇯🇴', '约旦'), 'LB': ('🇱🇧', '黎巴嫩'), 'SY': ('🇸🇾', '叙利亚'),
+    'IQ': ('🇮🇶', '伊拉克'), 'YE': ('🇾🇪', '也门'),
+    'EE': ('🇪🇪', '爱沙尼亚'), 'LV': ('🇱🇻', '拉脱维亚'), 'LT': ('🇱🇹', '立陶宛'),
+    'MD': ('🇲🇩', '摩尔多瓦'), 'LU': ('🇱🇺', '卢森堡'), 'SC': ('🇸🇨', '塞舌尔'),
+    'CY': ('🇨🇾', '塞浦路斯'), 'GI': ('🇬🇮', '直布罗陀'),
+}
+
+# 国家别名（保持与A脚本一致）
+COUNTRY_ALIASES = {
+    'SOUTH KOREA': 'KR', 'KOREA': 'KR', 'REPUBLIC OF KOREA': 'KR', 'KOREA, REPUBLIC OF': 'KR',
+    'HONG KONG': 'HK', 'HONGKONG': 'HK', 'HK SAR': 'HK',
+    'UNITED STATES': 'US', 'USA': 'US', 'U.S.': 'US', 'UNITED STATES OF AMERICA': 'US',
+    'UNITED KINGDOM': 'GB', 'UK': 'GB', 'GREAT BRITAIN': 'GB', '英国': 'GB',
+    'JAPAN': 'JP', 'JPN': 'JP', '日本': 'JP',
+    'TAIWAN': 'TW', 'TWN': 'TW', 'TAIWAN, PROVINCE OF CHINA': 'TW', '台湾': 'TW',
+    'SINGAPORE': 'SG', 'SGP': 'SG', '新加坡': 'SG',
+    'FRANCE': 'FR', 'FRA': 'FR', '法国': 'FR',
+    'GERMANY': 'DE', 'DEU': 'DE', '德国': 'DE',
+    'NETHERLANDS': 'NL', 'NLD': 'NL', '荷兰': 'NL',
+    'AUSTRALIA': 'AU', 'AUS': 'AU', '澳大利亚': 'AU',
+    'CANADA': 'CA', 'CAN': 'CA', '加拿大': 'CA',
+    'BRAZIL': 'BR', 'BRA': 'BR', '巴西': 'BR',
+    'RUSSIA': 'RU', 'RUS': 'RU', '俄罗斯': 'RU',
+    'INDIA': 'IN', 'IND': 'IN', '印度': 'IN',
+    'CHINA': 'CN', 'CHN': 'CN', '中国': 'CN',
+    'VIET NAM': 'VN', 'VIETNAM': 'VN', '越南': 'VN',
+    'THAILAND': 'TH', 'THA': 'TH', '泰国': 'TH',
+    'BURMA': 'MM', 'MYANMAR': 'MM', '缅甸': 'MM',
+    'NORTH KOREA': 'KP', 'KOREA, DEMOCRATIC PEOPLE\'S REPUBLIC OF': 'KP', '朝鲜': 'KP',
+    'MOLDOVA': 'MD', 'REPUBLIC OF MOLDOVA': 'MD', 'MOLDOVA, REPUBLIC OF': 'MD', '摩尔多瓦': 'MD',
+    'LUXEMBOURG': 'LU', 'GRAND DUCHY OF LUXEMBOURG': 'LU', '卢森堡': 'LU',
+    'SEYCHELLES': 'SC', 'REPUBLIC OF SEYCHELLES': 'SC', '塞舌尔': 'SC',
+    'CYPRUS': 'CY', 'REPUBLIC OF CYPRUS': 'CY', '塞浦路斯': 'CY',
+    'GIBRALTAR': 'GI', '直布罗陀': 'GI',
+}
+
+# 城市到国家代码映射表（保持与A脚本一致）
+CITY_TO_COUNTRY = {
+    'TOKYO': 'JP',
+    'HONG KONG': 'HK',
+    'HONGKONG': 'HK',
+    'LOS ANGELES': 'US',
+    'MANILA': 'PH',
+    'SINGAPORE': 'SG',
+    'SAN JOSE': 'US',
+    'YEREVAN': 'AM',
+    'FRANKFURT': 'DE',
+    'AMSTERDAM': 'NL',
+    'MOSCOW': 'RU',
+    'SEOUL': 'KR',
+    'TAIPEI': 'TW',
+    'BANGKOK': 'TH',
+    'JAKARTA': 'ID',
+    'HO CHI MINH CITY': 'VN',
+    'HANOI': 'VN',
+    'NEW DELHI': 'IN',
+    'YANGON': 'MM',
+    'MACAU': 'MO',
+    'PHNOM PENH': 'KH',
+    'VIENTIANE': 'LA',
+    'ULAANBAATAR': 'MN',
+    'PYONGYANG': 'KP',
+    'CHISINAU': 'MD',
+    'KISHINEV': 'MD',
+    'LUXEMBOURG': 'LU',
+    'VICTORIA': 'SC',
+    'NICOSIA': 'CY',
+    'GIBRALTAR': 'GI',
+}
+
+# IATA 代码到国家代码映射表（保持与A脚本一致）
+IATA_TO_COUNTRY = {
+    'NRT': 'JP',
+    'HKG': 'HK',
+    'LAX': 'US',
+    'MNL': 'PH',
+    'SIN': 'SG',
+    'SJC': 'US',
+    'EVN': 'AM',
+    'FRA': 'DE',
+    'AMS': 'NL',
+    'DME': 'RU',
+    'ICN': 'KR',
+    'TPE': 'TW',
+    'BKK': 'TH',
+    'CGK': 'ID',
+    'SGN': 'VN',
+    'HAN': 'VN',
+    'DEL': 'IN',
+    'RGN': 'MM',
+    'MFM': 'MO',
+    'PNH': 'KH',
+    'VTE': 'LA',
+    'ULN': 'MN',
+    'KIV': 'MD',
+    'LUX': 'LU',
+    'SEZ': 'SC',
+    'LCA': 'CY',
+    'PFO': 'CY',
+    'GIB': 'GI',
+}
+
+COUNTRY_INDEX = country_index.build_country_index(COUNTRY_LABELS, COUNTRY_ALIASES, CITY_TO_COUNTRY, IATA_TO_COUNTRY)
+
+def is_country_like(value: str) -> bool:
+    return bool(standardize_country(value))
+
+@lru_cache(maxsize=COUNTRY_MEMO_SIZE)
+def standardize_country(value: str) -> str:
+    """将国家代码、别名、中文名、城市或 IATA 代码统一为两位国家代码；查 COUNTRY_INDEX，每个字段 O(1)"""
+    return country_index.lookup_country(COUNTRY_INDEX, value)
@@ -0,0 +1,38 @@
+"""国家名称规范化索引：国家代码、别名、中文名、城市与 IATA 代码预先按规范化形式建成一张字典
+
+规范化形式只保留字母（含中文等 CJK 字符），去掉空格、标点与数字后转大写，
+因此 "Hong Kong"、"HONGKONG"、"hong-kong" 与 "香港" 都只需一次字典查找。
+"""
+import re
+from typing import Dict, Mapping, Tuple
+
+NON_LETTERS = re.compile(r'[\W\d_]+')
+
+def normalize_key(value: str) -> str:
+    return NON_LETTERS.sub('', value).upper()
+
+def build_country_index(labels: Mapping[str, Tuple[str, str]], aliases: Mapping[str, str],
+                        cities: Mapping[str, str] = None, iata: Mapping[str, str] = None) -> Dict[str, str]:
+    """建立 规范化键 → 国家代码 的索引
+
+    优先级：国家代码 > 别名 > 中文名 > 城市 > IATA 代码，同一规范化键先登记者生效
+    （例如别名 FRA→FR 优先于 IATA 代码 FRA→DE，与原先的逐表查找顺序一致）。
+    """
+    index: Dict[str, str] = {}
+    for code in labels:
+        index.setdefault(normalize_key(code), code)
+    for alias, code in aliases.items():
+        index.setdefault(normalize_key(alias), code)
+    for code, (_, name) in labels.items():
+        index.setdefault(normalize_key(name), code)
+    for table in (cities or {}, iata or {}):
+        for key, code in table.items():
+            index.setdefault(normalize_key(key), code)
+    index.pop('', None)
+    return index
+
+def lookup_country(index: Dict[str, str], value: str) -> str:
+    """返回 value 对应的国家代码，无法识别时返回空字符串"""
+    if not value:
+        return ''
+    return index.get(normalize_key(value), '')
@@ -0,0 +1,107 @@
+"""GeoIP 网段国家缓存的 SQLite 存储：按 CIDR 建主键，每条记录带写入时间与 mmdb 构建时间 (build_epoch)
+
+数据库使用 WAL 模式，多个流水线进程可以同时读取，写入只在一次短事务内批量 upsert 新增网段，
+不再像 country_cache.json 那样每次运行整体重写。mmdb 更新后 build_epoch 变化，旧版本的记录不再加载并被清理；
+超过 TTL 的记录同样失效。
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Optional
+
+import geo_enrich
+
+logger = logging.getLogger(__name__)
+
+BUSY_TIMEOUT = 10.0
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geoip_networks (
+    network TEXT PRIMARY KEY,
+    country TEXT NOT NULL,
+    build_epoch INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS geoip_networks_epoch ON geoip_networks (build_epoch, updated_at);
+"""
+UPSERT = """
+INSERT INTO geoip_networks (network, country, build_epoch, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (network) DO UPDATE SET
+    country = excluded.country, build_epoch = excluded.build_epoch, updated_at = excluded.updated_at
+"""
+
+def connect(path: str) -> sqlite3.Connection:
+    """打开（必要时创建）存储；WAL 模式允许写入时其他进程继续读取，锁冲突时最多等待 BUSY_TIMEOUT 秒"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def reader_build_epoch(reader) -> Optional[int]:
+    """返回 mmdb 的构建时间戳，reader 为空或读取失败时返回 None"""
+    try:
+        return int(reader.metadata().build_epoch) if reader is not None else None
+    except Exception:
+        return None
+
+def upsert_entries(conn: sqlite3.Connection, entries: Dict[str, str], build_epoch: int, updated_at: int = None):
+    """在一个事务内批量写入 {CIDR: 国家}"""
+    if not entries:
+        return
+    updated_at = int(time.time()) if updated_at is None else updated_at
+    with conn:
+        conn.executemany(UPSERT, ((network, country, build_epoch, updated_at)
+                                  for network, country in entries.items()))
+
+def migrate_json(conn: sqlite3.Connection, json_path: str, build_epoch: int):
+    """把旧的 country_cache.json 导入存储（写入时间取文件修改时间，TTL 照常生效），导入后重命名为 .migrated"""
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            cache = geo_enrich.build_prefix_cache(json.load(f))
+        entries = geo_enrich.prefix_cache_entries(cache)
+        upsert_entries(conn, entries, build_epoch, int(os.path.getmtime(json_path)))
+        os.replace(json_path, json_path + ".migrated")
+        logger.info(f"已将 {json_path} 中的 {len(entries)} 条国家缓存迁移到 SQLite 存储")
+    except Exception as e:
+        logger.warning(f"迁移国家缓存 {json_path} 失败: {e}")
+
+def load_prefix_cache(path: str, build_epoch: Optional[int], ttl: int,
+                      legacy_json: str = None) -> geo_enrich.PrefixCache:
+    """加载与当前 mmdb 构建时间一致且未超过 TTL 的网段，返回前缀缓存
+
+    build_epoch 为 None（GeoIP 数据库未加载）时使用存储中最新一次构建的记录。
+    已知 build_epoch 时顺带删除其他构建版本与过期的记录。
+    """
+    conn = connect(path)
+    try:
+        epoch_known = build_epoch is not None
+        if not epoch_known:
+            row = conn.execute("SELECT MAX(build_epoch) FROM geoip_networks").fetchone()
+            build_epoch = row[0] if row and row[0] is not None else 0
+        elif legacy_json and os.path.exists(legacy_json):
+            migrate_json(conn, legacy_json, build_epoch)
+        cutoff = int(time.time()) - ttl
+        rows = conn.execute("SELECT network, country FROM geoip_networks WHERE build_epoch = ? AND updated_at >= ?",
+                            (build_epoch, cutoff)).fetchall()
+        if epoch_known:
+            # 推断出的构建版本不一定是稍后打开的数据库，不能据此删除其他版本的记录
+            with conn:
+                stale = conn.execute("DELETE FROM geoip_networks WHERE build_epoch != ? OR updated_at < ?",
+                                     (build_epoch, cutoff)).rowcount
+            if stale:
+                logger.info(f"国家缓存清理 {stale} 条过期或属于旧版 GeoIP 数据库的记录")
+        return geo_enrich.build_prefix_cache(dict(rows))
+    finally:
+        conn.close()
+
+def save_entries(path: str, entries: Dict[str, str], build_epoch: Optional[int]):
+    """写入本次新查到的网段；build_epoch 未知时不写入，避免与数据库版本不符的记录"""
+    if not entries or build_epoch is None:
+        return
+    conn = connect(path)
+    try:
+        upsert_entries(conn, entries, build_epoch)
+    finally:
+        conn.close()
@@ -0,0 +1,62 @@
+"""分级文本解码：BOM → 严格 UTF-8 → 有限样本上的统计检测，并按来源缓存检测结果"""
+import codecs
+import logging
+import threading
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+DETECT_SAMPLE_SIZE = 64 * 1024
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+_lock = threading.Lock()
+_encoding_cache: Dict[str, str] = {}
+
+def _detect_sample(data: bytes) -> str:
+    """在前 DETECT_SAMPLE_SIZE 字节上做统计检测；检测不出时返回 utf-8"""
+    from charset_normalizer import detect
+    return detect(data[:DETECT_SAMPLE_SIZE]).get("encoding") or "utf-8"
+
+def decode_bytes(data: bytes, source: str = None, hint: str = None) -> Tuple[str, str]:
+    """将字节解码为文本，返回 (文本, 编码)
+
+    依次尝试：BOM、严格 UTF-8、该来源上次检测出的编码（本进程内缓存，否则为 hint）、样本统计检测。
+    latin-1、gb18030 等编码几乎能"解码"任意字节，因此已知编码只在严格 UTF-8 失败后使用，
+    作用仅是省去统计检测；统计检测得到的编码若无法严格解码整段内容，则以替换字符解码。
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding, errors='replace'), encoding
+
+    try:
+        return data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    cached = (_encoding_cache.get(source) if source else None) or hint
+    if cached and cached not in ('utf-8', 'utf-8-sig'):
+        try:
+            return data.decode(cached), cached
+        except (UnicodeDecodeError, LookupError):
+            pass
+
+    encoding = _detect_sample(data)
+    try:
+        text = data.decode(encoding)
+    except LookupError:
+        encoding = 'utf-8'
+        text = data.decode(encoding, errors='replace')
+    except UnicodeDecodeError:
+        logger.warning(f"{source or '内容'} 无法按 {encoding} 严格解码，使用替换字符")
+        text = data.decode(encoding, errors='replace')
+
+    if source:
+        with _lock:
+            _encoding_cache[source] = encoding
+    return text, encoding
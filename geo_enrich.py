@@ -0,0 +1,210 @@
+"""GeoIP 国家补全：mmap 方式打开 mmdb，并按查询返回的网段（前缀长度）缓存结果
+
+候选节点通常密集分布在少数 /24 中。一次查询得到的网段可以直接回答同一网段内的所有其他 IP，
+因此缓存按 CIDR 保存；查询前先按地址排序，相邻 IP 大多落在上一次命中的网段内。
+"""
+import ipaddress
+import logging
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 前缀缓存: {(IP 版本, 前缀长度): {网络号: 国家代码}}，网络号为地址整数右移 (位数 - 前缀长度)
+PrefixCache = Dict[Tuple[int, int], Dict[int, str]]
+
+# 未命中缓存的 IP 超过该数量时分片到进程池查询；每个工作进程以 mmap 打开自己的 reader
+PARALLEL_THRESHOLD = 100_000
+PARALLEL_WORKERS = os.cpu_count() or 1
+SHARDS_PER_WORKER = 4
+
+_worker_reader = None
+_worker_cache: PrefixCache = {}
+
+def _bits(version: int) -> int:
+    return 32 if version == 4 else 128
+
+def open_reader(db_path):
+    """以 mmap 方式打开 mmdb（优先 C 扩展），返回 geoip2 Reader；数据库无效时抛出异常"""
+    import geoip2.database
+    import maxminddb
+    try:
+        return geoip2.database.Reader(str(db_path), mode=maxminddb.MODE_MMAP_EXT)
+    except (ValueError, ImportError):
+        return geoip2.database.Reader(str(db_path), mode=maxminddb.MODE_MMAP)
+
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+METADATA_MAX_SIZE = 128 * 1024
+
+def read_build_epoch(db_path) -> Optional[int]:
+    """只读取 mmdb 末尾的元数据段得到构建时间戳，不打开完整的 reader；文件不存在或无法解析时返回 None"""
+    try:
+        from maxminddb.decoder import Decoder
+        size = os.path.getsize(db_path)
+        with open(db_path, "rb") as f:
+            f.seek(max(0, size - METADATA_MAX_SIZE))
+            tail = f.read()
+        start = tail.rfind(METADATA_MARKER)
+        if start < 0:
+            return None
+        start += len(METADATA_MARKER)
+        metadata, _ = Decoder(tail, start).decode(start)
+        return int(metadata["build_epoch"])
+    except Exception:
+        return None
+
+def build_prefix_cache(entries: Dict[str, str]) -> PrefixCache:
+    """由 {CIDR 或 IP: 国家} 建立前缀缓存；单个 IP 视为 /32 或 /128，无法解析的键被忽略"""
+    cache: PrefixCache = {}
+    for key, country in entries.items():
+        try:
+            network = ipaddress.ip_network(key, strict=False)
+        except ValueError:
+            continue
+        cache_add(cache, network, country)
+    return cache
+
+def prefix_cache_entries(cache: PrefixCache) -> Dict[str, str]:
+    """将前缀缓存转换为 {CIDR: 国家}，用于持久化"""
+    entries = {}
+    for (version, prefix_len), table in cache.items():
+        shift = _bits(version) - prefix_len
+        address_type = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        for network_number, country in table.items():
+            entries[f"{address_type(network_number << shift)}/{prefix_len}"] = country
+    return entries
+
+def cache_add(cache: PrefixCache, network, country: str):
+    version, prefix_len = network.version, network.prefixlen
+    shift = _bits(version) - prefix_len
+    cache.setdefault((version, prefix_len), {})[int(network.network_address) >> shift] = country
+
+def address_key(ip: str) -> Tuple[int, int]:
+    """返回 (IP 版本, 地址整数)；IPv4 走 inet_pton 快速路径，无效地址抛出 ValueError"""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        address = ipaddress.ip_address(ip.strip('[]'))
+        return address.version, int(address)
+
+def cache_lookup(cache: PrefixCache, version: int, value: int) -> Optional[Tuple[int, int, int, str]]:
+    """在前缀缓存中查找包含该地址的最长匹配网段，返回 (版本, 前缀长度, 网络号, 国家)，未命中返回 None"""
+    bits = _bits(version)
+    for (cached_version, prefix_len), table in sorted(cache.items(), key=lambda item: -item[0][1]):
+        if cached_version != version:
+            continue
+        network_number = value >> (bits - prefix_len)
+        country = table.get(network_number)
+        if country is not None:
+            return version, prefix_len, network_number, country
+    return None
+
+def lookup_countries(reader, ips: Iterable[str], cache: PrefixCache,
+                     added: Dict[str, str] = None) -> Dict[str, str]:
+    """批量查询 IP 的国家代码，返回 {ip: 国家}（查不到为空字符串）
+
+    IP 先去重并按地址排序；每个 IP 依次检查上一次命中的网段、前缀缓存，都未命中才查询 mmdb，
+    并把返回的网段（含查不到国家的网段）写入缓存；给出 added 时新网段同时记入 {CIDR: 国家}，便于增量持久化。
+    reader 可以是返回 reader 的无参函数，只在第一次未命中缓存时调用；reader 为 None 时只使用缓存。
+    """
+    addresses: List[Tuple[int, int, str]] = []
+    result: Dict[str, str] = {}
+    for ip in set(ips):
+        try:
+            addresses.append((*address_key(ip), ip))
+        except ValueError:
+            result[ip] = ''
+    addresses.sort()
+
+    import geoip2.errors
+    last = None
+    hits = lookups = 0
+    for version, value, ip in addresses:
+        if last is not None and last[0] == version and value >> (_bits(version) - last[1]) == last[2]:
+            result[ip] = last[3]
+            hits += 1
+            continue
+        found = cache_lookup(cache, version, value)
+        if found is not None:
+            last = found
+            result[ip] = found[3]
+            hits += 1
+            continue
+        if callable(reader):
+            reader = reader()
+        if reader is None:
+            result[ip] = ''
+            continue
+        lookups += 1
+        try:
+            response = reader.country(ip.strip('[]'))
+            country = response.country.iso_code or ''
+            network = response.traits.network
+        except geoip2.errors.AddressNotFoundError as e:
+            country, network = '', getattr(e, 'network', None)
+        except Exception:
+            result[ip] = ''
+            continue
+        result[ip] = country
+        if network is not None:
+            cache_add(cache, network, country)
+            if added is not None:
+                added[str(network)] = country
+            last = (network.version, network.prefixlen,
+                    int(network.network_address) >> (_bits(network.version) - network.prefixlen), country)
+    if addresses:
+        logger.info(f"GeoIP 查询 {len(addresses)} 个 IP: 网段缓存命中 {hits} 个，查询数据库 {lookups} 次")
+    return result
+
+def configure_parallel(workers: int = None, threshold: int = None):
+    """调整多进程查询的工作进程数与启用阈值（workers <= 1 表示始终在本进程查询）"""
+    global PARALLEL_WORKERS, PARALLEL_THRESHOLD
+    if workers is not None:
+        PARALLEL_WORKERS = max(1, workers)
+    if threshold is not None:
+        PARALLEL_THRESHOLD = max(0, threshold)
+
+def _init_worker(db_path, cache: PrefixCache):
+    global _worker_reader, _worker_cache
+    logger.setLevel(logging.WARNING)
+    _worker_reader = open_reader(db_path)
+    _worker_cache = cache
+
+def _lookup_shard(ips: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    added: Dict[str, str] = {}
+    countries = lookup_countries(_worker_reader, ips, _worker_cache, added)
+    return [countries[ip] for ip in ips], added
+
+def lookup_countries_parallel(db_path, reader, ips: Iterable[str], cache: PrefixCache,
+                              added: Dict[str, str] = None) -> Dict[str, str]:
+    """与 lookup_countries 相同，但去重后的 IP 较多时分片交给进程池并行查询
+
+    IP 按字符串排序后切成连续分片，同一网段的地址基本落在同一分片；前缀缓存随进程池初始化复制到各工作进程，
+    各分片的结果与新网段合并回 cache / added。IP 数低于 PARALLEL_THRESHOLD 时直接在本进程查询。
+    """
+    unique = sorted(set(ips))
+    if callable(reader) and PARALLEL_WORKERS > 1 and len(unique) >= PARALLEL_THRESHOLD:
+        reader = reader()
+    if PARALLEL_WORKERS <= 1 or len(unique) < PARALLEL_THRESHOLD or reader is None:
+        return lookup_countries(reader, unique, cache, added)
+
+    shard_count = PARALLEL_WORKERS * SHARDS_PER_WORKER
+    shard_size = -(-len(unique) // shard_count)
+    shards = [unique[i:i + shard_size] for i in range(0, len(unique), shard_size)]
+    logger.info(f"GeoIP 并行查询: {len(unique)} 个 IP 分为 {len(shards)} 片，{PARALLEL_WORKERS} 个进程")
+    result: Dict[str, str] = {}
+    try:
+        with ProcessPoolExecutor(max_workers=PARALLEL_WORKERS, initializer=_init_worker,
+                                 initargs=(str(db_path), cache)) as executor:
+            for shard, (countries, shard_added) in zip(shards, executor.map(_lookup_shard, shards)):
+                result.update(zip(shard, countries))
+                for network, country in shard_added.items():
+                    cache_add(cache, ipaddress.ip_network(network), country)
+                if added is not None:
+                    added.update(shard_added)
+    except Exception as e:
+        logger.warning(f"GeoIP 并行查询失败，改为在本进程查询: {e}")
+        result.update(lookup_countries(reader, [ip for ip in unique if ip not in result], cache, added))
+    return result
@@ -0,0 +1,204 @@
+"""GeoIP 数据库下载：多个镜像同时发起请求，保留最先返回数据的连接
+
+正文写入 <目标>.part，中断后下一轮以 Range 请求从已下载的位置续传。.part 所属的发布标签与服务器 ETag
+记录在 <目标>.part.json：标签变化或没有任何校验依据时丢弃 .part 重新下载，续传请求带 If-Range，
+服务器上的文件已变化时返回完整内容。完成后校验发布资源的大小与 sha256 摘要，再原子替换目标文件。成功下载的发布版本记录在 <目标>.release.json，
+发布标签未变化且本地文件大小一致时跳过下载。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+DOWNLOAD_DEADLINE = 300
+RACE_ROUNDS = 3
+CHUNK_SIZE = 64 * 1024
+MIN_DB_SIZE = 100
+
+def part_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + ".part")
+
+def part_meta_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + ".part.json")
+
+def _load_json(path: Path) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_json(path: Path, data: Dict):
+    temp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"无法写入 {path}: {e}")
+
+def discard_part(dest: Path):
+    part_path(dest).unlink(missing_ok=True)
+    part_meta_path(dest).unlink(missing_ok=True)
+
+def release_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + ".release.json")
+
+def load_release(dest: Path) -> Dict:
+    return _load_json(release_path(dest))
+
+def save_release(dest: Path, release: Dict):
+    _save_json(release_path(dest), release)
+
+def clear_release(dest: Path):
+    """目标文件改由其他来源写入时调用，避免之后被误判为最新版本"""
+    release_path(dest).unlink(missing_ok=True)
+
+def is_current(dest: Path, release: Dict) -> bool:
+    """本地文件是否就是该发布版本：标签一致，且发布信息带大小时文件大小一致"""
+    if not dest.exists() or not release.get("tag"):
+        return False
+    local = load_release(dest)
+    if local.get("tag") != release["tag"]:
+        return False
+    return not release.get("size") or dest.stat().st_size == release["size"]
+
+def _parse_content_range_start(value: str) -> Optional[int]:
+    # 形如 "bytes 1000-9999/10000"
+    try:
+        return int(value.split(" ", 1)[1].split("-", 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+def _racer(name: str, url: str, part: Path, offset: int, headers: Dict, deadline: float, state: Dict):
+    try:
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            if state["etag"]:
+                request_headers["If-Range"] = state["etag"]
+        with http_client.stream(url, retries=0, backoff_factor=0, headers=request_headers,
+                                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            resumed = bool(offset) and response.status_code == 206
+            if resumed and _parse_content_range_start(response.headers.get("Content-Range", "")) != offset:
+                raise ValueError(f"Content-Range 与续传位置 {offset} 不符: {response.headers.get('Content-Range')}")
+            chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            first = next(chunks, b"")
+            with state["lock"]:
+                if state["winner"] is not None or state["cancelled"]:
+                    return
+                state["winner"] = name
+            logger.info(f"GeoIP 下载选用 {name}" + (f"，从 {offset} 字节处续传" if resumed else ""))
+            _save_json(state["meta_path"], {"tag": state["tag"], "etag": response.headers.get("ETag") or
+                                            (state["etag"] if resumed else None)})
+            with open(part, "ab" if resumed else "wb") as f:
+                f.write(first)
+                for chunk in chunks:
+                    if state["cancelled"]:
+                        raise TimeoutError("下载已被取消")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("超过下载时限")
+                    f.write(chunk)
+            state["ok"] = True
+    except Exception as e:
+        logger.warning(f"通过 {name} 下载 GeoIP 数据库失败: {e}")
+    finally:
+        with state["lock"]:
+            state["finished"] += 1
+            if state["winner"] == name or (state["winner"] is None and state["finished"] == state["total"]):
+                state["done"].set()
+
+def _race_once(candidates: List[Tuple[str, str]], dest: Path, offset: int, headers: Dict, deadline: float,
+               tag: Optional[str], etag: Optional[str]) -> bool:
+    """所有镜像同时请求，最先返回首个数据块的连接负责写入，其余连接随即关闭；返回写入是否完整结束
+
+    返回前取消尚未结束的连接并等待负责写入的线程退出，保证之后没有线程再写 .part。
+    """
+    state = {"lock": threading.Lock(), "done": threading.Event(), "winner": None, "cancelled": False,
+             "ok": False, "finished": 0, "total": len(candidates), "tag": tag, "etag": etag,
+             "meta_path": part_meta_path(dest)}
+    threads = {}
+    for name, url in candidates:
+        threads[name] = threading.Thread(target=_racer, args=(name, url, part_path(dest), offset, headers, deadline, state),
+                                         daemon=True)
+        threads[name].start()
+    state["done"].wait(max(0.0, deadline - time.monotonic()))
+    with state["lock"]:
+        state["cancelled"] = True
+        winner = state["winner"]
+    if winner is not None:
+        # 写入线程在下一个数据块或读超时 (READ_TIMEOUT) 后退出
+        threads[winner].join()
+    return state["ok"]
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def download(candidates: List[Tuple[str, str]], dest: Path, release: Dict = None,
+             headers: Dict = None, deadline: float = DOWNLOAD_DEADLINE) -> bool:
+    """从候选镜像 [(名称, URL)] 下载到 dest；release 可带 tag、size、digest ("sha256:...") 用于校验与记录"""
+    release = release or {}
+    expected_size = release.get("size") or 0
+    tag = release.get("tag")
+    part = part_path(dest)
+    meta = _load_json(part_meta_path(dest))
+    if part.exists() and not (meta.get("tag") == tag and (tag or meta.get("etag"))):
+        # .part 属于其他发布版本，或无法确认与服务器上的文件一致
+        logger.info(f"丢弃不属于当前发布版本 {tag or '未知'} 的未完成下载 {part}")
+        discard_part(dest)
+    end = time.monotonic() + deadline
+    completed = False
+    for _ in range(RACE_ROUNDS):
+        offset = part.stat().st_size if part.exists() else 0
+        if expected_size and offset > expected_size:
+            discard_part(dest)
+            offset = 0
+        if expected_size and offset == expected_size:
+            completed = True
+            break
+        if time.monotonic() >= end:
+            logger.error(f"GeoIP 数据库下载超过 {deadline} 秒时限")
+            break
+        etag = _load_json(part_meta_path(dest)).get("etag") if offset else None
+        if _race_once(candidates, dest, offset, headers, end, tag, etag):
+            completed = True
+            break
+
+    if not part.exists() or part.stat().st_size < MIN_DB_SIZE:
+        logger.error("所有镜像均无法下载 GeoIP 数据库")
+        return False
+    size = part.stat().st_size
+    if expected_size and size != expected_size:
+        logger.error(f"GeoIP 数据库未下载完整 ({size}/{expected_size} 字节)，保留 {part} 供下次续传")
+        return False
+    if not completed and not expected_size:
+        # 发布信息没有大小时只能以最后一次下载正常结束为准，中途断开的文件不能替换现有数据库
+        logger.error(f"GeoIP 数据库下载未正常结束且无法确认大小 ({size} 字节)，已删除下载文件，保留现有数据库")
+        discard_part(dest)
+        return False
+    algorithm, _, expected_digest = (release.get("digest") or "").partition(":")
+    if algorithm == "sha256" and expected_digest and _sha256(part) != expected_digest.lower():
+        logger.error("GeoIP 数据库 sha256 校验失败，已删除下载文件")
+        discard_part(dest)
+        return False
+    os.replace(part, dest)
+    part_meta_path(dest).unlink(missing_ok=True)
+    if release.get("tag"):
+        save_release(dest, {key: release.get(key) for key in ("tag", "size", "digest", "url")})
+    logger.info(f"GeoIP 数据库下载完成并通过校验: {dest} ({size} 字节)")
+    return True
@@ -0,0 +1,162 @@
+"""共享 HTTP 客户端：按主机复用连接池会话，限制全局与单主机并发数，并提供条件请求的源缓存"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = 8
+PER_HOST_CONCURRENCY = 2
+RETRY_STATUS_FORCELIST = [429, 500, 502, 503, 504]
+SOURCE_CACHE_DIR = ".source_cache"
+
+_lock = threading.Lock()
+_sessions: Dict[Tuple[str, int, float], requests.Session] = {}
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_global_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+def configure(max_concurrency: int = None, per_host: int = None, source_cache_dir: str = None):
+    """调整全局与单主机并发上限及源缓存目录（空字符串表示禁用）；应在发出第一个请求前调用"""
+    global MAX_CONCURRENCY, PER_HOST_CONCURRENCY, SOURCE_CACHE_DIR, _global_slots
+    with _lock:
+        if source_cache_dir is not None:
+            SOURCE_CACHE_DIR = source_cache_dir
+        if max_concurrency:
+            MAX_CONCURRENCY = max(1, max_concurrency)
+            _global_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+        if per_host:
+            PER_HOST_CONCURRENCY = max(1, per_host)
+            _host_slots.clear()
+            for session in _sessions.values():
+                session.close()
+            _sessions.clear()
+    logger.info(f"HTTP 并发上限: 全局 {MAX_CONCURRENCY}，单主机 {PER_HOST_CONCURRENCY}")
+
+def get_session(url: str, retries: int = 5, backoff_factor: float = 2) -> requests.Session:
+    """返回该主机共享的会话；同一主机、同一重试策略的请求复用同一个连接池"""
+    host = urlsplit(url).netloc.lower()
+    key = (host, retries, backoff_factor)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_FORCELIST)
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=PER_HOST_CONCURRENCY)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+        return session
+
+@contextmanager
+def request_slot(url: str) -> Iterator[None]:
+    """占用一个主机并发槽和一个全局并发槽，直到请求（含流式正文）处理完毕
+
+    先取主机槽再取全局槽，排队等待同一主机的线程不会占住全局槽。
+    """
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        host_slots = _host_slots.get(host)
+        if host_slots is None:
+            host_slots = _host_slots[host] = threading.BoundedSemaphore(PER_HOST_CONCURRENCY)
+        global_slots = _global_slots
+    with host_slots, global_slots:
+        yield
+
+def get(url: str, retries: int = 5, backoff_factor: float = 2, **kwargs) -> requests.Response:
+    """发送 GET 请求并完整读取正文"""
+    kwargs.pop('stream', None)
+    with request_slot(url):
+        return get_session(url, retries, backoff_factor).get(url, **kwargs)
+
+@contextmanager
+def stream(url: str, retries: int = 5, backoff_factor: float = 2, **kwargs) -> Iterator[requests.Response]:
+    """流式 GET：在 with 块内逐块读取正文，期间持续占用并发槽，退出时释放连接"""
+    with request_slot(url):
+        response = get_session(url, retries, backoff_factor).get(url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
+def _cache_paths(url: str, cache_dir: str) -> Tuple[str, str]:
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json"), os.path.join(cache_dir, f"{key}.body")
+
+def _write_atomic(path: str, data: bytes):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def fetch_cached(url: str, retries: int = 5, backoff_factor: float = 2, **kwargs) -> Tuple[bytes, Dict]:
+    """带 ETag/Last-Modified 校验的 GET：服务器返回 304 时直接复用磁盘上的缓存正文
+
+    返回 (正文, 元数据)；元数据含 etag、last_modified、encoding 以及 from_cache 标记。
+    请求失败时抛出 requests 异常，与 get() 一致。
+    """
+    cache_dir = SOURCE_CACHE_DIR
+    if not cache_dir:
+        response = get(url, retries, backoff_factor, **kwargs)
+        response.raise_for_status()
+        return response.content, {'url': url, 'encoding': response.encoding, 'from_cache': False}
+
+    meta_path, body_path = _cache_paths(url, cache_dir)
+    meta = {}
+    if os.path.exists(meta_path) and os.path.exists(body_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"源缓存元数据损坏，将重新下载 {url}: {e}")
+            meta = {}
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    response = get(url, retries, backoff_factor, headers=headers, **kwargs)
+
+    if response.status_code == 304 and meta:
+        with open(body_path, "rb") as f:
+            body = f.read()
+        meta['checked_at'] = time.time()
+        _write_atomic(meta_path, json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        logger.info(f"源未变化 (304)，复用缓存: {url} ({len(body)} 字节)")
+        return body, dict(meta, from_cache=True)
+
+    response.raise_for_status()
+    body = response.content
+    meta = {
+        'url': url,
+        'etag': response.headers.get('ETag', ''),
+        'last_modified': response.headers.get('Last-Modified', ''),
+        'encoding': response.encoding,
+        'size': len(body),
+        'fetched_at': time.time(),
+        'checked_at': time.time(),
+    }
+    if meta['etag'] or meta['last_modified']:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _write_atomic(body_path, body)
+            _write_atomic(meta_path, json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        except OSError as e:
+            logger.warning(f"无法写入源缓存 {url}: {e}")
+    return body, dict(meta, from_cache=False)
+
+def close_all():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -1,65 +1,49 @@
 import logging
 import sys
 import os
-import requests
 import re
 import csv
 import subprocess
 import threading
 import time
 import json
+import statistics
 import argparse
 import platform
 import shutil
 import tarfile
-from typing import List, Tuple, Dict
+import hashlib
+import signal
+from typing import List, Tuple, Dict, Iterable, Iterator
 from collections import defaultdict
-from charset_normalizer import detect
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from contextlib import contextmanager
 from pathlib import Path
-from packaging import version
-import tempfile
 import atexit
 import stat
-import venv
-import ast
-from bs4 import BeautifulSoup  # 新增依赖以支持B脚本的网页抓取
-from concurrent.futures import ThreadPoolExecutor  # 新增导入
+import native_probe
+import http_client
+import encoding_detect
+import source_parser
+import geo_enrich
+import geoip_download
+import pipeline
+import api_server
+import node_history
+import retest_scheduler
+import probe_quota
+import subnet_sampling
+from countries import COUNTRY_LABELS
+from pipeline import (COUNTRY_CACHE_DB, COUNTRY_CACHE_TTL, DESIRED_COUNTRIES, GEOIP_DB_PATH, HEADERS, IP_LIST_FILE,
+                      IPS_FILE, WEB_PORTS)
+from source_parser import is_valid_port
 
-# 确保日志文件路径可写
 LOG_FILE = "speedtest.log"
 LOG_DIR = os.path.dirname(os.path.abspath(__file__))
-try:
-    os.makedirs(LOG_DIR, exist_ok=True)
-    LOG_PATH = os.path.join(LOG_DIR, LOG_FILE)
-    with open(LOG_PATH, 'a', encoding='utf-8') as f:
-        pass
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(message)s',
-        handlers=[
-            logging.FileHandler(LOG_PATH, encoding="utf-8", mode="w"),
-            logging.StreamHandler(sys.stdout)  # 恢复 StreamHandler
-        ],
-        force=True
-    )
-    logger = logging.getLogger(__name__)
-    logger.info(f"日志初始化完成，日志文件: {LOG_PATH}")
-except Exception as e:
-    print(f"无法创建日志文件 {LOG_PATH}: {e}")
-    sys.exit(1)
-
-# 禁用 stdout 缓冲，确保实时输出
-sys.stdout.reconfigure(line_buffering=True)
+logger = logging.getLogger(__name__)
 
 # 配置
-IP_LIST_FILE = "ip.txt"
-IPS_FILE = "ips.txt"
 FINAL_CSV = "ip.csv"
 INPUT_FILE = "input.csv"
-TEMP_FILE = os.path.join(tempfile.gettempdir(), "temp_proxy.csv")
-TEMP_FILE_CACHE_DURATION = 3600
 INPUT_URLS = [
     "https://bihai.cf/CFIP/CUCC/standard.csv",
     # 添加更多 URL，例如：
@@ -69,156 +53,43 @@ WEB_URLS = [
     'https://ip.164746.xyz/ipTop10.html',
     'https://cf.090227.xyz',
 ]
-WEB_PORTS = [443, 2053, 2083, 2087, 2096, 8443]
 COUNTRY_CACHE_FILE = "country_cache.json"
-GEOIP_DB_PATH = Path("GeoLite2-Country.mmdb")
 GEOIP_DB_URL_BACKUP = "https://download.maxmind.com/app/geoip_download?edition_id=GeoLite2-Country&license_key={}&suffix=tar.gz"
 MAXMIND_LICENSE_KEY = os.getenv("MAXMIND_LICENSE_KEY", "")
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-    "Accept-Language": "en-US,en;q=0.9",
-    "Referer": "https://www.google.com/"
-}
-DESIRED_COUNTRIES = ['TW', 'JP', 'HK', 'SG', 'KR', 'IN', 'KP', 'VN', 'TH', 'MM', 'US']
 REQUIRED_PACKAGES = ['requests', 'charset-normalizer', 'geoip2==4.8.0', 'maxminddb>=2.0.0', 'packaging>=21.3', 'bs4']  # 新增bs4
 CONFIG_FILE = ".gitconfig.json"
 SSH_KEY_PATH = os.path.expanduser("~/.ssh/id_ed25519")
 VENV_DIR = ".venv"
-
-# 国家代码和标签（保持与A脚本一致）
-COUNTRY_LABELS = {
-    'JP': ('🇯🇵', '日本'), 'KR': ('🇰🇷', '韩国'), 'SG': ('🇸🇬', '新加坡'),
-    'TW': ('🇹🇼', '台湾'), 'HK': ('🇭🇰', '香港'), 'MY': ('🇲🇾', '马来西亚'),
-    'TH': ('🇹🇭', '泰国'), 'ID': ('🇮🇩', '印度尼西亚'), 'PH': ('🇵🇭', '菲律宾'),
-    'VN': ('🇻🇳', '越南'), 'IN': ('🇮🇳', '印度'), 'MO': ('🇲🇴', '澳门'),
-    'KH': ('🇰🇭', '柬埔寨'), 'LA': ('🇱🇦', '老挝'), 'MM': ('🇲🇲', '缅甸'),
-    'MN': ('🇲🇳', '蒙古'), 'KP': ('🇵🇵', '朝鲜'), 'US': ('🇺🇸', '美国'),
-    'GB': ('🇬🇧', '英国'), 'DE': ('🇩🇪', '德国'), 'FR': ('🇫🇷', '法国'),
-    'IT': ('🇮🇹', '意大利'), 'ES': ('🇪🇸', '西班牙'), 'NL': ('🇳🇱', '荷兰'),
-    'FI': ('🇫🇮', '芬兰'), 'AU': ('🇦🇺', '澳大利亚'), 'CA': ('🇨🇦', '加拿大'),
-    'NZ': ('🇳🇿', '新西兰'), 'BR': ('🇧🇷', '巴西'), 'RU': ('🇷🇺', '俄罗斯'),
-    'PL': ('🇵🇱', '波兰'), 'UA': ('🇺🇦', '乌克兰'), 'CZ': ('🇨🇿', '捷克'),
-    'HU': ('🇭🇺', '匈牙利'), 'RO': ('🇷🇴', '罗马尼亚'), 'SA': ('🇸🇦', '沙特阿拉伯'),
-    'AE': ('🇦🇪', '阿联酋'), 'QA': ('🇶🇦', '卡塔尔'), 'IL': ('🇮🇱', '以色列'),
-    'TR': ('🇹🇷', '土耳其'), 'IR': ('🇮🇷', '伊朗'),
-    'CN': ('🇨🇳', '中国'), 'BD': ('🇧🇩', '孟加拉国'), 'PK': ('🇵🇰', '巴基斯坦'),
-    'LK': ('🇱🇰', '斯里兰卡'), 'NP': ('🇳🇵', '尼泊尔'), 'BT': ('🇧🇹', '不丹'),
-    'MV': ('🇲🇻', '马尔代夫'), 'BN': ('🇧🇳', '文莱'), 'TL': ('🇹🇱', '东帝汶'),
-    'EG': ('🇪🇬', '埃及'), 'ZA': ('🇿🇦', '南非'), 'NG': ('🇳🇬', '尼日利亚'),
-    'KE': ('🇰🇪', '肯尼亚'), 'GH': ('🇬🇭', '加纳'), 'MA': ('🇲🇦', '摩洛哥'),
-    'DZ': ('🇩🇿', '阿尔及利亚'), 'TN': ('🇹🇳', '突尼斯'), 'AR': ('🇦🇷', '阿根廷'),
-    'CL': ('🇨🇱', '智利'), 'CO': ('🇨🇴', '哥伦比亚'), 'PE': ('🇵🇪', '秘鲁'),
-    'MX': ('🇲🇽', '墨西哥'), 'VE': ('🇻🇪', '委内瑞拉'), 'SE': ('🇸🇪', '瑞典'),
-    'NO': ('🇳🇴', '挪威'), 'DK': ('🇩🇰', '丹麦'), 'CH': ('🇨🇭', '瑞士'),
-    'AT': ('🇦🇹', '奥地利'), 'BE': ('🇧🇪', '比利时'), 'IE': ('🇮🇪', '爱尔兰'),
-    'PT': ('🇵🇹', '葡萄牙'), 'GR': ('🇬🇷', '希腊'), 'BG': ('🇧🇬', '保加利亚'),
-    'SK': ('🇸🇰', '斯洛伐克'), 'SI': ('🇸🇮', '斯洛文尼亚'), 'HR': ('🇭🇷', '克罗地亚'),
-    'RS': ('🇷🇸', '塞尔维亚'), 'BA': ('🇧🇦', '波黑'), 'MK': ('🇲🇰', '北马其顿'),
-    'AL': ('🇦🇱', '阿尔巴尼亚'), 'KZ': ('🇰🇿', '哈萨克斯坦'), 'UZ': ('🇺🇿', '乌兹别克斯坦'),
-    'KG': ('🇰🇬', '吉尔吉斯斯坦'), 'TJ': ('🇹🇯', '塔吉克斯坦'), 'TM': ('🇹🇲', '土库曼斯坦'),
-    'GE': ('🇬🇪', '格鲁吉亚'), 'AM': ('🇦🇲', '亚美尼亚'), 'AZ': ('🇦🇿', '阿塞拜疆'),
-    'KW': ('🇰🇼', '科威特'), 'BH': ('🇧🇭', '巴林'), 'OM': ('🇴🇲', '阿曼'),
-    'JO': ('🇯🇴', '约旦'), 'LB': ('🇱🇧', '黎巴嫩'), 'SY': ('🇸🇾', '叙利亚'),
-    'IQ': ('🇮🇶', '伊拉克'), 'YE': ('🇾🇪', '也门'),
-    'EE': ('🇪🇪', '爱沙尼亚'), 'LV': ('🇱🇻', '拉脱维亚'), 'LT': ('🇱🇹', '立陶宛'),
-    'MD': ('🇲🇩', '摩尔多瓦'), 'LU': ('🇱🇺', '卢森堡'), 'SC': ('🇸🇨', '塞舌尔'),
-    'CY': ('🇨🇾', '塞浦路斯'), 'GI': ('🇬🇮', '直布罗陀'),
-}
-
-# 国家别名（保持与A脚本一致）
-COUNTRY_ALIASES = {
-    'SOUTH KOREA': 'KR', 'KOREA': 'KR', 'REPUBLIC OF KOREA': 'KR', 'KOREA, REPUBLIC OF': 'KR',
-    'HONG KONG': 'HK', 'HONGKONG': 'HK', 'HK SAR': 'HK',
-    'UNITED STATES': 'US', 'USA': 'US', 'U.S.': 'US', 'UNITED STATES OF AMERICA': 'US',
-    'UNITED KINGDOM': 'GB', 'UK': 'GB', 'GREAT BRITAIN': 'GB', '英国': 'GB',
-    'JAPAN': 'JP', 'JPN': 'JP', '日本': 'JP',
-    'TAIWAN': 'TW', 'TWN': 'TW', 'TAIWAN, PROVINCE OF CHINA': 'TW', '台湾': 'TW',
-    'SINGAPORE': 'SG', 'SGP': 'SG', '新加坡': 'SG',
-    'FRANCE': 'FR', 'FRA': 'FR', '法国': 'FR',
-    'GERMANY': 'DE', 'DEU': 'DE', '德国': 'DE',
-    'NETHERLANDS': 'NL', 'NLD': 'NL', '荷兰': 'NL',
-    'AUSTRALIA': 'AU', 'AUS': 'AU', '澳大利亚': 'AU',
-    'CANADA': 'CA', 'CAN': 'CA', '加拿大': 'CA',
-    'BRAZIL': 'BR', 'BRA': 'BR', '巴西': 'BR',
-    'RUSSIA': 'RU', 'RUS': 'RU', '俄罗斯': 'RU',
-    'INDIA': 'IN', 'IND': 'IN', '印度': 'IN',
-    'CHINA': 'CN', 'CHN': 'CN', '中国': 'CN',
-    'VIET NAM': 'VN', 'VIETNAM': 'VN', '越南': 'VN',
-    'THAILAND': 'TH', 'THA': 'TH', '泰国': 'TH',
-    'BURMA': 'MM', 'MYANMAR': 'MM', '缅甸': 'MM',
-    'NORTH KOREA': 'KP', 'KOREA, DEMOCRATIC PEOPLE\'S REPUBLIC OF': 'KP', '朝鲜': 'KP',
-    'MOLDOVA': 'MD', 'REPUBLIC OF MOLDOVA': 'MD', 'MOLDOVA, REPUBLIC OF': 'MD', '摩尔多瓦': 'MD',
-    'LUXEMBOURG': 'LU', 'GRAND DUCHY OF LUXEMBOURG': 'LU', '卢森堡': 'LU',
-    'SEYCHELLES': 'SC', 'REPUBLIC OF SEYCHELLES': 'SC', '塞舌尔': 'SC',
-    'CYPRUS': 'CY', 'REPUBLIC OF CYPRUS': 'CY', '塞浦路斯': 'CY',
-    'GIBRALTAR': 'GI', '直布罗陀': 'GI',
-}
-
-# 城市到国家代码映射表（保持与A脚本一致）
-CITY_TO_COUNTRY = {
-    'TOKYO': 'JP',
-    'HONG KONG': 'HK',
-    'HONGKONG': 'HK',
-    'LOS ANGELES': 'US',
-    'MANILA': 'PH',
-    'SINGAPORE': 'SG',
-    'SAN JOSE': 'US',
-    'YEREVAN': 'AM',
-    'FRANKFURT': 'DE',
-    'AMSTERDAM': 'NL',
-    'MOSCOW': 'RU',
-    'SEOUL': 'KR',
-    'TAIPEI': 'TW',
-    'BANGKOK': 'TH',
-    'JAKARTA': 'ID',
-    'HO CHI MINH CITY': 'VN',
-    'HANOI': 'VN',
-    'NEW DELHI': 'IN',
-    'YANGON': 'MM',
-    'MACAU': 'MO',
-    'PHNOM PENH': 'KH',
-    'VIENTIANE': 'LA',
-    'ULAANBAATAR': 'MN',
-    'PYONGYANG': 'KP',
-    'CHISINAU': 'MD',
-    'KISHINEV': 'MD',
-    'LUXEMBOURG': 'LU',
-    'VICTORIA': 'SC',
-    'NICOSIA': 'CY',
-    'GIBRALTAR': 'GI',
-}
-
-# IATA 代码到国家代码映射表（保持与A脚本一致）
-IATA_TO_COUNTRY = {
-    'NRT': 'JP',
-    'HKG': 'HK',
-    'LAX': 'US',
-    'MNL': 'PH',
-    'SIN': 'SG',
-    'SJC': 'US',
-    'EVN': 'AM',
-    'FRA': 'DE',
-    'AMS': 'NL',
-    'DME': 'RU',
-    'ICN': 'KR',
-    'TPE': 'TW',
-    'BKK': 'TH',
-    'CGK': 'ID',
-    'SGN': 'VN',
-    'HAN': 'VN',
-    'DEL': 'IN',
-    'RGN': 'MM',
-    'MFM': 'MO',
-    'PNH': 'KH',
-    'VTE': 'LA',
-    'ULN': 'MN',
-    'KIV': 'MD',
-    'LUX': 'LU',
-    'SEZ': 'SC',
-    'LCA': 'CY',
-    'PFO': 'CY',
-    'GIB': 'GI',
-}
+VENV_STAMP_NAME = ".requirements.sha256"
+STARTUP_TIMINGS: List[Tuple[str, float]] = []
+FUNNEL_TOP_K = 20
+KEEP_SOURCES_DIR = "sources"
+DAEMON_INTERVAL = 1800
+DAEMON_MAX_AGE = 6 * 3600
+HISTORY_DB = "node_history.sqlite3"
+PROBE_CACHE_FILE = "probe_cache.json"
+INCREMENTAL_TTL = 3 * 3600
+
+
+def setup_logging():
+    """同时输出到 stdout 与 speedtest.log（每次运行覆盖），并关闭 stdout 缓冲以便实时输出"""
+    log_path = os.path.join(LOG_DIR, LOG_FILE)
+    try:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(message)s',
+            handlers=[
+                logging.FileHandler(log_path, encoding="utf-8", mode="w"),
+                logging.StreamHandler(sys.stdout)
+            ],
+            force=True
+        )
+        logger.info(f"日志初始化完成，日志文件: {log_path}")
+    except Exception as e:
+        print(f"无法创建日志文件 {log_path}: {e}")
+        sys.exit(1)
+    sys.stdout.reconfigure(line_buffering=True)
 
 def find_speedtest_script() -> str:
     system = platform.system().lower()
@@ -238,10 +109,11 @@ def find_speedtest_script() -> str:
                     continue
             logger.info(f"找到测速脚本: {candidate}")
             return candidate
-    logger.error("未找到测速脚本，请确保 iptest.sh 或 iptest.bat 存在")
-    sys.exit(1)
+    logger.warning("未找到测速脚本 iptest.sh 或 iptest.bat，仅可使用 --engine=native")
+    return ''
 
-SPEEDTEST_SCRIPT = find_speedtest_script()
+# 在 main() 中查找，导入本模块时不访问文件系统
+SPEEDTEST_SCRIPT = ''
 
 def is_termux() -> bool:
     """检查是否运行在 Termux 环境中"""
@@ -250,15 +122,10 @@ def is_termux() -> bool:
 def parse_speedlimit_from_script(script_path: str) -> float:
     """从 iptest.sh 或 iptest.bat 解析 speedlimit 参数，默认为 8.0 MB/s"""
     try:
-        # 使用 charset_normalizer 检测文件编码
         with open(script_path, "rb") as f:
             raw_data = f.read()
-        detected = detect(raw_data)
-        encoding = detected.get("encoding", "utf-8") or "utf-8"
+        content, encoding = encoding_detect.decode_bytes(raw_data, script_path)
         logger.info(f"检测到 {script_path} 的编码: {encoding}")
-
-        # 解码文件内容
-        content = raw_data.decode(encoding, errors="replace")
         logger.debug(f"{script_path} 内容（前 1000 字符）: {content[:1000]}")
 
         # 匹配 speedlimit 参数，支持多种格式
@@ -313,24 +180,35 @@ def filter_ip_csv_by_speed(csv_file: str, speed_limit: float):
         logger.error(f"过滤 {csv_file} 失败: {e}")
 
 geoip_reader = None
-
-def cleanup_temp_file():
-    temp_dir = tempfile.gettempdir()
-    for temp_file in Path(temp_dir).glob("temp_proxy_*.csv"):
-        try:
-            temp_file.unlink()
-            logger.info(f"已清理临时文件: {temp_file}")
-        except Exception as e:
-            logger.warning(f"无法清理临时文件 {temp_file}: {e}")
-
-atexit.register(cleanup_temp_file)
+geoip_lock = threading.Lock()
+# GeoIP 数据库在第一次未命中缓存的查询时才打开，这里记录打开时使用的参数
+geoip_options = {'offline': False, 'update_geoip': False}
+PIPELINE = None
+
+@contextmanager
+def startup_step(name: str):
+    """记录一个启动步骤的耗时，供 --startup-report 输出"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS.append((name, time.perf_counter() - start))
+
+def log_startup_report():
+    total = sum(elapsed for _, elapsed in STARTUP_TIMINGS)
+    logger.info(f"启动耗时报告 (合计 {total:.3f} 秒):")
+    for name, elapsed in STARTUP_TIMINGS:
+        logger.info(f"  {name}: {elapsed:.3f} 秒")
+
+def venv_stamp_digest(system: str) -> str:
+    """依赖列表与解释器版本的摘要；二者不变时虚拟环境无需重新检查"""
+    payload = json.dumps({'packages': REQUIRED_PACKAGES, 'python': sys.version,
+                          'executable': sys.executable, 'platform': system}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
 def setup_and_activate_venv():
     logger = logging.getLogger(__name__)
     
-    # 定义依赖列表
-    REQUIRED_PACKAGES = ['requests', 'charset-normalizer', 'geoip2==4.8.0', 'maxminddb>=2.0.0', 'packaging>=21.3', 'bs4']  # 新增bs4
-    
     # 检测平台
     system = sys.platform.lower()
     if system.startswith('win'):
@@ -346,164 +224,185 @@ def setup_and_activate_venv():
     logger.debug(f"检测到的平台: {system}")
     logger.debug(f"Python 可执行文件: {sys.executable}, 版本: {sys.version}")
     
-    venv_path = Path('.venv')
+    venv_path = Path(VENV_DIR)
     logger.debug(f"虚拟环境路径: {venv_path}")
+    bin_dir = venv_path / ('Scripts' if system == 'windows' else 'bin')
+    venv_python, pip_venv = str(bin_dir / 'python'), str(bin_dir / 'pip')
+    venv_site = str(venv_path / ('Lib' if system == 'windows' else 'lib') / 
+                    f"python{sys.version_info.major}.{sys.version_info.minor}" / 'site-packages')
+    stamp_path = venv_path / VENV_STAMP_NAME
+    digest = venv_stamp_digest(system)
     
-    # 检查是否需要重建虚拟环境
-    recreate_venv = False
-    if venv_path.exists():
-        logger.debug(f"检测到现有虚拟环境: {venv_path}")
-        venv_python = str(venv_path / ('Scripts' if system == 'windows' else 'bin') / 'python')
+    # 快速路径：标记文件与当前依赖列表、解释器一致时不启动任何子进程
+    with startup_step("虚拟环境标记检查"):
         try:
-            result = subprocess.run([venv_python, '--version'], check=True, capture_output=True, text=True)
-            logger.debug(f"虚拟环境 Python 版本: {result.stdout.strip()}")
-        except subprocess.CalledProcessError as e:
-            logger.warning(f"虚拟环境 Python 不可用: {e}, 将重新创建")
-            recreate_venv = True
-    else:
-        logger.debug("未找到虚拟环境，将创建")
-        recreate_venv = True
-    
-    pip_venv = str(venv_path / ('Scripts' if system == 'windows' else 'bin') / 'pip')
-    logger.debug("开始检查虚拟环境依赖")
+            stamp_ok = stamp_path.read_text(encoding='utf-8').strip() == digest and os.path.isdir(venv_site)
+        except OSError:
+            stamp_ok = False
+    if stamp_ok:
+        if venv_site not in sys.path:
+            sys.path.insert(0, venv_site)
+        logger.info("虚拟环境标记匹配，跳过依赖检查")
+        return
     
-    # 检查已安装的依赖
-    installed_packages = {}
-    if not recreate_venv:
-        try:
-            result = subprocess.run([pip_venv, "list", "--format=json"], check=True, capture_output=True, text=True)
-            logger.debug(f"pip list 输出: {result.stdout}")
-            installed_packages = {pkg["name"].lower(): pkg["version"] for pkg in json.loads(result.stdout)}
-            logger.debug(f"已安装的包: {installed_packages}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"pip list 失败: {e}, 输出: {e.output}")
+    # 检查是否需要重建虚拟环境
+    recreate_venv = False
+    missing_packages = []
+    with startup_step("虚拟环境依赖检查"):
+        if venv_path.exists():
+            logger.debug(f"检测到现有虚拟环境: {venv_path}")
+            try:
+                result = subprocess.run([venv_python, '--version'], check=True, capture_output=True, text=True)
+                logger.debug(f"虚拟环境 Python 版本: {result.stdout.strip()}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"虚拟环境 Python 不可用: {e}, 将重新创建")
+                recreate_venv = True
+        else:
+            logger.debug("未找到虚拟环境，将创建")
             recreate_venv = True
+        
+        # 检查已安装的依赖
+        installed_packages = {}
+        if not recreate_venv:
+            try:
+                result = subprocess.run([pip_venv, "list", "--format=json"], check=True, capture_output=True, text=True)
+                logger.debug(f"pip list 输出: {result.stdout}")
+                installed_packages = {pkg["name"].lower(): pkg["version"] for pkg in json.loads(result.stdout)}
+                logger.debug(f"已安装的包: {installed_packages}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.error(f"pip list 失败: {e}")
+                recreate_venv = True
+        
+        # 验证依赖是否满足
+        if not recreate_venv:
+            from packaging import version
+            for pkg in REQUIRED_PACKAGES:
+                if '==' in pkg:
+                    pkg_name, expected_version = pkg.split('==')
+                    version_op = '=='
+                elif '>=' in pkg:
+                    pkg_name, expected_version = pkg.split('>=')
+                    version_op = '>='
+                else:
+                    pkg_name, expected_version = pkg, None
+                    version_op = None
+                pkg_name = pkg_name.lower().replace('_', '-')
+                
+                if pkg_name not in installed_packages:
+                    logger.warning(f"未找到依赖: {pkg_name}")
+                    missing_packages.append(pkg)
+                    continue
+                
+                if expected_version:
+                    installed_version = installed_packages[pkg_name]
+                    if version_op == '==' and installed_version != expected_version:
+                        logger.warning(f"依赖 {pkg_name} 版本不匹配，实际 {installed_version}，期望 == {expected_version}")
+                        missing_packages.append(pkg)
+                    elif version_op == '>=' and version.parse(installed_version) < version.parse(expected_version):
+                        logger.warning(f"依赖 {pkg_name} 版本过低，实际 {installed_version}，期望 >= {expected_version}")
+                        missing_packages.append(pkg)
     
-    # 验证依赖是否满足
-    missing_packages = []
-    if not recreate_venv:
-        for pkg in REQUIRED_PACKAGES:
-            if '==' in pkg:
-                pkg_name, expected_version = pkg.split('==')
-                version_op = '=='
-            elif '>=' in pkg:
-                pkg_name, expected_version = pkg.split('>=')
-                version_op = '>='
-            else:
-                pkg_name, expected_version = pkg, None
-                version_op = None
-            pkg_name = pkg_name.lower().replace('_', '-')
+    # 虚拟环境损坏时重建
+    if recreate_venv:
+        with startup_step("创建虚拟环境"):
+            if venv_path.exists():
+                logger.debug("删除现有虚拟环境")
+                shutil.rmtree(venv_path, ignore_errors=True)
+                logger.debug("成功删除现有虚拟环境")
             
-            if pkg_name not in installed_packages:
-                logger.warning(f"未找到依赖: {pkg_name}")
-                missing_packages.append(pkg)
-                continue
+            logger.debug(f"创建虚拟环境: {venv_path}")
+            try:
+                subprocess.run([sys.executable, '-m', 'venv', str(venv_path)], check=True)
+                logger.debug("虚拟环境创建成功")
+            except subprocess.CalledProcessError as e:
+                logger.error(f"创建虚拟环境失败: {e}")
+                sys.exit(1)
             
-            if expected_version:
-                installed_version = installed_packages[pkg_name]
-                if version_op == '==' and installed_version != expected_version:
-                    logger.warning(f"依赖 {pkg_name} 版本不匹配，实际 {installed_version}，期望 == {expected_version}")
-                    missing_packages.append(pkg)
-                elif version_op == '>=' and version.parse(installed_version) < version.parse(expected_version):
-                    logger.warning(f"依赖 {pkg_name} 版本过低，实际 {installed_version}，期望 >= {expected_version}")
-                    missing_packages.append(pkg)
-    
-    if missing_packages:
-        logger.warning(f"虚拟环境缺少依赖: {missing_packages}，将重新创建")
-        recreate_venv = True
-    else:
-        logger.info("所有依赖已满足，无需重新创建虚拟环境")
-        recreate_venv = False
+            # 尝试升级 pip（非致命）
+            try:
+                result = subprocess.run([pip_venv, 'install', '--upgrade', 'pip'], check=True, capture_output=True, text=True)
+                logger.debug(f"升级 pip 成功: {result.stdout}")
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"升级 pip 失败: {e}, 输出: {e.output}, 继续安装依赖")
     
-    # 创建或重建虚拟环境
-    if recreate_venv:
-        if venv_path.exists():
-            logger.debug("删除现有虚拟环境")
-            shutil.rmtree(venv_path, ignore_errors=True)
-            logger.debug("成功删除现有虚拟环境")
-        
-        logger.debug(f"创建虚拟环境: {venv_path}")
-        try:
-            subprocess.run([sys.executable, '-m', 'venv', str(venv_path)], check=True)
-            logger.debug("虚拟环境创建成功")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"创建虚拟环境失败: {e}")
-            sys.exit(1)
-        
-        venv_python = str(venv_path / ('Scripts' if system == 'windows' else 'bin') / 'python')
-        pip_venv = str(venv_path / ('Scripts' if system == 'windows' else 'bin') / 'pip')
-        logger.debug(f"虚拟环境 Python: {venv_python}, pip: {pip_venv}")
-        
-        # 尝试升级 pip（非致命）
-        try:
-            result = subprocess.run([pip_venv, 'install', '--upgrade', 'pip'], check=True, capture_output=True, text=True)
-            logger.debug(f"升级 pip 成功: {result.stdout}")
-        except subprocess.CalledProcessError as e:
-            logger.warning(f"升级 pip 失败: {e}, 输出: {e.output}, 继续安装依赖")
-        
-        # 安装依赖
-        for pkg in REQUIRED_PACKAGES:
-            logger.debug(f"安装依赖: {pkg}")
+    # 所有依赖交给 pip 一次解析安装
+    if recreate_venv or missing_packages:
+        logger.info(f"安装依赖: {' '.join(REQUIRED_PACKAGES)}")
+        with startup_step("安装依赖"):
             try:
-                result = subprocess.run([pip_venv, 'install', pkg], check=True, capture_output=True, text=True)
-                logger.debug(f"成功安装依赖: {pkg}, 输出: {result.stdout}")
+                result = subprocess.run([pip_venv, 'install', *REQUIRED_PACKAGES], check=True, capture_output=True, text=True)
+                logger.debug(f"成功安装依赖, 输出: {result.stdout}")
             except subprocess.CalledProcessError as e:
-                logger.error(f"安装依赖 {pkg} 失败: {e}, 输出: {e.output}")
+                logger.error(f"安装依赖失败: {e}, 输出: {e.output}")
                 sys.exit(1)
+    else:
+        logger.info("所有依赖已满足，无需重新创建虚拟环境")
     
     # 将虚拟环境的 site-packages 添加到 sys.path
-    venv_site = str(venv_path / ('Lib' if system == 'windows' else 'lib') / 
-                    f"python{sys.version_info.major}.{sys.version_info.minor}" / 'site-packages')
     logger.debug(f"虚拟环境 site-packages: {venv_site}")
     if venv_site not in sys.path:
         sys.path.insert(0, venv_site)
     logger.debug("虚拟环境已激活")
     
-    # 清理模块缓存
-    for module in list(sys.modules.keys()):
-        if module.startswith('geoip2') or module.startswith('maxminddb') or module.startswith('bs4'):
-            del sys.modules[module]
-    logger.debug("已清理 geoip2、maxminddb 和 bs4 模块缓存")
+    with startup_step("验证关键模块"):
+        # 清理模块缓存
+        for module in list(sys.modules.keys()):
+            if module.startswith('geoip2') or module.startswith('maxminddb') or module.startswith('bs4'):
+                del sys.modules[module]
+        logger.debug("已清理 geoip2、maxminddb 和 bs4 模块缓存")
+        
+        # 验证关键模块
+        try:
+            import geoip2.database
+            import maxminddb
+            import packaging
+            import bs4
+            logger.debug("所有关键模块导入成功")
+        except ImportError as e:
+            logger.error(f"无法导入关键模块: {e}")
+            sys.exit(1)
     
-    # 验证关键模块
     try:
-        import geoip2.database
-        import maxminddb
-        import packaging
-        import bs4
-        logger.debug("所有关键模块导入成功")
-    except ImportError as e:
-        logger.error(f"无法导入关键模块: {e}")
-        sys.exit(1)
+        stamp_path.write_text(digest, encoding='utf-8')
+    except OSError as e:
+        logger.warning(f"无法写入虚拟环境标记 {stamp_path}: {e}")
 
-def get_latest_geoip_url() -> str:
+def get_latest_geoip_release() -> Dict:
+    """返回最新发布中 GeoLite2-Country.mmdb 的 {tag, url, size, digest}，失败时返回空字典"""
     api_url = "https://api.github.com/repos/P3TERX/GeoLite.mmdb/releases/latest"
     logger.info(f"正在从 GitHub API 获取最新版本: {api_url}")
     try:
-        session = requests.Session()
-        retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504, 429])
-        session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(api_url, headers=HEADERS, timeout=30)
+        response = http_client.get(api_url, retries=3, backoff_factor=1, headers=HEADERS, timeout=30)
         response.raise_for_status()
         release_data = response.json()
         
         for asset in release_data.get("assets", []):
             if asset.get("name") == "GeoLite2-Country.mmdb":
-                download_url = asset.get("browser_download_url")
-                logger.info(f"找到最新 GeoIP 数据库 URL: {download_url}")
-                return download_url
+                release = {
+                    "tag": release_data.get("tag_name", ""),
+                    "url": asset.get("browser_download_url"),
+                    "size": asset.get("size") or 0,
+                    "digest": asset.get("digest") or "",
+                }
+                logger.info(f"找到最新 GeoIP 数据库 ({release['tag']}): {release['url']}")
+                return release
         
         logger.error("未找到 GeoLite2-Country.mmdb 的下载 URL")
-        return ""
+        return {}
     except Exception as e:
         logger.error(f"无法获取最新 GeoIP 数据库 URL: {e}")
-        return ""
+        return {}
 
 def download_geoip_database(dest_path: Path) -> bool:
-    url = get_latest_geoip_url()
+    """同时向直连地址和各代理镜像发起下载，发布标签未变化时跳过"""
+    release = get_latest_geoip_release()
+    url = release.get("url")
     if not url:
         logger.error("无法获取最新 GeoIP 数据库 URL")
         return False
+    if geoip_download.is_current(dest_path, release):
+        logger.info(f"GeoIP 数据库已是最新版本 ({release['tag']})，跳过下载")
+        return True
     
     proxy_services = [
         ("Ghfast.top", "https://ghfast.top/"),
@@ -518,36 +417,8 @@ def download_geoip_database(dest_path: Path) -> bool:
             proxy_url = proxy_prefix + url
             urls_to_try.append((proxy_name, proxy_url))
     
-    for proxy_name, download_url in urls_to_try:
-        logger.info(f"下载 GeoIP 数据库（使用 {proxy_name}）: {download_url}")
-        try:
-            session = requests.Session()
-            retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
-            session.mount('https://', HTTPAdapter(max_retries=retry))
-            response = session.get(download_url, timeout=60, stream=True, headers=HEADERS)
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-            with open(dest_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size > 0:
-                            progress = (downloaded / total_size) * 100
-                            logger.info(f"下载进度: {progress:.2f}%")
-            logger.info(f"GeoIP 数据库下载完成: {dest_path}")
-            if not dest_path.exists() or dest_path.stat().st_size < 100:
-                logger.error(f"下载的 GeoIP 数据库无效")
-                dest_path.unlink(missing_ok=True)
-                return False
-            return True
-        except Exception as e:
-            logger.warning(f"通过 {proxy_name} 下载 GeoIP 数据库失败: {e}")
-            continue
-    
-    logger.error("所有代理服务均无法下载 GeoIP 数据库")
-    return False
+    logger.info(f"同时从 {len(urls_to_try)} 个来源下载 GeoIP 数据库: {', '.join(name for name, _ in urls_to_try)}")
+    return geoip_download.download(urls_to_try, dest_path, release=release, headers=HEADERS)
 
 def download_geoip_database_maxmind(dest_path: Path) -> bool:
     if not MAXMIND_LICENSE_KEY:
@@ -555,33 +426,31 @@ def download_geoip_database_maxmind(dest_path: Path) -> bool:
         return False
     url = GEOIP_DB_URL_BACKUP.format(MAXMIND_LICENSE_KEY)
     logger.info(f"从 MaxMind 下载 GeoIP 数据库: {url}")
+    temp_tar = dest_path.with_suffix(".tar.gz")
     try:
         if dest_path.exists():
             logger.info(f"删除旧的 GeoIP 数据库文件: {dest_path}")
             dest_path.unlink(missing_ok=True)
             
-        session = requests.Session()
-        retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
-        session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(url, timeout=60, stream=True, headers=HEADERS)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        temp_tar = dest_path.with_suffix(".tar.gz")
-        with open(temp_tar, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0:
-                        progress = (downloaded / total_size) * 100
-                        logger.info(f"下载进度: {progress:.2f}%")
+        with http_client.stream(url, timeout=60, headers=HEADERS) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get('content-length', 0))
+            downloaded = 0
+            with open(temp_tar, "wb") as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+                        downloaded += len(chunk)
+                        if total_size > 0:
+                            progress = (downloaded / total_size) * 100
+                            logger.info(f"下载进度: {progress:.2f}%")
         with tarfile.open(temp_tar, "r:gz") as tar:
             for member in tar.getmembers():
                 if member.name.endswith("GeoLite2-Country.mmdb"):
                     tar.extract(member, dest_path.parent)
                     extracted_path = dest_path.parent / member.name
                     extracted_path.rename(dest_path)
+                    geoip_download.clear_release(dest_path)
                     break
         temp_tar.unlink(missing_ok=True)
         if not dest_path.exists() or dest_path.stat().st_size < 100:
@@ -616,9 +485,10 @@ def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
             logger.error(f"离线模式下未找到本地 GeoIP 数据库: {GEOIP_DB_PATH}")
             sys.exit(1)
     else:
-        if update_geoip:
-            logger.info("检测到 --update-geoip 参数，强制更新 GeoIP 数据库")
-            GEOIP_DB_PATH.unlink(missing_ok=True)
+        if update_geoip and GEOIP_DB_PATH.exists():
+            logger.info("检测到 --update-geoip 参数，检查 GeoIP 数据库是否有新版本")
+            if not download_geoip_database(GEOIP_DB_PATH):
+                logger.warning("更新 GeoIP 数据库失败，继续使用本地数据库")
         if GEOIP_DB_PATH.exists() and is_geoip_file_valid(GEOIP_DB_PATH):
             logger.info(f"本地 GeoIP 数据库已存在且有效: {GEOIP_DB_PATH}，直接使用")
         else:
@@ -636,11 +506,8 @@ def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
                     sys.exit(1)
     
     try:
-        import geoip2.database
-        with geoip2.database.Reader(GEOIP_DB_PATH) as reader:
-            logger.info("GeoIP 数据库验证成功")
-        geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
-        logger.info("GeoIP 数据库加载成功")
+        geoip_reader = geo_enrich.open_reader(GEOIP_DB_PATH)
+        logger.info("GeoIP 数据库加载成功 (mmap)")
     except ImportError as e:
         logger.error(f"无法导入 geoip2.database: {e}. 请确保 geoip2==4.8.0 已安装，并检查虚拟环境")
         sys.exit(1)
@@ -658,10 +525,8 @@ def init_geoip_reader(offline: bool = False, update_geoip: bool = False):
             if not success:
                 logger.error("重新下载 GeoIP 数据库失败")
                 sys.exit(1)
-        with geoip2.database.Reader(GEOIP_DB_PATH) as reader:
-            logger.info("GeoIP 数据库验证成功")
-        geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
-        logger.info("GeoIP 数据库加载成功")
+        geoip_reader = geo_enrich.open_reader(GEOIP_DB_PATH)
+        logger.info("GeoIP 数据库加载成功 (mmap)")
 
 def close_geoip_reader():
     global geoip_reader
@@ -673,537 +538,353 @@ def close_geoip_reader():
             logger.warning(f"关闭 GeoIP 数据库失败: {e}")
         geoip_reader = None
 
-atexit.register(close_geoip_reader)
 
-def check_dependencies(offline: bool = False, update_geoip: bool = False):
-    init_geoip_reader(offline=offline, update_geoip=update_geoip)
+def get_geoip_reader():
+    """返回 GeoIP reader，首次调用时才检查/下载并打开数据库"""
+    with geoip_lock:
+        if geoip_reader is None:
+            init_geoip_reader(**geoip_options)
+        return geoip_reader
 
-def load_country_cache() -> Dict[str, str]:
-    if os.path.exists(COUNTRY_CACHE_FILE):
+def warm_geoip_reader() -> threading.Thread:
+    """在后台线程中提前打开 GeoIP 数据库（与来源下载并行）；失败时留待首次查询再处理"""
+    def warm():
         try:
-            with open(COUNTRY_CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.warning(f"无法加载国家缓存: {e}")
-    return {}
-
-def save_country_cache(cache: Dict[str, str]):
-    try:
-        with open(COUNTRY_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.warning(f"无法保存国家缓存: {e}")
-
-def is_temp_file_valid(temp_file: str) -> bool:
-    if not os.path.exists(temp_file):
-        return False
-    mtime = os.path.getmtime(temp_file)
-    current_time = time.time()
-    if (current_time - mtime) > TEMP_FILE_CACHE_DURATION:
-        logger.info(f"临时文件 {temp_file} 已过期")
-        return False
-    if os.path.getsize(temp_file) < 10:
-        logger.warning(f"临时文件 {temp_file} 内容太小")
-        return False
-    return True
-
-def detect_delimiter(lines: List[str]) -> str:
-    sample_lines = lines[:5]
-    delimiters = [',', ';', '\t', ' ', '|', '-']
-    counts = {d: 0 for d in delimiters}
-    for line in sample_lines:
-        if not line.strip() or line.startswith('#'):
-            continue
-        for d in delimiters:
-            if d in line:
-                counts[d] += line.count(d)
-    max_count = max(counts.values())
-    if max_count > 0:
-        delimiter = max(counts, key=counts.get)
-        logger.info(f"检测到分隔符: '{delimiter}'")
-        return delimiter
-    logger.warning("无法检测分隔符，假定为逗号")
-    return ','
-
-def is_valid_ip(ip: str) -> bool:
-    ipv4_pattern = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
-    ipv6_pattern = re.compile(r'^(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}$')
-    return bool(ipv4_pattern.match(ip) or ipv6_pattern.match(ip.strip('[]')))
-
-def is_valid_port(port: str) -> bool:
-    try:
-        port_num = int(port)
-        return 0 <= port_num <= 65535
-    except (ValueError, TypeError):
-        return False
-
-def is_country_like(value: str) -> bool:
-    if not value:
-        return False
-    value_upper = value.upper().strip()
-    if re.match(r'^[A-Z]{2}$', value_upper) and value_upper in COUNTRY_LABELS:
-        return True
-    if value_upper in COUNTRY_ALIASES:
-        return True
-    return False
-
-def standardize_country(value: str) -> str:
-    if not value:
-        return ''
-    value_clean = re.sub(r'[^a-zA-Z\s]', '', value).strip().upper()
-    
-    if value_clean in COUNTRY_LABELS:
-        return value_clean
-    
-    if value_clean in COUNTRY_ALIASES:
-        return COUNTRY_ALIASES[value_clean]
-    
-    if value_clean in CITY_TO_COUNTRY:
-        return CITY_TO_COUNTRY[value_clean]
-    
-    if value_clean in IATA_TO_COUNTRY:
-        return IATA_TO_COUNTRY[value_clean]
-    
-    value_no_space = value_clean.replace(' ', '')
-    for alias, code in COUNTRY_ALIASES.items():
-        alias_clean = alias.replace(' ', '')
-        if value_no_space == alias_clean:
-            return code
-    for city, code in CITY_TO_COUNTRY.items():
-        city_clean = city.replace(' ', '')
-        if value_no_space == city_clean:
-            return code
-    
-    return ''
-
-def find_country_column(lines: List[str], delimiter: str) -> Tuple[int, str, int]:
-    country_col = -1
-    ip_col, port_col = 0, 1
-    sample_lines = [line for line in lines[:20] if line.strip() and not line.startswith('#')]
-    if not sample_lines:
-        return ip_col, port_col, country_col
-
-    col_matches = defaultdict(int)
-    total_rows = len(sample_lines)
-    for line in sample_lines:
-        fields = line.split(delimiter)
-        for col, field in enumerate(fields):
-            field = field.strip()
-            standardized = standardize_country(field)
-            if standardized:
-                col_matches[col] += 1
-
-    if col_matches:
-        for col, count in col_matches.items():
-            logger.info(f"列 {col + 1}: 匹配 {count} 行 (匹配率: {count / total_rows:.2%})")
-        country_col = max(col_matches, key=col_matches.get)
-        match_rate = col_matches[country_col] / total_rows
-        if match_rate >= 0.3:
-            logger.info(f"选择国家列: 第 {country_col + 1} 列 (匹配率: {match_rate:.2%})")
-        else:
-            country_col = -1
-    else:
-        logger.info("未找到任何匹配国家代码、城市或 IATA 代码列")
-
-    return ip_col, port_col, country_col
-
-def fetch_and_save_to_temp_file(url: str) -> str:
-    logger.info(f"下载 URL: {url} 到 {TEMP_FILE}")
-    try:
-        session = requests.Session()
-        retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
-        session.mount('https://', HTTPAdapter(max_retries=retry))
-        response = session.get(url, timeout=60, headers=HEADERS, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        temp_content = []
-        with open(TEMP_FILE, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    temp_content.append(chunk)
-                    if total_size > 0:
-                        progress = (downloaded / total_size) * 100
-                        logger.info(f"下载进度: {progress:.2f}%")
-        
-        try:
-            with open(TEMP_FILE, "rb") as f:
-                raw_data = f.read()
-            encoding = detect(raw_data).get("encoding", "utf-8")
-            content = raw_data.decode(encoding)
-            lines = content.strip().splitlines()
-            if not lines:
-                logger.error(f"下载的文件 {TEMP_FILE} 为空")
-                return ''
-            logger.info(f"下载文件编码: {encoding}")
-            logger.info(f"下载文件前 5 行: {lines[:5]}")
-            delimiter = detect_delimiter(lines)
-            if not delimiter:
-                logger.error(f"下载的文件 {TEMP_FILE} 无法检测分隔符")
-                return ''
-            header = lines[0].strip().split(delimiter)
-            if len(header) < 2 or 'ip' not in header[0].lower():
-                logger.warning(f"下载的文件 {TEMP_FILE} 表头可能无效: {header}")
-            if len(lines) < 2:
-                logger.error(f"下载的文件 {TEMP_FILE} 缺少数据行")
-                return ''
-        except Exception as e:
-            logger.error(f"验证下载文件格式失败: {e}")
-            return ''
-        
-        logger.info(f"已下载到 {TEMP_FILE}")
-        return TEMP_FILE
-    except Exception as e:
-        logger.error(f"无法下载 URL: {e}")
-        return ''
-
-def fetch_multiple_urls_to_temp_files(urls: List[str]) -> List[str]:
-    """从多个 URL 下载内容并保存到临时文件，返回有效临时文件列表"""
-    temp_files = []
-    for idx, url in enumerate(urls):
-        temp_file = os.path.join(tempfile.gettempdir(), f"temp_proxy_{idx}.csv")
-        logger.info(f"下载 URL: {url} 到 {temp_file}")
-        try:
-            session = requests.Session()
-            retry = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
-            session.mount('https://', HTTPAdapter(max_retries=retry))
-            response = session.get(url, timeout=60, headers=HEADERS, stream=True)
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-            with open(temp_file, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size > 0:
-                            progress = (downloaded / total_size) * 100
-                            logger.info(f"下载进度 ({url}): {progress:.2f}%")
-            
-            # 验证文件
-            with open(temp_file, "rb") as f:
-                raw_data = f.read()
-            encoding = detect(raw_data).get("encoding", "utf-8")
-            content = raw_data.decode(encoding)
-            lines = content.strip().splitlines()
-            if not lines:
-                logger.error(f"下载的文件 {temp_file} 为空")
-                os.remove(temp_file)
-                continue
-            delimiter = detect_delimiter(lines)
-            if not delimiter:
-                logger.error(f"下载的文件 {temp_file} 无法检测分隔符")
-                os.remove(temp_file)
-                continue
-            temp_files.append(temp_file)
-            logger.info(f"已下载到 {temp_file}")
-        except Exception as e:
-            logger.error(f"无法下载 URL {url}: {e}")
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-    return temp_files
+            get_geoip_reader()
+        except BaseException as e:
+            logger.warning(f"后台预热 GeoIP 数据库失败，将在首次查询时重试: {e!r}")
+    thread = threading.Thread(target=warm, name="geoip-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def check_dependencies(offline: bool = False, update_geoip: bool = False, warmup: bool = False):
+    """记录 GeoIP 参数；--update-geoip 时立即更新并打开数据库，--geoip-warmup 时在后台预热，否则按需打开"""
+    geoip_options.update(offline=offline, update_geoip=update_geoip)
+    if update_geoip:
+        get_geoip_reader()
+    elif warmup:
+        warm_geoip_reader()
+
+def get_pipeline() -> pipeline.Pipeline:
+    """返回本进程共用的流水线；GeoIP 数据库由 get_geoip_reader 负责检查、下载与打开"""
+    global PIPELINE
+    if PIPELINE is None:
+        PIPELINE = pipeline.Pipeline(
+            desired_countries=DESIRED_COUNTRIES, geoip_db_path=GEOIP_DB_PATH,
+            country_cache_db=COUNTRY_CACHE_DB, country_cache_ttl=COUNTRY_CACHE_TTL,
+            legacy_country_cache=COUNTRY_CACHE_FILE, reader_factory=get_geoip_reader, headers=HEADERS)
+    return PIPELINE
+
+def fetch_source_nodes(url: str, idx: int, keep_sources: bool = False) -> List[Tuple[str, int, str]]:
+    """下载单个 URL 数据源并直接在内存中解析；keep_sources 为 True 时另将原始正文保存到 KEEP_SOURCES_DIR"""
+    pipe = get_pipeline()
+    pipe.keep_sources_dir = KEEP_SOURCES_DIR if keep_sources else None
+    return pipe.fetch_source(url, idx)
+
+def iter_source_batches(args: argparse.Namespace) -> Iterator[List[Tuple[str, int, str]]]:
+    """并发拉取所有在线来源，每个来源一完成解析就立即产出其节点批次"""
+    if args.offline:
+        return iter(())
+    pipe = get_pipeline()
+    pipe.keep_sources_dir = KEEP_SOURCES_DIR if args.keep_sources else None
+    return pipe.iter_sources(args.url or [], WEB_URLS, WEB_PORTS)
+
+def run_streaming_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str]) -> List[Dict]:
+    """流式管道：来源解析、国家补全过滤与延迟探测首尾相连，返回可达节点的探测结果并写出 ip.txt"""
+    handshake_host = None
+    if args.funnel and args.funnel_handshake == "tls":
+        handshake_host, _ = native_probe.split_speedtest_url(args.speedtest_url)
+    batches = get_pipeline().iter_candidates(iter_source_batches(args), node_countries)
+    probes = native_probe.probe_latency_stream(
+        batches, concurrency=args.probe_concurrency, samples=args.probe_samples,
+        timeout=args.probe_timeout, handshake_host=handshake_host, queue_size=args.stream_queue_size
+    )
+    if probes:
+        with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+            for r in probes:
+                f.write(f"{r['ip']} {r['port']}\n")
+        logger.info(f"已生成 {IP_LIST_FILE}，包含 {len(probes)} 个可达节点")
+    return probes
 
 def fetch_all_sources(args: argparse.Namespace) -> List[Tuple[str, int, str]]:
     """并行处理所有在线来源（INPUT_URLS 和 WEB_URLS），返回合并的节点列表"""
-    ip_ports = []
-    futures = []
-
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        # 处理 INPUT_URLS
-        if args.url and not args.offline:
-            logger.info(f"从 INPUT_URLS 开始提取节点: {args.url}")
-            futures.append(executor.submit(fetch_multiple_urls_to_temp_files, args.url))
-        # 处理 WEB_URLS
-        if WEB_URLS and not args.offline:
-            logger.info(f"从 WEB_URLS 开始提取节点: {WEB_URLS}")
-            futures.append(executor.submit(extract_ip_ports_from_web, WEB_URLS, WEB_PORTS))
-
-        for future in futures:
-            result = future.result()
-            if isinstance(result, list) and all(isinstance(item, str) for item in result):  # TEMP_FILES
-                for temp_file in result:
-                    if is_temp_file_valid(temp_file):
-                        temp_ip_ports = extract_ip_ports_from_file(temp_file)
-                        ip_ports.extend(temp_ip_ports)
-                        logger.info(f"从临时文件 {temp_file} 提取到 {len(temp_ip_ports)} 个节点")
-                        os.remove(temp_file)  # 清理临时文件
-            elif isinstance(result, list):  # WEB_IP_PORTS
-                ip_ports.extend(result)
-                logger.info(f"从 WEB_URLS 提取到 {len(result)} 个节点")
-
-    return list(dict.fromkeys(ip_ports))  # 去重
+    if args.offline:
+        return []
+    pipe = get_pipeline()
+    pipe.keep_sources_dir = KEEP_SOURCES_DIR if args.keep_sources else None
+    return pipe.fetch_all(args.url or [], WEB_URLS, WEB_PORTS)
 
 def extract_ip_ports_from_file(file_path: str) -> List[Tuple[str, int, str]]:
-    if not os.path.exists(file_path):
-        logger.error(f"文件 {file_path} 不存在")
-        return []
+    return get_pipeline().parse_file(file_path)
+
+def write_ip_list(ip_ports: List[Tuple[str, int, str]], is_github_actions: bool,
+                  node_countries: Dict[Tuple[str, int], str] = None) -> str:
+    """按国家过滤节点并写入 ip.txt；若传入 node_countries，则同时记录每个保留节点的最终国家"""
+    return get_pipeline().write_ip_list(ip_ports, IP_LIST_FILE, node_countries)
+
+def read_ip_list(file_path: str = IP_LIST_FILE) -> List[Tuple[str, int]]:
+    """读取 ip.txt（每行 "IP 端口"），兼容 BOM"""
+    nodes = []
+    with open(file_path, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and is_valid_port(parts[1]):
+                nodes.append((parts[0], int(parts[1])))
+    return nodes
+
+def run_latency_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str] = None,
+                      probes: List[Dict] = None) -> str:
+    """使用内置 asyncio 探测器测量 ip.txt 中所有节点的 TCP 连接延迟，结果按 ip.csv 格式写出"""
+    results = probes
+    if results is None:
+        if not os.path.exists(IP_LIST_FILE):
+            logger.error(f"{IP_LIST_FILE} 不存在，请确保 write_ip_list 已正确生成文件")
+            return None
+        try:
+            nodes = read_ip_list(IP_LIST_FILE)
+        except Exception as e:
+            logger.error(f"无法读取 {IP_LIST_FILE}: {e}")
+            return None
+        logger.info(f"{IP_LIST_FILE} 包含 {len(nodes)} 个节点，开始原生延迟探测")
+        results = native_probe.probe_latency(
+            nodes, concurrency=args.probe_concurrency, samples=args.probe_samples, timeout=args.probe_timeout
+        )
+    reachable = [r for r in results if r['received']]
+    if not reachable:
+        logger.error("没有可达的节点")
+        return None
+    medians = [r['median'] for r in reachable]
+    lossy = sum(1 for r in reachable if r['loss'] > 0)
+    logger.info(f"延迟统计: 最小={min(medians):.0f} ms, 中位={statistics.median(medians):.0f} ms, "
+                f"最大={max(medians):.0f} ms, 存在丢包的节点={lossy}")
+
+    country_names = {code: name for code, (_, name) in COUNTRY_LABELS.items()}
+    count = native_probe.write_results_csv(FINAL_CSV, reachable, node_countries, country_names)
+    logger.info(f"{FINAL_CSV} 包含 {count} 个节点")
+    return FINAL_CSV
+
+def run_native_speed_test(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str] = None,
+                          probes: List[Dict] = None) -> str:
+    """内置测速后端：先探测全部节点的连接延迟，再按延迟顺序对可达节点进行下载测速
+
+    每个国家只有延迟最低的 --funnel-top-k 个可达节点进入下载测速（与漏斗模式相同的上限），
+    否则每个可达节点都要下载约 10 秒。超出上限而未测速的节点会从 ip.txt 中移除，见 drop_untested_nodes。
+    若传入 probes（如漏斗模式第一阶段的结果），则跳过延迟探测直接进入下载测速。
+    """
     start_time = time.time()
-    with open(file_path, "rb") as f:
-        raw_data = f.read()
-    encoding = detect(raw_data).get("encoding", "utf-8")
-    logger.info(f"文件 {file_path} 编码: {encoding}")
-    try:
-        content = raw_data.decode(encoding)
-    except UnicodeDecodeError as e:
-        logger.error(f"无法解码文件 {file_path}: {e}")
-        return []
-    ip_ports = extract_ip_ports_from_content(content)
-    logger.info(f"文件 {file_path} 解析完成 (耗时: {time.time() - start_time:.2f} 秒)")
-    return ip_ports
-
-def extract_ip_ports_from_web(urls: List[str], ports: List[int]) -> List[Tuple[str, int, str]]:
-    """从指定网页提取IP并分配端口"""
-    ip_ports = []
-    ipv4_pattern = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)')
-    
-    for url in urls:
-        logger.info(f"正在从网页提取 IP: {url}")
+    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 8.0
+    if probes is None:
+        if not os.path.exists(IP_LIST_FILE):
+            logger.error(f"{IP_LIST_FILE} 不存在，请确保 write_ip_list 已正确生成文件")
+            return None
         try:
-            session = requests.Session()
-            retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-            session.mount('https://', HTTPAdapter(max_retries=retry))
-            response = session.get(url, headers=HEADERS, timeout=30)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            text = soup.get_text()
-            ips = set(ipv4_pattern.findall(text))
-            
-            logger.info(f"从 {url} 提取到 {len(ips)} 个唯一 IP")
-            
-            for ip in ips:
-                if is_valid_ip(ip):
-                    for port in ports:
-                        ip_ports.append((ip, port, ''))  # 国家信息留空，依赖GeoIP查询
-                else:
-                    logger.debug(f"无效 IP 地址: {ip}")
-                    
+            nodes = read_ip_list(IP_LIST_FILE)
         except Exception as e:
-            logger.error(f"无法从 {url} 提取 IP: {e}")
+            logger.error(f"无法读取 {IP_LIST_FILE}: {e}")
+            return None
+        logger.info(f"{IP_LIST_FILE} 包含 {len(nodes)} 个节点，使用内置引擎测速")
+        probes = native_probe.probe_latency(
+            nodes, concurrency=args.probe_concurrency, samples=args.probe_samples, timeout=args.probe_timeout
+        )
+    reachable = [r for r in probes if r['received']]
+    if not reachable:
+        logger.error("没有可达的节点")
+        return None
+    reachable = sorted(reachable, key=lambda r: (r['median'], r['jitter'] or 0))
+    reachable, skipped = cap_per_country(reachable, node_countries or {}, args.funnel_top_k)
+    if skipped:
+        logger.info(f"下载测速: 每个国家保留延迟最低的 {args.funnel_top_k} 个可达节点，"
+                    f"共 {len(reachable)} 个，{len(skipped)} 个超出上限不测速")
+        drop_untested_nodes(skipped)
+
+    downloads = native_probe.run_download_tests(
+        [(r['ip'], r['port']) for r in reachable], url=args.speedtest_url, concurrency=args.speedtest_concurrency
+    )
+    passed = []
+    for probe, download in zip(reachable, downloads):
+        if download['speed'] is None:
+            logger.debug(f"{probe['ip']}:{probe['port']} 下载测速失败: {download['error']}")
             continue
-    
-    unique_ip_ports = list(dict.fromkeys(ip_ports))
-    logger.info(f"从网页共提取 {len(unique_ip_ports)} 个唯一 IP:端口对")
-    return unique_ip_ports
-
-def extract_ip_ports_from_content(content: str) -> List[Tuple[str, int, str]]:
-    server_port_pairs = []
-    invalid_lines = []
-    content = content.replace('\r\n', '\n').replace('\r', '\n')
-    lines = content.splitlines()
-    if not lines:
-        logger.error("内容为空")
-        return []
-
-    logger.info(f"数据源样本 (前 5 行): {lines[:5]}")
+        logger.info(f"{probe['ip']}:{probe['port']} 数据中心={download['colo'] or '未知'} "
+                    f"延迟={probe['median']:.0f} ms 速度={download['speed']:.2f} MB/s")
+        if download['speed'] >= speed_limit:
+            probe.update(speed=download['speed'], colo=download['colo'])
+            passed.append(probe)
+    passed.sort(key=lambda r: r['speed'], reverse=True)
+    logger.info(f"测速完成，{len(passed)} 个节点达到速度下限 {speed_limit} MB/s，耗时: {time.time() - start_time:.2f} 秒")
+    if not passed:
+        logger.error("没有节点达到速度下限")
+        return None
 
-    try:
-        data = json.loads(content)
-        for item in data:
-            ip = item.get('ip', '') or item.get('IP Address', '') or item.get('ip_address', '')
-            port = item.get('port', '') or item.get('Port', '')
-            country = standardize_country(
-                item.get('country', '') or
-                item.get('countryCode', '') or
-                item.get('country_code', '') or
-                item.get('location', '') or
-                item.get('nation', '') or
-                item.get('region', '') or
-                item.get('geo', '') or
-                item.get('area', '') or
-                item.get('dc city', '') or
-                item.get('dc_city', '') or
-                item.get('city', '') or
-                item.get('dc location', '') or
-                item.get('dc_location', '')
-            )
-            if is_valid_ip(ip) and is_valid_port(str(port)):
-                server_port_pairs.append((ip, int(port), country))
-        logger.info(f"从 JSON 解析出 {len(server_port_pairs)} 个节点，其中 {sum(1 for _, _, c in server_port_pairs if c)} 个有国家信息")
-        return list(dict.fromkeys(server_port_pairs))
-    except json.JSONDecodeError as e:
-        logger.info(f"JSON 解析失败: {e}")
-
-    delimiter = detect_delimiter(lines)
-    if not delimiter:
-        logger.warning("无法检测分隔符，假定为逗号")
-        delimiter = ','
-
-    ip_col, port_col, country_col = 0, 1, -1
-    lines_to_process = lines
-    if lines and lines[0].strip() and not lines[0].startswith('#'):
-        header = lines[0].strip().split(delimiter)
-        logger.info(f"检测到表头: {header}")
-        for idx, col in enumerate(header):
-            col_lower = col.strip().lower()
-            if col_lower in ['ip', 'address', 'ip_address', 'ip地址', 'ip address']:
-                ip_col = idx
-            elif col_lower in ['port', '端口', 'port_number', '端口号']:
-                port_col = idx
-            elif col_lower in ['country', '国家', 'country_code', 'countrycode', '国际代码', 'nation', 'location', 'region', 'geo', 'area', 'Country', 'cc', 'iso_code', 'country_name', 'dc city', 'dc_city', 'city', 'dc location', 'dc_location']:
-                country_col = idx
-        if country_col != -1:
-            logger.info(f"检测到国家列: 第 {country_col + 1} 列 (字段名: {header[country_col]})")
-            lines_to_process = lines[1:]
+    speeds = [r['speed'] for r in passed]
+    logger.info(f"ip.csv 速度统计: 平均={sum(speeds)/len(speeds):.2f} MB/s, "
+                f"最小={min(speeds):.2f} MB/s, 最大={max(speeds):.2f} MB/s, "
+                f"节点数={len(speeds)}")
+    country_names = {code: name for code, (_, name) in COUNTRY_LABELS.items()}
+    count = native_probe.write_results_csv(FINAL_CSV, passed, node_countries, country_names)
+    logger.info(f"{FINAL_CSV} 包含 {count} 个节点")
+    return FINAL_CSV
+
+def cap_per_country(probes: List[Dict], node_countries: Dict[Tuple[str, int], str],
+                    top_k: int) -> Tuple[List[Dict], List[Tuple[str, int]]]:
+    """按原顺序每个国家保留前 top_k 个节点，返回 (保留的探测结果, 超出上限的 (ip, port))；top_k <= 0 表示不限制"""
+    if top_k <= 0:
+        return list(probes), []
+    kept, skipped, counts = [], [], defaultdict(int)
+    for r in probes:
+        country = node_countries.get((r['ip'], r['port']), '')
+        if counts[country] < top_k:
+            counts[country] += 1
+            kept.append(r)
         else:
-            logger.info("表头中不包含国家相关列，尝试逐行逐列搜索")
-            ip_col, port_col, country_col = find_country_column(lines, delimiter)
-            if country_col >= 0:
-                logger.info(f"通过逐行搜索确定国家列: 第 {country_col + 1} 列")
-            else:
-                logger.info(f"无法确定国家列，设为 -1")
+            skipped.append((r['ip'], r['port']))
+    return kept, skipped
 
-    ip_port_pattern = re.compile(
-        r'(((\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|\[(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}\]|(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}))[ :,\t](\d{1,5})'
-    )
+def drop_untested_nodes(skipped: Iterable[Tuple[str, int]]):
+    """从 ip.txt 中移除因测速上限而没有测速的节点
 
-    for i, line in enumerate(lines_to_process):
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
-        match = ip_port_pattern.match(line)
-        if match:
-            server = match.group(1).strip('[]')
-            port = match.group(4)
-            country = ''
-            if delimiter:
-                fields = line.split(delimiter)
-                if country_col != -1 and country_col < len(fields):
-                    country = standardize_country(fields[country_col].strip())
-                if not country:
-                    for col, field in enumerate(fields):
-                        field = field.strip()
-                        potential_country = standardize_country(field)
-                        if potential_country:
-                            country = potential_country
-                            break
-            if is_valid_port(port):
-                server_port_pairs.append((server, int(port), country))
-            else:
-                invalid_lines.append(f"第 {i} 行: {line} (端口无效)")
-            continue
-        if delimiter:
-            fields = line.split(delimiter)
-            if len(fields) < max(ip_col, port_col, country_col) + 1:
-                invalid_lines.append(f"第 {i} 行: {line} (字段太少)")
-                continue
-            server = fields[ip_col].strip('[]')
-            port_str = fields[port_col].strip()
-            country = ''
-            if country_col != -1 and country_col < len(fields):
-                country = standardize_country(fields[country_col].strip())
-            if not country:
-                for col, field in enumerate(fields):
-                    field = field.strip()
-                    potential_country = standardize_country(field)
-                    if potential_country:
-                        country = potential_country
-                        break
-            if is_valid_ip(server) and is_valid_port(port_str):
-                server_port_pairs.append((server, int(port_str), country))
-            else:
-                invalid_lines.append(f"第 {i} 行: {line} (IP 或端口无效)")
-        else:
-            invalid_lines.append(f"第 {i} 行: {line} (格式无效)")
-
-    if invalid_lines:
-        logger.info(f"发现 {len(invalid_lines)} 个无效条目")
-    logger.info(f"解析出 {len(server_port_pairs)} 个节点，其中 {sum(1 for _, _, c in server_port_pairs if c)} 个有国家信息")
-    unique_server_port_pairs = list(dict.fromkeys(server_port_pairs))
-    logger.info(f"去重后: {len(unique_server_port_pairs)} 个节点")
-    return unique_server_port_pairs
-
-def get_country_from_ip(ip: str, cache: Dict[str, str]) -> str:
-    if ip in cache:
-        return cache[ip]
-    try:
-        response = geoip_reader.country(ip)
-        country_code = response.country.iso_code or ''
-        if country_code:
-            cache[ip] = country_code
-            return country_code
-        return ''
-    except Exception:
-        return ''
-
-def get_countries_from_ips(ips: List[str], cache: Dict[str, str]) -> List[str]:
-    uncached_ips = [ip for ip in ips if ip not in cache]
-    if uncached_ips:
-        logger.info(f"批量查询 {len(uncached_ips)} 个 IP 的国家信息")
-        for ip in uncached_ips:
-            try:
-                response = geoip_reader.country(ip)
-                cache[ip] = response.country.iso_code or ''
-            except Exception:
-                cache[ip] = ''
-    return [cache[ip] for ip in ips]
+    测速流程结束后 ip.txt 只包含实际测速过（无论成功与否）的节点：测速历史据此记录失败，
+    各测速模式用 split_attempted 区分本轮已测速与需要沿用或重新排队的节点。
+    """
+    skipped = set(skipped)
+    if not skipped or not os.path.exists(IP_LIST_FILE):
+        return
+    nodes = [node for node in read_ip_list(IP_LIST_FILE) if node not in skipped]
+    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+        for ip, port in nodes:
+            f.write(f"{ip} {port}\n")
 
-def write_ip_list(ip_ports: List[Tuple[str, int, str]], is_github_actions: bool) -> str:
-    if not ip_ports:
-        logger.error(f"没有有效的节点来生成 {IP_LIST_FILE}")
-        return None
+def split_attempted(nodes: List[Tuple[str, int]]) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """测速流程结束后按 ip.txt 把 nodes 分为 (实际测速过的节点, 因测速上限被跳过的节点)"""
+    attempted = set(read_ip_list(IP_LIST_FILE)) if os.path.exists(IP_LIST_FILE) else set()
+    return [node for node in nodes if node in attempted], [node for node in nodes if node not in attempted]
+
+def select_funnel_candidates(probes: List[Dict], node_countries: Dict[Tuple[str, int], str],
+                             top_k: int, max_latency: float = 0) -> Tuple[List[Dict], List[Tuple[str, int]]]:
+    """漏斗筛选：按国家分组，每个国家保留延迟最低的 top_k 个可达节点（top_k <= 0 表示不限制）
 
+    返回 (保留的节点, 通过筛选但超出 top_k 而不测速的节点)；不可达或延迟超限的节点视为已测速失败。
+    """
+    by_country = defaultdict(list)
+    for r in probes:
+        if not r['received'] or r['loss'] > 0:
+            continue
+        if max_latency and r['median'] > max_latency:
+            continue
+        country = node_countries.get((r['ip'], r['port']), '')
+        if DESIRED_COUNTRIES and country not in DESIRED_COUNTRIES:
+            continue
+        by_country[country].append(r)
+    selected, skipped = [], []
+    for country, nodes in by_country.items():
+        nodes.sort(key=lambda r: (r['median'], r['jitter']))
+        kept, cut = cap_per_country(nodes, node_countries, top_k)
+        selected.extend(kept)
+        skipped.extend(cut)
+        logger.info(f"漏斗筛选 {country or 'UNKNOWN'}: 候选 {len(nodes)} 个，保留 {len(kept)} 个")
+    selected.sort(key=lambda r: r['median'])
+    return selected, skipped
+
+def run_funnel(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str], probes: List[Dict] = None) -> str:
+    """两阶段漏斗：先对全部候选做快速连接/TLS 握手筛选，只有每个国家延迟最好的 K 个节点进入下载测速
+
+    若传入 probes（流式管道已完成第一阶段），则直接进行筛选。
+    """
     start_time = time.time()
-    country_cache = load_country_cache()
-    filtered_ip_ports = set()
-    country_counts = defaultdict(int)
-    filtered_counts = defaultdict(int)
-    logger.info(f"开始处理 {len(ip_ports)} 个节点...")
-
-    from_source = sum(1 for _, _, country in ip_ports if country and country in COUNTRY_LABELS)
-    logger.info(f"数据源为 {from_source} 个节点提供了有效国家信息（包括城市映射）")
-
-    # 收集需要查询数据库的 IP（国家信息为空或无效）
-    ips_to_query = [ip for ip, _, country in ip_ports if not country or country not in COUNTRY_LABELS]
-    supplemented = 0
-    if ips_to_query:
-        logger.info(f"批量查询 {len(ips_to_query)} 个 IP 的国家信息（缺失或无效）")
-        countries = get_countries_from_ips(ips_to_query, country_cache)
-        ip_country_map = dict(zip(ips_to_query, countries))
-        supplemented = sum(1 for country in countries if country)
+    if probes is None:
+        try:
+            nodes = read_ip_list(IP_LIST_FILE)
+        except Exception as e:
+            logger.error(f"无法读取 {IP_LIST_FILE}: {e}")
+            return None
+        handshake_host = None
+        if args.funnel_handshake == "tls":
+            handshake_host, _ = native_probe.split_speedtest_url(args.speedtest_url)
+        logger.info(f"漏斗阶段 1: 对 {len(nodes)} 个节点进行{'TLS 握手' if handshake_host else 'TCP 连接'}筛选")
+        probes = native_probe.probe_latency(
+            nodes, concurrency=args.probe_concurrency, samples=args.probe_samples,
+            timeout=args.probe_timeout, handshake_host=handshake_host
+        )
     else:
-        ip_country_map = {}
-
-    for ip, port, country in ip_ports:
-        final_country = country
-        source = "数据源" if country and country in COUNTRY_LABELS else "待查询"
-        
-        if not country or country not in COUNTRY_LABELS:
-            final_country = ip_country_map.get(ip, '')
-            if final_country:
-                source = "GeoIP 数据库"
-        
-        if not DESIRED_COUNTRIES:
-            filtered_ip_ports.add((ip, port))
-            if final_country:
-                country_counts[final_country] += 1
-        elif final_country and final_country in DESIRED_COUNTRIES:
-            filtered_ip_ports.add((ip, port))
-            country_counts[final_country] += 1
-        else:
-            filtered_counts[final_country or 'UNKNOWN'] += 1
+        nodes = [(r['ip'], r['port']) for r in probes]
+    candidates = len(nodes)
+    reachable = sum(1 for r in probes if r['received'])
+    selected, skipped = select_funnel_candidates(probes, node_countries, args.funnel_top_k, args.funnel_max_latency)
+    logger.info(f"漏斗阶段 1 完成: {candidates} 个候选，{reachable} 个可达，保留 {len(selected)} 个 "
+                f"(每个国家前 {args.funnel_top_k} 个，耗时 {time.time() - start_time:.2f} 秒)")
+    if not selected:
+        logger.error("漏斗阶段 1 没有保留任何节点")
+        return None
 
-    total_retained = len(filtered_ip_ports)
-    total_filtered = sum(filtered_counts.values())
-    logger.info(f"过滤结果: 保留 {total_retained} 个节点，过滤掉 {total_filtered} 个节点")
-    logger.info(f"通过 GeoIP 数据库补充国家信息: {supplemented} 个节点")
-    logger.info(f"保留的国家分布: {dict(country_counts)}")
-    logger.info(f"过滤掉的国家分布: {dict(filtered_counts)}")
+    # 第二阶段只测试保留的节点；ip.txt 同时作为 iptest 的输入
+    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+        for r in selected:
+            f.write(f"{r['ip']} {r['port']}\n")
+    logger.info(f"漏斗阶段 2: 对 {len(selected)} 个节点进行下载测速 (引擎: {args.engine})")
+    if args.engine == "native":
+        csv_file = run_native_speed_test(args, node_countries, probes=selected)
+    else:
+        csv_file = run_speed_test()
+    if csv_file:
+        with open(csv_file, "r", encoding="utf-8-sig") as f:
+            kept = max(sum(1 for line in f if line.strip()) - 1, 0)
+        logger.info(f"漏斗阶段 2 完成: {len(selected)} 个节点测速，保留 {kept} 个 (总耗时 {time.time() - start_time:.2f} 秒)")
+    # 阶段 1 淘汰的节点也已测速（失败），恢复到 ip.txt；只移除超出 top_k 而没有下载测速的节点
+    skipped = set(skipped)
+    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+        for ip, port in nodes:
+            if (ip, port) not in skipped:
+                f.write(f"{ip} {port}\n")
+    return csv_file
+
+def run_probe_stage(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str],
+                    probes: List[Dict] = None) -> str:
+    """按命令行选项选择测速流程；probes 为流式管道已完成的延迟探测结果。结果同时写入测速历史"""
+    if args.funnel:
+        csv_file = run_funnel(args, node_countries, probes)
+    elif args.latency_only:
+        csv_file = run_latency_probe(args, node_countries, probes)
+    elif args.engine == "native":
+        csv_file = run_native_speed_test(args, node_countries, probes)
+    else:
+        csv_file = run_speed_test()
+    record_probe_history(args, node_countries, csv_file)
+    return csv_file
 
-    if not filtered_ip_ports:
-        logger.error(f"没有有效的节点来生成 {IP_LIST_FILE}")
+def parse_metric(value: str):
+    """解析 "123 ms" 或 "12.34" 形式的数值，无法解析时返回 None"""
+    try:
+        return float(value.replace("ms", "").strip())
+    except (AttributeError, ValueError):
         return None
 
-    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
-        for ip, port in filtered_ip_ports:
-            f.write(f"{ip} {port}\n")
-    logger.info(f"已生成 {IP_LIST_FILE}")
+def record_probe_history(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str], csv_file: str):
+    """把 ip.txt 中本次测速的每个节点写入测速历史：出现在结果 CSV 中记为成功，否则记为失败
 
-    logger.info(f"生成 {IP_LIST_FILE}，包含 {len(filtered_ip_ports)} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
-    save_country_cache(country_cache)
-    return IP_LIST_FILE
+    没有结果 CSV（测速流程本身失败）时不记录，避免拉低各节点的 EWMA 与成功率。
+    """
+    if not args.history_db:
+        return
+    if not csv_file or not os.path.exists(csv_file):
+        logger.warning("测速流程没有产出结果，本次不写入测速历史")
+        return
+    try:
+        tested = read_ip_list(IP_LIST_FILE) if os.path.exists(IP_LIST_FILE) else []
+        _, results = read_result_rows(csv_file)
+        samples = []
+        for key in dict.fromkeys(tested + list(results)):
+            row = results.get(key)
+            sample = {'ip': key[0], 'port': key[1], 'ok': row is not None, 'country': node_countries.get(key, '')}
+            if row is not None:
+                cell = lambda i: row[i].strip() if len(row) > i else ''  # noqa: E731
+                sample.update(latency=parse_metric(cell(8)), speed=parse_metric(cell(9)), colo=cell(3),
+                              country=sample['country'] or cell(5).upper())
+            samples.append(sample)
+        count = node_history.record_samples(args.history_db, samples, retention_days=args.history_retention_days)
+        if count:
+            logger.info(f"测速历史已记录 {count} 个节点 ({sum(1 for s in samples if s['ok'])} 个成功) 到 {args.history_db}")
+    except Exception as e:
+        logger.warning(f"无法写入测速历史 {args.history_db}: {e}")
 
 def run_speed_test() -> str:
     if not SPEEDTEST_SCRIPT:
@@ -1347,60 +1028,15 @@ def filter_speed_and_deduplicate(csv_file: str, is_github_actions: bool):
     except Exception as e:
         logger.warning(f"排序失败: {e}")
 
-    with open(csv_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        writer.writerows(final_rows)
+    write_csv_atomic(csv_file, header, final_rows)
     logger.info(f"已生成 {csv_file}")
 
     logger.info(f"{csv_file} 处理完成，{len(final_rows)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
     return len(final_rows)
 
-def generate_ips_file(csv_file: str, is_github_actions: bool):
-    start_time = time.time()
-    if not os.path.exists(csv_file):
-        logger.info(f"{csv_file} 不存在")
-        return
-    country_cache = load_country_cache()
-    final_nodes = []
-    try:
-        with open(csv_file, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            next(reader)
-            for row in reader:
-                if len(row) < 2:
-                    continue
-                ip, port = row[0], row[1]
-                if not is_valid_ip(ip) or not is_valid_port(port):
-                    continue
-                country = country_cache.get(ip, '')
-                if not country:
-                    country = get_country_from_ip(ip, country_cache)
-                if DESIRED_COUNTRIES and country and country in DESIRED_COUNTRIES:
-                    final_nodes.append((ip, int(port), country))
-    except Exception as e:
-        logger.error(f"无法读取 {csv_file}: {e}")
-        return
-    if not final_nodes:
-        logger.info(f"没有符合条件的节点（DESIRED_COUNTRIES: {DESIRED_COUNTRIES}）")
-        return
-    country_count = defaultdict(int)
-    labeled_nodes = []
-    for ip, port, country in sorted(final_nodes, key=lambda x: x[2] or 'ZZ'):
-        country_count[country] += 1
-        emoji, name = COUNTRY_LABELS.get(country, ('🌐', '未知'))
-        label = f"{emoji} {name}-{country_count[country]}"
-        labeled_nodes.append((ip, port, label))
-
-    with open(IPS_FILE, "w", encoding="utf-8-sig") as f:
-        for ip, port, label in labeled_nodes:
-            f.write(f"{ip}:{port}#{label}\n")
-    logger.info(f"已生成 {IPS_FILE}")
-
-    logger.info(f"生成 {IPS_FILE}，{len(labeled_nodes)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
-    logger.info(f"国家分布: {dict(country_count)}")
-    save_country_cache(country_cache)
-    return len(labeled_nodes)
+def generate_ips_file(csv_file: str, is_github_actions: bool, node_countries: Dict[Tuple[str, int], str] = None):
+    """生成 ips.txt；国家依次取 node_countries、ip.csv 的国际代码列，都没有时才查询 GeoIP"""
+    return get_pipeline().write_ips_file(csv_file, IPS_FILE, node_countries)
 
 def validate_username(username: str) -> bool:
     """验证 Git 用户名格式"""
@@ -1799,7 +1435,333 @@ def commit_and_push(is_github_actions: bool = False, no_push: bool = False):
         logger.error(f"提交和推送过程中发生未知错误: {e}")
         sys.exit(1)
 
+def collect_input_nodes(args: argparse.Namespace) -> List[Tuple[str, int, str]]:
+    """优先读取本地 input.csv，不存在时拉取所有在线来源，返回去重后的节点"""
+    if os.path.exists(args.input_file):
+        ip_ports = extract_ip_ports_from_file(args.input_file)
+        if ip_ports:
+            logger.info(f"从本地文件 {args.input_file} 提取到 {len(ip_ports)} 个节点")
+        else:
+            logger.warning(f"本地文件 {args.input_file} 无有效节点")
+    else:
+        logger.info(f"本地文件 {args.input_file} 不存在，尝试从 URL 和网页获取")
+        ip_ports = fetch_all_sources(args)
+        if ip_ports:
+            logger.info(f"从所有在线来源共提取到 {len(ip_ports)} 个节点")
+        else:
+            logger.warning(f"无法从 INPUT_URLS {args.url} 或 WEB_URLS {WEB_URLS} 获取有效节点")
+
+    # 去重
+    ip_ports = list(dict.fromkeys(ip_ports))
+    logger.info(f"去重后总计 {len(ip_ports)} 个节点")
+    return ip_ports
+
+def read_result_rows(csv_file: str) -> Tuple[List[str], Dict[Tuple[str, int], List[str]]]:
+    """读取测速结果 CSV，返回 (表头, {(ip, port): 行})；文件不存在时返回空结果"""
+    header, rows = [], {}
+    if not csv_file or not os.path.exists(csv_file):
+        return header, rows
+    with open(csv_file, "r", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or []
+        for row in reader:
+            if len(row) >= 2 and is_valid_port(row[1]):
+                rows.setdefault((row[0], int(row[1])), row)
+    return header, rows
+
+def write_csv_atomic(csv_file: str, header: List[str], rows: Iterable[List[str]]):
+    temp_file = f"{csv_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(temp_file, csv_file)
+
+def result_speed(row: List[str]):
+    """ip.csv 行中的下载速度 (MB/s)，没有或无法解析时返回 None"""
+    return parse_metric(row[9]) if row and len(row) > 9 else None
+
+def load_node_states(args: argparse.Namespace, candidates: List[Tuple[str, int]],
+                     seeds: Dict[Tuple[str, int], Tuple[float, float]]) -> Dict[Tuple[str, int], Dict]:
+    """候选节点的历史状态：测速历史汇总优先，没有历史的节点以 seeds {(ip, port): (速度, 测速时间)} 为种子"""
+    states = retest_scheduler.seed_states(seeds)
+    if args.history_db and os.path.exists(args.history_db):
+        try:
+            states.update(node_history.node_summaries(args.history_db, candidates))
+        except Exception as e:
+            logger.warning(f"无法读取测速历史 {args.history_db}，仅使用上一次的测速结果: {e}")
+    return states
+
+def run_adaptive_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str]) -> str:
+    """自适应复测：只测速调度器选出的节点，其余候选沿用上一次 ip.csv 中的结果，合并后写回 ip.csv
+
+    每个节点的测速时间记录在 --probe-cache 中：ip.csv 每轮都会整体重写，其修改时间不能代表沿用行的测速时间。
+    缓存中没有记录的行不作为种子，按新节点优先复测。
+    """
+    candidates = read_ip_list(IP_LIST_FILE)
+    previous_header, previous = read_result_rows(FINAL_CSV)
+    _, tested = load_probe_cache(args.probe_cache)
+    states = load_node_states(args, candidates, {
+        key: (result_speed(entry['row']), entry['tested_at']) for key, entry in tested.items() if key in previous})
+    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 8.0
+    now = time.time()
+    probe, reuse = retest_scheduler.plan_retests(
+        candidates, states, speed_limit, now, budget=args.probe_budget,
+        min_interval=args.retest_min_interval, max_interval=args.retest_max_interval)
+
+    header, probed = [], {}
+    if probe:
+        with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+            for ip, port in probe:
+                f.write(f"{ip} {port}\n")
+        csv_file = run_probe_stage(args, node_countries)
+        if csv_file:
+            header, probed = read_result_rows(csv_file)
+            # 只有本轮实际测速的节点记录本轮时间；超出测速上限而没有测速的节点沿用上次结果
+            attempted, skipped = split_attempted(probe)
+            for key in attempted:
+                tested[key] = {'row': probed.get(key), 'tested_at': now}
+            reuse.extend(skipped)
+        else:
+            reuse.extend(probe)
+    current = set(candidates)
+    for key in [key for key, entry in tested.items()
+                if key not in current and now - entry['tested_at'] >= args.retest_max_interval]:
+        del tested[key]
+    save_probe_cache(args.probe_cache, header or previous_header, tested)
+    reused = [previous[key] for key in reuse if key in previous and key not in probed]
+    rows = list(probed.values()) + reused
+    if not rows:
+        return None
+    write_csv_atomic(FINAL_CSV, header or previous_header or native_probe.CSV_HEADER, rows)
+    logger.info(f"{FINAL_CSV} 合并 {len(probed)} 个本轮测速结果与 {len(reused)} 个沿用的结果")
+    return FINAL_CSV
+
+def run_quota_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str]) -> str:
+    """配额模式：按预期质量分波测速，每个国家通过测速的节点达到 --quota 个后停止测速该国家，
+    每个国家保留速度最快的 --quota 个节点写入 ip.csv"""
+    start_time = time.time()
+    candidates = read_ip_list(IP_LIST_FILE)
+    _, previous = read_result_rows(FINAL_CSV)
+    speed_limit = parse_speedlimit_from_script(SPEEDTEST_SCRIPT) if SPEEDTEST_SCRIPT else 8.0
+    seeds = {key: (result_speed(row), 0.0) for key, row in previous.items()}
+    queues = probe_quota.build_queues(candidates, node_countries, load_node_states(args, candidates, seeds),
+                                      speed_limit, DESIRED_COUNTRIES)
+    total = sum(len(nodes) for nodes in queues.values())
+    passed: Dict[str, int] = defaultdict(int)
+    by_country: Dict[str, List[List[str]]] = defaultdict(list)
+    header, tested, wave_no = [], 0, 0
+    while True:
+        wave = probe_quota.next_wave(queues, passed, args.quota, args.quota_wave_factor)
+        if not wave:
+            break
+        wave_no += 1
+        with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+            for ip, port in wave:
+                f.write(f"{ip} {port}\n")
+        wave_header, probed = read_result_rows(run_probe_stage(args, node_countries))
+        header = wave_header or header
+        # 超出测速上限而没有测速的节点放回队列，留给下一波
+        attempted, skipped = split_attempted(wave)
+        tested += len(attempted)
+        probe_quota.requeue(queues, skipped, node_countries)
+        for key, row in probed.items():
+            country = node_countries.get(key) or (row[5].strip().upper() if len(row) > 5 else '')
+            by_country[country].append(row)
+            # iptest（非 Termux）与 --latency-only 会写出未达到速度下限的行，这些节点不计入配额
+            speed = result_speed(row)
+            if speed is not None and speed >= speed_limit:
+                passed[country] += 1
+        probe_quota.log_progress(wave_no, attempted, queues, passed, args.quota)
+        if not attempted:
+            logger.warning(f"配额测速第 {wave_no} 波没有节点实际测速，停止分波")
+            break
+
+    rows = []
+    for country, country_rows in by_country.items():
+        country_rows.sort(key=lambda row: result_speed(row) or 0.0, reverse=True)
+        rows.extend(country_rows[:args.quota])
+    logger.info(f"配额测速完成: {wave_no} 波共测速 {tested}/{total} 个候选 (跳过 {total - tested} 个)，"
+                f"保留 {len(rows)} 个节点，耗时 {time.time() - start_time:.2f} 秒")
+    if not rows:
+        return None
+    write_csv_atomic(FINAL_CSV, header or native_probe.CSV_HEADER, rows)
+    return FINAL_CSV
+
+def probe_node_list(args: argparse.Namespace, nodes: List[Tuple[str, int]],
+                    node_countries: Dict[Tuple[str, int], str]) -> Tuple[List[str], Dict[Tuple[str, int], List[str]]]:
+    """把 nodes 写入 ip.txt 并运行测速流程，返回 (表头, {(ip, port): 通过测速的行})"""
+    with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+        for ip, port in nodes:
+            f.write(f"{ip} {port}\n")
+    return read_result_rows(run_probe_stage(args, node_countries))
+
+def run_subnet_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str]) -> str:
+    """网段抽样模式：先测每个网段的代表节点，再只对代表通过的网段测速其余节点，两次结果合并写入 ip.csv"""
+    groups = subnet_sampling.group_by_prefix(read_ip_list(IP_LIST_FILE), args.subnet_prefix_v4, args.subnet_prefix_v6)
+    representatives, remaining = subnet_sampling.split_representatives(groups, args.subnet_representatives)
+    logger.info(f"网段抽样代表阶段: 测速 {len(representatives)} 个节点")
+    # 代表阶段不受每个国家 --funnel-top-k 的下载测速上限限制，否则超出上限的代表所在网段会被误判为不可用
+    representative_args = argparse.Namespace(**dict(vars(args), funnel_top_k=0))
+    header, rows = probe_node_list(representative_args, representatives, node_countries) if representatives else ([], {})
+    # 只根据实际测速过的代表判断网段；代表都没有测速的网段无法判断，整段进入扩展阶段
+    attempted, untested = split_attempted(representatives)
+    live = subnet_sampling.live_prefixes(groups, rows)
+    undecided = subnet_sampling.live_prefixes(groups, untested) - live
+    if undecided:
+        logger.warning(f"网段抽样: {len(untested)} 个代表没有测速，{len(undecided)} 个网段无法判断，全部进入扩展阶段")
+        for prefix in undecided:
+            remaining[prefix] = [node for node in groups[prefix] if node not in attempted]
+        live |= undecided
+    expanded = [node for prefix in live for node in remaining[prefix]]
+    if expanded:
+        logger.info(f"网段抽样扩展阶段: 测速 {len(live)} 个网段中的其余 {len(expanded)} 个节点")
+        expanded_header, probed = probe_node_list(args, expanded, node_countries)
+        header = expanded_header or header
+        rows.update(probed)
+    subnet_sampling.log_report(groups, remaining, live, len(representatives), len(expanded))
+    if not rows:
+        return None
+    write_csv_atomic(FINAL_CSV, header or native_probe.CSV_HEADER, list(rows.values()))
+    return FINAL_CSV
+
+def probe_expired_nodes(args: argparse.Namespace, candidates: List[Tuple[str, int]],
+                        tested: Dict[Tuple[str, int], Dict], max_age: float,
+                        node_countries: Dict[Tuple[str, int], str], header: List[str]) -> Tuple[List[str], List[List[str]]]:
+    """只测新增或结果超过 max_age 秒的候选节点，更新 tested 并返回 (表头, 当前候选中通过测速的行)
+
+    tested 为 {(ip, port): {'row': ip.csv 中的行（未通过测速为 None）, 'tested_at': 时间戳}}；
+    已不在候选中且已过期的记录被删除。测速流程没有产出结果 CSV 时不更新 tested，只返回仍在有效期内的行。
+    """
+    now = time.time()
+    current = set(candidates)
+    for key in [key for key, entry in tested.items()
+                if key not in current and now - entry['tested_at'] >= max_age]:
+        del tested[key]
+    due = [key for key in candidates
+           if key not in tested or now - tested[key]['tested_at'] >= max_age]
+    logger.info(f"本轮 {len(candidates)} 个候选节点：{len(due)} 个新增或过期需要测速，"
+                f"{len(candidates) - len(due)} 个沿用上次结果")
+
+    if due:
+        with open(IP_LIST_FILE, "w", encoding="utf-8") as f:
+            for ip, port in due:
+                f.write(f"{ip} {port}\n")
+        csv_file = run_probe_stage(args, node_countries)
+        if csv_file:
+            probed_header, probed = read_result_rows(csv_file)
+            header = probed_header or header
+            # 超出测速上限而没有测速的节点留到下一轮
+            for key in split_attempted(due)[0]:
+                tested[key] = {'row': probed.get(key), 'tested_at': now}
+        else:
+            # 测速流程本身失败（如 iptest 异常退出），不能当作这些节点测速失败记入缓存
+            logger.error(f"测速流程没有产出结果，{len(due)} 个节点下一轮重新测速")
+    rows = []
+    for key in dict.fromkeys(candidates):
+        entry = tested.get(key)
+        if entry and entry['row'] and now - entry['tested_at'] < max_age:
+            rows.append(entry['row'])
+    return header, rows
+
+def run_refresh_cycle(args: argparse.Namespace, is_github_actions: bool,
+                      tested: Dict[Tuple[str, int], Dict], header: List[str]) -> List[str]:
+    """守护模式的一轮刷新：只测新增或结果过期的节点，与其余节点的上次结果合并后原子地重写 ip.csv 与 ips.txt
+
+    tested 在各轮之间保留（见 probe_expired_nodes）；返回 ip.csv 表头供下一轮使用。
+    """
+    ip_ports = collect_input_nodes(args)
+    if not ip_ports:
+        logger.error("没有有效的 IP 和端口数据")
+        return header
+    node_countries = {}
+    candidates = get_pipeline().select(ip_ports, node_countries)
+    header, rows = probe_expired_nodes(args, candidates, tested, args.daemon_max_age, node_countries, header)
+    if not rows:
+        logger.error("没有通过测速的节点，保留现有输出文件")
+        return header
+    write_csv_atomic(FINAL_CSV, header or native_probe.CSV_HEADER, rows)
+    if filter_speed_and_deduplicate(FINAL_CSV, is_github_actions=is_github_actions):
+        generate_ips_file(FINAL_CSV, is_github_actions=is_github_actions, node_countries=node_countries)
+        commit_and_push(is_github_actions=is_github_actions, no_push=args.no_push)
+    return header
+
+def load_probe_cache(path: str) -> Tuple[List[str], Dict[Tuple[str, int], Dict]]:
+    """读取增量与自适应模式的测速结果缓存，返回 (表头, tested)；缓存不存在时以上一次 ip.csv 为种子（测速时间取文件修改时间）"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        tested = {}
+        for key, entry in data.get("nodes", {}).items():
+            ip, _, port = key.rpartition(" ")
+            tested[(ip, int(port))] = {'row': entry.get('row'), 'tested_at': float(entry['tested_at'])}
+        return data.get("header") or [], tested
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        logger.warning(f"测速结果缓存 {path} 无效，将重新建立: {e}")
+    header, previous = read_result_rows(FINAL_CSV)
+    tested_at = os.path.getmtime(FINAL_CSV) if previous else 0
+    return header, {key: {'row': row, 'tested_at': tested_at} for key, row in previous.items()}
+
+def save_probe_cache(path: str, header: List[str], tested: Dict[Tuple[str, int], Dict]):
+    nodes = {f"{ip} {port}": entry for (ip, port), entry in tested.items()}
+    try:
+        pipeline.write_text_atomic(path, json.dumps({"header": header, "nodes": nodes}, ensure_ascii=False))
+    except OSError as e:
+        logger.warning(f"无法保存测速结果缓存 {path}: {e}")
+
+def run_incremental_probe(args: argparse.Namespace, node_countries: Dict[Tuple[str, int], str]) -> str:
+    """增量模式：ip.txt 中的候选与测速结果缓存比对，只测新增或超过 --incremental-ttl 的节点，
+    与仍有效的缓存结果合并写入 ip.csv"""
+    header, tested = load_probe_cache(args.probe_cache)
+    candidates = read_ip_list(IP_LIST_FILE)
+    header, rows = probe_expired_nodes(args, candidates, tested, args.incremental_ttl, node_countries, header)
+    save_probe_cache(args.probe_cache, header, tested)
+    if not rows:
+        return None
+    write_csv_atomic(FINAL_CSV, header or native_probe.CSV_HEADER, rows)
+    return FINAL_CSV
+
+def run_daemon(args: argparse.Namespace, is_github_actions: bool):
+    """守护模式：GeoIP reader、HTTP 连接池、网段缓存、来源解析结果与测速结果常驻内存，
+    每隔 --daemon-interval 秒刷新一次；收到 SIGTERM 或 Ctrl-C 后在当前一轮结束时退出"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    if args.stream:
+        logger.warning("守护模式不使用流式管道，--stream 将被忽略")
+    tested: Dict[Tuple[str, int], Dict] = {}
+    header: List[str] = []
+    cycle = 0
+    try:
+        while not stop.is_set():
+            cycle += 1
+            start_time = time.time()
+            logger.info(f"守护模式第 {cycle} 轮刷新开始")
+            try:
+                header = run_refresh_cycle(args, is_github_actions, tested, header)
+            except SystemExit as e:
+                logger.error(f"第 {cycle} 轮刷新中止 (退出码 {e.code})")
+            except Exception as e:
+                logger.exception(f"第 {cycle} 轮刷新失败: {e}")
+            logger.info(f"第 {cycle} 轮刷新结束，耗时 {time.time() - start_time:.2f} 秒，"
+                        f"{args.daemon_interval} 秒后开始下一轮")
+            stop.wait(args.daemon_interval)
+    except KeyboardInterrupt:
+        pass
+    logger.info("守护模式退出")
+
+def close_pipeline():
+    if PIPELINE is not None:
+        PIPELINE.close()
+
 def main():
+    global SPEEDTEST_SCRIPT
+    setup_logging()
+    SPEEDTEST_SCRIPT = find_speedtest_script()
+    atexit.register(close_geoip_reader)
+    atexit.register(close_pipeline)
+
     parser = argparse.ArgumentParser(description="IP 测试和筛选脚本")
     parser.add_argument("--input-file", type=str, default=INPUT_FILE, help=f"输入 CSV 文件路径 (默认: {INPUT_FILE})")
     parser.add_argument(
@@ -1812,7 +1774,110 @@ def main():
     parser.add_argument("--offline", action="store_true", help="离线模式，不下载 GeoIP 数据库")
     parser.add_argument("--update-geoip", action="store_true", help="强制更新 GeoIP 数据库")
     parser.add_argument("--no-push", action="store_true", help="禁用 Git 提交和推送")
+    parser.add_argument("--engine", choices=["iptest", "native"], default="iptest",
+                        help="测速后端：iptest 调用外部二进制，native 使用内置 Python 引擎 (默认: iptest)")
+    parser.add_argument("--speedtest-url", type=str, default=native_probe.SPEEDTEST_URL,
+                        help=f"内置引擎的测速文件地址 (默认: {native_probe.SPEEDTEST_URL})")
+    parser.add_argument("--speedtest-concurrency", type=int, default=native_probe.SPEEDTEST_CONCURRENCY,
+                        help=f"内置引擎同时进行的下载测速数 (默认: {native_probe.SPEEDTEST_CONCURRENCY})")
+    parser.add_argument("--funnel", action="store_true", help="两阶段漏斗：先快速筛选全部节点，只对每个国家延迟最好的 K 个节点下载测速")
+    parser.add_argument("--funnel-top-k", type=int, default=FUNNEL_TOP_K,
+                        help=f"漏斗模式与内置引擎下每个国家进入下载测速的节点数，0 表示不限制 (默认: {FUNNEL_TOP_K})")
+    parser.add_argument("--funnel-max-latency", type=float, default=0,
+                        help="漏斗模式第一阶段的延迟上限 (毫秒)，0 表示不限制")
+    parser.add_argument("--funnel-handshake", choices=["tcp", "tls"], default="tls",
+                        help="漏斗模式第一阶段的筛选方式：tcp 仅建立连接，tls 额外完成 TLS 握手 (默认: tls)")
+    parser.add_argument("--stream", action="store_true", help="流式管道：每个来源一完成解析就进行国家过滤并送入延迟探测器")
+    parser.add_argument("--stream-queue-size", type=int, default=native_probe.STREAM_QUEUE_SIZE,
+                        help=f"流式管道中等待探测的最大节点数 (默认: {native_probe.STREAM_QUEUE_SIZE})")
+    parser.add_argument("--max-fetch-concurrency", type=int, default=http_client.MAX_CONCURRENCY,
+                        help=f"所有来源下载的全局并发上限 (默认: {http_client.MAX_CONCURRENCY})")
+    parser.add_argument("--per-host-concurrency", type=int, default=http_client.PER_HOST_CONCURRENCY,
+                        help=f"同一主机的并发请求上限 (默认: {http_client.PER_HOST_CONCURRENCY})")
+    parser.add_argument("--no-source-cache", action="store_true",
+                        help=f"禁用条件请求源缓存与表结构缓存 ({http_client.SOURCE_CACHE_DIR})，每次完整下载并重新推断所有来源")
+    parser.add_argument("--keep-sources", action="store_true",
+                        help=f"将下载的来源原文保存到 {KEEP_SOURCES_DIR}/ 目录以便排查（默认只在内存中解析）")
+    parser.add_argument("--latency-only", action="store_true", help="仅使用内置探测器测量 TCP 连接延迟，不调用 iptest 下载测速")
+    parser.add_argument("--probe-concurrency", type=int, default=native_probe.PROBE_CONCURRENCY,
+                        help=f"延迟探测的最大并发连接数 (默认: {native_probe.PROBE_CONCURRENCY})")
+    parser.add_argument("--probe-samples", type=int, default=native_probe.PROBE_SAMPLES,
+                        help=f"每个节点的延迟采样次数 (默认: {native_probe.PROBE_SAMPLES})")
+    parser.add_argument("--probe-timeout", type=float, default=native_probe.PROBE_TIMEOUT,
+                        help=f"单次连接超时秒数 (默认: {native_probe.PROBE_TIMEOUT})")
+    parser.add_argument("--daemon", action="store_true",
+                        help="守护模式：常驻内存并定期刷新，只重新解析内容变化的来源、只测新增或过期的节点")
+    parser.add_argument("--daemon-interval", type=float, default=DAEMON_INTERVAL,
+                        help=f"守护模式两轮刷新之间的间隔秒数 (默认: {DAEMON_INTERVAL})")
+    parser.add_argument("--daemon-max-age", type=float, default=DAEMON_MAX_AGE,
+                        help=f"守护模式中节点测速结果的有效期秒数，过期后重新测速 (默认: {DAEMON_MAX_AGE})")
+    parser.add_argument("--history-db", type=str, default=HISTORY_DB,
+                        help=f"测速历史 SQLite 数据库路径，空字符串表示不记录 (默认: {HISTORY_DB})")
+    parser.add_argument("--history-retention-days", type=float, default=node_history.RETENTION_DAYS,
+                        help=f"测速历史样本的保留天数 (默认: {node_history.RETENTION_DAYS})")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="自适应复测：根据测速历史与上一次 ip.csv 为每个节点安排复测间隔，只测新节点与到期节点")
+    parser.add_argument("--probe-budget", type=int, default=0,
+                        help="自适应复测时每轮最多测速的节点数，优先测排名最不确定的节点，0 表示不限制 (默认: 0)")
+    parser.add_argument("--retest-min-interval", type=float, default=retest_scheduler.MIN_INTERVAL,
+                        help=f"自适应复测的最短复测间隔秒数 (默认: {retest_scheduler.MIN_INTERVAL})")
+    parser.add_argument("--retest-max-interval", type=float, default=retest_scheduler.MAX_INTERVAL,
+                        help=f"自适应复测的最长复测间隔秒数 (默认: {retest_scheduler.MAX_INTERVAL})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="增量模式：只测新增或缓存结果已过期的候选节点，与仍有效的缓存结果合并")
+    parser.add_argument("--incremental-ttl", type=float, default=INCREMENTAL_TTL,
+                        help=f"增量模式中测速结果的有效期秒数 (默认: {INCREMENTAL_TTL})")
+    parser.add_argument("--probe-cache", type=str, default=PROBE_CACHE_FILE,
+                        help=f"增量与自适应模式的测速结果缓存文件，记录每个节点的测速时间 (默认: {PROBE_CACHE_FILE})")
+    parser.add_argument("--quota", type=int, default=0,
+                        help="配额模式：每个国家只测到通过速度下限的节点达到该数量为止，0 表示不启用 (默认: 0)")
+    parser.add_argument("--quota-wave-factor", type=float, default=probe_quota.WAVE_FACTOR,
+                        help=f"配额模式每一波为每个国家测速 剩余配额×该系数 个节点 (默认: {probe_quota.WAVE_FACTOR})")
+    parser.add_argument("--sample-subnets", action="store_true",
+                        help="网段抽样：每个网段先测少数代表节点，只有代表通过测速的网段才测其余节点")
+    parser.add_argument("--subnet-representatives", type=int, default=subnet_sampling.REPRESENTATIVES,
+                        help=f"网段抽样中每个网段的代表节点数 (默认: {subnet_sampling.REPRESENTATIVES})")
+    parser.add_argument("--subnet-prefix-v4", type=int, default=subnet_sampling.IPV4_PREFIX,
+                        help=f"网段抽样的 IPv4 前缀长度 (默认: {subnet_sampling.IPV4_PREFIX})")
+    parser.add_argument("--subnet-prefix-v6", type=int, default=subnet_sampling.IPV6_PREFIX,
+                        help=f"网段抽样的 IPv6 前缀长度 (默认: {subnet_sampling.IPV6_PREFIX})")
+    parser.add_argument("--serve", action="store_true",
+                        help=f"启动内置 HTTP API，从内存索引提供 {FINAL_CSV} 的过滤结果；与 --daemon 同用时在后台线程运行")
+    parser.add_argument("--serve-host", type=str, default=api_server.SERVE_HOST,
+                        help=f"HTTP API 监听地址 (默认: {api_server.SERVE_HOST})")
+    parser.add_argument("--serve-port", type=int, default=api_server.SERVE_PORT,
+                        help=f"HTTP API 监听端口 (默认: {api_server.SERVE_PORT})")
+    parser.add_argument("--startup-report", action="store_true", help="输出虚拟环境、GeoIP 与 Git 配置等启动步骤的耗时")
+    parser.add_argument("--geoip-warmup", action="store_true",
+                        help="在下载来源的同时于后台打开 GeoIP 数据库（默认在首次需要查询时才打开）")
+    parser.add_argument("--geoip-workers", type=int, default=geo_enrich.PARALLEL_WORKERS,
+                        help=f"GeoIP 补全的并行进程数，1 表示只在本进程查询 (默认: {geo_enrich.PARALLEL_WORKERS})")
+    parser.add_argument("--geoip-parallel-threshold", type=int, default=geo_enrich.PARALLEL_THRESHOLD,
+                        help=f"未命中缓存的 IP 达到该数量才启用多进程查询 (默认: {geo_enrich.PARALLEL_THRESHOLD})")
     args = parser.parse_args()
+    if sum(map(bool, (args.adaptive, args.incremental, args.quota, args.sample_subnets))) > 1:
+        parser.error("--adaptive、--incremental、--quota 与 --sample-subnets 只能选择一个")
+    if args.stream and (args.adaptive or args.incremental or args.quota or args.sample_subnets):
+        # 流式管道直接把探测结果交给测速，不经过这些模式的候选筛选，组合使用时模式会被静默忽略
+        parser.error("--stream 不能与 --adaptive、--incremental、--quota 或 --sample-subnets 同时使用")
+    if args.daemon and (args.adaptive or args.incremental or args.quota or args.sample_subnets):
+        # 守护模式每轮固定按测速结果的有效期增量刷新，不使用这些模式的候选筛选
+        parser.error("--daemon 不能与 --adaptive、--incremental、--quota 或 --sample-subnets 同时使用")
+
+    geo_enrich.configure_parallel(workers=args.geoip_workers, threshold=args.geoip_parallel_threshold)
+    http_client.configure(max_concurrency=args.max_fetch_concurrency, per_host=args.per_host_concurrency,
+                          source_cache_dir='' if args.no_source_cache else None)
+    source_parser.configure_schema_cache(
+        '' if args.no_source_cache else os.path.join(http_client.SOURCE_CACHE_DIR, source_parser.SCHEMA_CACHE_NAME))
+
+    if args.serve and not args.daemon:
+        # 仅提供已有结果，不需要虚拟环境、GeoIP 与 Git
+        api_server.serve(FINAL_CSV, host=args.serve_host, port=args.serve_port)
+        return
+
+    if args.engine == "iptest" and not args.latency_only and not SPEEDTEST_SCRIPT:
+        logger.error("未找到测速脚本，请确保 iptest.sh 或 iptest.bat 存在，或使用 --engine=native")
+        sys.exit(1)
 
     is_github_actions = os.getenv("GITHUB_ACTIONS") == "true"
     logger.info(f"运行环境: {'GitHub Actions' if is_github_actions else '本地'}, 离线模式: {args.offline}, 更新 GeoIP: {args.update_geoip}")
@@ -1821,45 +1886,55 @@ def main():
     setup_and_activate_venv()
 
     # 检查依赖
-    check_dependencies(offline=args.offline, update_geoip=args.update_geoip)
+    with startup_step("GeoIP 初始化"):
+        check_dependencies(offline=args.offline, update_geoip=args.update_geoip, warmup=args.geoip_warmup)
 
     # 设置 Git 配置
-    setup_git_config(is_github_actions=is_github_actions)
-
-    # 处理输入
-    ip_ports = []
+    with startup_step("Git 配置"):
+        setup_git_config(is_github_actions=is_github_actions)
+    if args.startup_report:
+        log_startup_report()
+
+    if args.daemon:
+        if args.serve:
+            api_server.start_in_thread(FINAL_CSV, host=args.serve_host, port=args.serve_port)
+        run_daemon(args, is_github_actions)
+        return
 
-    # 1. 从本地 input.csv 获取节点
-    if os.path.exists(args.input_file):
-        ip_ports = extract_ip_ports_from_file(args.input_file)
-        if ip_ports:
-            logger.info(f"从本地文件 {args.input_file} 提取到 {len(ip_ports)} 个节点")
-        else:
-            logger.warning(f"本地文件 {args.input_file} 无有效节点")
+    node_countries = {}
+    if args.stream and not os.path.exists(args.input_file):
+        # 流式模式：来源一到即解析、补全国家并送入探测器
+        logger.info("流式模式：来源拉取、国家过滤与延迟探测并行进行")
+        probes = run_streaming_probe(args, node_countries)
+        if not probes:
+            logger.error("流式管道没有产出可达节点")
+            sys.exit(1)
+        csv_file = run_probe_stage(args, node_countries, probes)
     else:
-        logger.info(f"本地文件 {args.input_file} 不存在，尝试从 URL 和网页获取")
-        ip_ports = fetch_all_sources(args)
-        if ip_ports:
-            logger.info(f"从所有在线来源共提取到 {len(ip_ports)} 个节点")
-        else:
-            logger.warning(f"无法从 INPUT_URLS {args.url} 或 WEB_URLS {WEB_URLS} 获取有效节点")
+        # 处理输入
+        ip_ports = collect_input_nodes(args)
 
-    # 去重
-    ip_ports = list(dict.fromkeys(ip_ports))
-    logger.info(f"去重后总计 {len(ip_ports)} 个节点")
-
-    if not ip_ports:
-        logger.error("没有有效的 IP 和端口数据")
-        sys.exit(1)
+        if not ip_ports:
+            logger.error("没有有效的 IP 和端口数据")
+            sys.exit(1)
 
-    # 写入 IP 列表
-    ip_list_file = write_ip_list(ip_ports, is_github_actions=is_github_actions)
-    if not ip_list_file:
-        logger.error("无法生成 IP 列表")
-        sys.exit(1)
+        # 写入 IP 列表
+        ip_list_file = write_ip_list(ip_ports, is_github_actions=is_github_actions, node_countries=node_countries)
+        if not ip_list_file:
+            logger.error("无法生成 IP 列表")
+            sys.exit(1)
 
-    # 运行测速
-    csv_file = run_speed_test()
+        # 运行测速
+        if args.adaptive:
+            csv_file = run_adaptive_probe(args, node_countries)
+        elif args.incremental:
+            csv_file = run_incremental_probe(args, node_countries)
+        elif args.quota:
+            csv_file = run_quota_probe(args, node_countries)
+        elif args.sample_subnets:
+            csv_file = run_subnet_probe(args, node_countries)
+        else:
+            csv_file = run_probe_stage(args, node_countries)
     if not csv_file:
         logger.error("测速失败")
         sys.exit(1)
@@ -1871,7 +1946,7 @@ def main():
         sys.exit(1)
 
     # 生成最终 IPs 文件
-    final_node_count = generate_ips_file(csv_file, is_github_actions=is_github_actions)
+    final_node_count = generate_ips_file(csv_file, is_github_actions=is_github_actions, node_countries=node_countries)
     if not final_node_count:
         logger.error("无法生成最终 IPs 文件")
         sys.exit(1)
@@ -0,0 +1,329 @@
+"""原生测速引擎：基于 asyncio 的 TCP 连接延迟探测与下载测速，可替代 iptest"""
+import asyncio
+import csv
+import logging
+import socket
+import ssl
+import statistics
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 与 iptest 输出的 ip.csv 保持一致的列
+CSV_HEADER = ['IP地址', '端口', 'TLS', '数据中心', '地区', '国际代码', '国家', '城市', '网络延迟', '下载速度MB/s']
+TLS_PORTS = {443, 2053, 2083, 2087, 2096, 8443}
+PROBE_CONCURRENCY = 2000
+PROBE_SAMPLES = 3
+PROBE_TIMEOUT = 2.0
+STREAM_QUEUE_SIZE = 4096
+SPEEDTEST_URL = "speed.cloudflare.com/__down?bytes=50000000"
+SPEEDTEST_CONCURRENCY = 3
+DOWNLOAD_DURATION = 10.0
+DOWNLOAD_TIMEOUT = 5.0
+RECV_BUFFER_SIZE = 256 * 1024
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+def raise_fd_limit(wanted: int):
+    """尽量提高文件描述符软限制，保证数千个并发连接不会触发 EMFILE"""
+    try:
+        import resource
+    except ImportError:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = wanted + 256
+        if hard != resource.RLIM_INFINITY:
+            target = min(target, hard)
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            logger.info(f"文件描述符限制已从 {soft} 提高到 {target}")
+    except (ValueError, OSError) as e:
+        logger.warning(f"无法提高文件描述符限制: {e}")
+
+async def _connect_once(loop: asyncio.AbstractEventLoop, ip: str, port: int, timeout: float) -> Optional[float]:
+    """建立一次 TCP 连接，返回握手耗时（毫秒），失败返回 None"""
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    # 以 RST 关闭连接，避免大量 TIME_WAIT 占满本地端口
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout)
+        return (time.perf_counter() - start) * 1000
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        sock.close()
+
+async def _handshake_once(ip: str, port: int, timeout: float, context: ssl.SSLContext, server_hostname: str) -> Optional[float]:
+    """建立一次 TCP 连接并完成 TLS 握手，返回总耗时（毫秒），失败返回 None"""
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port, ssl=context, server_hostname=server_hostname), timeout
+        )
+    except (OSError, asyncio.TimeoutError, ssl.SSLError):
+        return None
+    elapsed = (time.perf_counter() - start) * 1000
+    writer.transport.abort()
+    return elapsed
+
+def summarize_samples(ip: str, port: int, rtts: List[Optional[float]]) -> Dict:
+    """汇总单个节点的采样结果：最小值、中位数、抖动与丢包率"""
+    ok = [rtt for rtt in rtts if rtt is not None]
+    result = {
+        'ip': ip,
+        'port': port,
+        'tls': port in TLS_PORTS,
+        'samples': len(rtts),
+        'received': len(ok),
+        'loss': (1 - len(ok) / len(rtts)) if rtts else 1.0,
+        'min': None,
+        'median': None,
+        'jitter': None,
+    }
+    if ok:
+        result['min'] = min(ok)
+        result['median'] = statistics.median(ok)
+        # 抖动取相邻采样差值的平均绝对值（RFC 3550 的简化形式）
+        diffs = [abs(b - a) for a, b in zip(ok, ok[1:])]
+        result['jitter'] = sum(diffs) / len(diffs) if diffs else 0.0
+    return result
+
+async def _probe_node(loop: asyncio.AbstractEventLoop, ip: str, port: int, samples: int, timeout: float,
+                      context: Optional[ssl.SSLContext], handshake_host: str) -> Dict:
+    rtts = []
+    for _ in range(samples):
+        if handshake_host and port in TLS_PORTS:
+            rtts.append(await _handshake_once(ip, port, timeout, context, handshake_host))
+        else:
+            rtts.append(await _connect_once(loop, ip, port, timeout))
+    return summarize_samples(ip, port, rtts)
+
+async def _probe_worker(nodes, results: List[Dict], samples: int, timeout: float, handshake_host: str):
+    loop = asyncio.get_running_loop()
+    context = ssl.create_default_context() if handshake_host else None
+    for ip, port in nodes:
+        results.append(await _probe_node(loop, ip, port, samples, timeout, context, handshake_host))
+
+async def probe_latency_async(nodes: Iterable[Tuple[str, int]], concurrency: int = PROBE_CONCURRENCY,
+                              samples: int = PROBE_SAMPLES, timeout: float = PROBE_TIMEOUT,
+                              handshake_host: str = None) -> List[Dict]:
+    """并发探测所有节点；固定数量的 worker 共享同一个迭代器，在途连接数不超过 concurrency
+
+    指定 handshake_host 时，TLS 端口的每次采样都以该 SNI 完成一次 TLS 握手，握手失败计为丢包。
+    """
+    results = []
+    node_iter = iter(nodes)
+    workers = [asyncio.create_task(_probe_worker(node_iter, results, samples, timeout, handshake_host))
+               for _ in range(max(1, concurrency))]
+    await asyncio.gather(*workers)
+    return results
+
+def probe_latency(nodes: Iterable[Tuple[str, int]], concurrency: int = PROBE_CONCURRENCY,
+                  samples: int = PROBE_SAMPLES, timeout: float = PROBE_TIMEOUT,
+                  handshake_host: str = None) -> List[Dict]:
+    """同步入口：返回按中位延迟升序排列的探测结果（不可达节点排在最后）"""
+    nodes = list(nodes)
+    if not nodes:
+        return []
+    concurrency = max(1, min(concurrency, len(nodes)))
+    raise_fd_limit(concurrency)
+    start_time = time.time()
+    results = asyncio.run(probe_latency_async(nodes, concurrency, samples, timeout, handshake_host))
+    results.sort(key=lambda r: (r['median'] is None, r['median'] or 0.0))
+    reachable = sum(1 for r in results if r['received'])
+    logger.info(f"延迟探测完成: {len(nodes)} 个节点，{reachable} 个可达 "
+                f"(并发 {concurrency}，每节点 {samples} 次采样，耗时 {time.time() - start_time:.2f} 秒)")
+    return results
+
+async def _feed_queue(batches: Iterable[List[Tuple[str, int]]], queue: asyncio.Queue, workers: int):
+    """在线程池中逐批推进上游生成器；队列满时 put 会阻塞，从而把背压传回上游"""
+    loop = asyncio.get_running_loop()
+    batch_iter = iter(batches)
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, next, batch_iter, None)
+            if batch is None:
+                break
+            for node in batch:
+                await queue.put(node)
+    finally:
+        for _ in range(workers):
+            await queue.put(None)
+
+async def _stream_worker(queue: asyncio.Queue, results: List[Dict], stats: Dict, samples: int,
+                         timeout: float, handshake_host: str):
+    loop = asyncio.get_running_loop()
+    context = ssl.create_default_context() if handshake_host else None
+    while True:
+        node = await queue.get()
+        if node is None:
+            return
+        if stats['first_probe'] is None:
+            stats['first_probe'] = time.perf_counter()
+        result = await _probe_node(loop, node[0], node[1], samples, timeout, context, handshake_host)
+        stats['probed'] += 1
+        if result['received']:
+            results.append(result)
+
+async def probe_latency_stream_async(batches: Iterable[List[Tuple[str, int]]], concurrency: int, samples: int,
+                                     timeout: float, handshake_host: str, queue_size: int, stats: Dict) -> List[Dict]:
+    queue = asyncio.Queue(maxsize=max(1, queue_size))
+    results = []
+    workers = [asyncio.create_task(_stream_worker(queue, results, stats, samples, timeout, handshake_host))
+               for _ in range(max(1, concurrency))]
+    await asyncio.gather(_feed_queue(batches, queue, len(workers)), *workers)
+    return results
+
+def probe_latency_stream(batches: Iterable[List[Tuple[str, int]]], concurrency: int = PROBE_CONCURRENCY,
+                         samples: int = PROBE_SAMPLES, timeout: float = PROBE_TIMEOUT,
+                         handshake_host: str = None, queue_size: int = STREAM_QUEUE_SIZE) -> List[Dict]:
+    """流式探测：上游每产出一批节点就立即开始探测，队列容量有限，内存不随候选总数增长
+
+    只保留可达节点的结果，按中位延迟升序返回。
+    """
+    raise_fd_limit(concurrency)
+    stats = {'first_probe': None, 'probed': 0}
+    start = time.perf_counter()
+    results = asyncio.run(probe_latency_stream_async(
+        batches, concurrency, samples, timeout, handshake_host, queue_size, stats
+    ))
+    results.sort(key=lambda r: r['median'])
+    if stats['first_probe'] is not None:
+        logger.info(f"流式探测: 首个探测在启动后 {stats['first_probe'] - start:.2f} 秒开始")
+    logger.info(f"流式探测完成: {stats['probed']} 个节点，{len(results)} 个可达 "
+                f"(并发 {concurrency}，队列容量 {queue_size}，耗时 {time.perf_counter() - start:.2f} 秒)")
+    return results
+
+def write_results_csv(path: str, results: List[Dict], countries: Dict[Tuple[str, int], str] = None,
+                      country_names: Dict[str, str] = None) -> int:
+    """将可达节点按 ip.csv 的列格式写出，返回写入行数"""
+    countries = countries or {}
+    country_names = country_names or {}
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for r in results:
+            if not r['received']:
+                continue
+            code = countries.get((r['ip'], r['port']), '')
+            speed = r.get('speed')
+            writer.writerow([
+                r['ip'], r['port'], 'true' if r['tls'] else 'false',
+                r.get('colo', ''), '', code, country_names.get(code, ''), '',
+                f"{r['median']:.0f} ms",
+                f"{speed:.2f}" if speed is not None else '',
+            ])
+            count += 1
+    return count
+
+def split_speedtest_url(url: str) -> Tuple[str, str]:
+    """将 "host/path?query" 或完整 URL 拆分为 (host, path)"""
+    url = url.split('://', 1)[-1]
+    host, sep, path = url.partition('/')
+    return host, sep + path if sep else '/'
+
+_thread_buffers = threading.local()
+
+def _recv_buffer() -> memoryview:
+    """每个测速线程复用一块预分配的接收缓冲区，接收循环中不产生任何分配"""
+    view = getattr(_thread_buffers, 'view', None)
+    if view is None:
+        view = memoryview(bytearray(RECV_BUFFER_SIZE))
+        _thread_buffers.view = view
+    return view
+
+def _parse_response_head(head: bytes) -> Tuple[int, Dict[str, str]]:
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+def measure_download(ip: str, port: int, url: str = SPEEDTEST_URL, tls: bool = None,
+                     duration: float = DOWNLOAD_DURATION, timeout: float = DOWNLOAD_TIMEOUT) -> Dict:
+    """连接候选 IP，以正确的 SNI/Host 请求测速文件，返回下载速度 (MB/s) 与数据中心
+
+    最多下载 duration 秒；返回字典包含 speed、bytes、colo 与 error。
+    """
+    host, path = split_speedtest_url(url)
+    if tls is None:
+        tls = port in TLS_PORTS
+    result = {'ip': ip, 'port': port, 'speed': None, 'bytes': 0, 'colo': '', 'error': ''}
+    view = _recv_buffer()
+    sock = None
+    try:
+        sock = socket.create_connection((ip, port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if tls:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=host)
+        request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: {USER_AGENT}\r\n"
+                   f"Accept: */*\r\nConnection: close\r\n\r\n")
+        sock.sendall(request.encode('ascii'))
+
+        # 读取响应头：头部可能与首段正文一起到达，计时从第一次读取前开始，首段正文的耗时也计入
+        start = time.perf_counter()
+        filled = 0
+        head_end = -1
+        while head_end < 0:
+            if filled == len(view):
+                raise ValueError("响应头过大")
+            n = sock.recv_into(view[filled:])
+            if not n:
+                raise ConnectionError("响应头未完整返回")
+            filled += n
+            head_end = bytes(view[:filled]).find(b'\r\n\r\n')
+        status, headers = _parse_response_head(bytes(view[:head_end]))
+        if status != 200:
+            raise ValueError(f"HTTP 状态码 {status}")
+        cf_ray = headers.get('cf-ray', '')
+        if '-' in cf_ray:
+            result['colo'] = cf_ray.rsplit('-', 1)[1].upper()
+        content_length = int(headers.get('content-length', 0) or 0)
+
+        received = filled - (head_end + 4)
+        deadline = start + duration
+        sock.settimeout(timeout)
+        recv_into = sock.recv_into
+        while not content_length or received < content_length:
+            n = recv_into(view)
+            if not n:
+                break
+            received += n
+            if time.perf_counter() >= deadline:
+                break
+        elapsed = time.perf_counter() - start
+        result['bytes'] = received
+        if elapsed > 0:
+            result['speed'] = received / elapsed / (1024 * 1024)
+    except (OSError, ValueError, ssl.SSLError) as e:
+        result['error'] = str(e) or type(e).__name__
+    finally:
+        if sock is not None:
+            sock.close()
+    return result
+
+def run_download_tests(nodes: List[Tuple[str, int]], url: str = SPEEDTEST_URL,
+                       concurrency: int = SPEEDTEST_CONCURRENCY, duration: float = DOWNLOAD_DURATION,
+                       timeout: float = DOWNLOAD_TIMEOUT) -> List[Dict]:
+    """按给定顺序对节点进行下载测速，同时进行的下载数不超过 concurrency"""
+    if not nodes:
+        return []
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(lambda node: measure_download(node[0], node[1], url, duration=duration, timeout=timeout), nodes))
+    measured = sum(1 for r in results if r['speed'] is not None)
+    logger.info(f"下载测速完成: {len(nodes)} 个节点，{measured} 个成功 (并发 {concurrency}，耗时 {time.time() - start_time:.2f} 秒)")
+    return results
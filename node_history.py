@@ -0,0 +1,185 @@
+"""节点测速历史的 SQLite 存储：每个 (IP, 端口) 每次测速记录一条样本，并维护汇总
+
+samples 表按 (ip, port, ts) 与 ts 建索引，保存每次测速的成功与否、延迟、速度与数据中心；
+nodes 表为每个节点保存最近一次的国家/数据中心、成功次数、延迟与速度的 EWMA（速度另有 EWMA 方差），
+以及最近 MAX_SAMPLES_PER_NODE 个样本的分位数。按国家取速度最好的节点只需沿 (country, ewma_speed) 索引读取汇总表，
+样本数达到数百万时仍在毫秒级完成。
+
+保留策略：超过保留期的样本与长期未出现的节点被删除，每个节点最多保留 MAX_SAMPLES_PER_NODE 个样本，
+删除后用 incremental_vacuum 归还空闲页。
+"""
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BUSY_TIMEOUT = 10.0
+EWMA_ALPHA = 0.3
+RETENTION_DAYS = 30
+MAX_SAMPLES_PER_NODE = 100
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    ok INTEGER NOT NULL,
+    latency REAL,
+    speed REAL,
+    colo TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_node ON samples (ip, port, ts);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+CREATE TABLE IF NOT EXISTS nodes (
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    country TEXT NOT NULL DEFAULT '',
+    colo TEXT NOT NULL DEFAULT '',
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    last_ok INTEGER,
+    tests INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    ewma_latency REAL,
+    ewma_speed REAL,
+    ewma_speed_var REAL,
+    p50_latency REAL,
+    p90_latency REAL,
+    p10_speed REAL,
+    p50_speed REAL,
+    PRIMARY KEY (ip, port)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS nodes_country_speed ON nodes (country, ewma_speed);
+CREATE INDEX IF NOT EXISTS nodes_last_seen ON nodes (last_seen);
+"""
+UPSERT_NODE = """
+INSERT INTO nodes (ip, port, country, colo, first_seen, last_seen, last_ok, tests, successes, ewma_latency,
+                   ewma_speed, ewma_speed_var, p50_latency, p90_latency, p10_speed, p50_speed)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (ip, port) DO UPDATE SET
+    country = excluded.country, colo = excluded.colo, last_seen = excluded.last_seen, last_ok = excluded.last_ok,
+    tests = excluded.tests, successes = excluded.successes, ewma_latency = excluded.ewma_latency,
+    ewma_speed = excluded.ewma_speed, ewma_speed_var = excluded.ewma_speed_var,
+    p50_latency = excluded.p50_latency, p90_latency = excluded.p90_latency,
+    p10_speed = excluded.p10_speed, p50_speed = excluded.p50_speed
+"""
+NODE_COLUMNS = ("ip", "port", "country", "colo", "first_seen", "last_seen", "last_ok", "tests", "successes",
+                "ewma_latency", "ewma_speed", "ewma_speed_var", "p50_latency", "p90_latency", "p10_speed", "p50_speed")
+
+def connect(path: str) -> sqlite3.Connection:
+    """打开（必要时创建）存储；新建的数据库使用增量 auto_vacuum，便于压缩后归还空间"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _ewma(previous: Optional[float], value: Optional[float]) -> Optional[float]:
+    if value is None:
+        return previous
+    return value if previous is None else previous + EWMA_ALPHA * (value - previous)
+
+def _update_node(conn: sqlite3.Connection, sample: Dict, ts: int):
+    ip, port = sample['ip'], sample['port']
+    row = conn.execute("SELECT first_seen, last_ok, tests, successes, ewma_latency, ewma_speed, ewma_speed_var, "
+                       "country, colo FROM nodes WHERE ip = ? AND port = ?", (ip, port)).fetchone()
+    first_seen, last_ok, tests, successes, ewma_latency, ewma_speed, speed_var, country, colo = \
+        row or (ts, None, 0, 0, None, None, None, '', '')
+    if sample['ok']:
+        last_ok, successes = ts, successes + 1
+        ewma_latency = _ewma(ewma_latency, sample.get('latency'))
+        speed = sample.get('speed')
+        if speed is not None:
+            if ewma_speed is None:
+                ewma_speed, speed_var = speed, 0.0
+            else:
+                # EWMA 方差: var' = (1 - a) * (var + a * diff^2)
+                diff = speed - ewma_speed
+                ewma_speed += EWMA_ALPHA * diff
+                speed_var = (1 - EWMA_ALPHA) * ((speed_var or 0.0) + EWMA_ALPHA * diff * diff)
+    recent = conn.execute("SELECT latency, speed FROM samples WHERE ip = ? AND port = ? AND ok = 1 "
+                          "ORDER BY ts DESC LIMIT ?", (ip, port, MAX_SAMPLES_PER_NODE)).fetchall()
+    latencies = [latency for latency, _ in recent if latency is not None]
+    speeds = [speed for _, speed in recent if speed is not None]
+    conn.execute(UPSERT_NODE, (
+        ip, port, sample.get('country') or country, sample.get('colo') or colo, first_seen, ts, last_ok,
+        tests + 1, successes, ewma_latency, ewma_speed, speed_var,
+        _percentile(latencies, 0.5), _percentile(latencies, 0.9), _percentile(speeds, 0.1), _percentile(speeds, 0.5),
+    ))
+
+def record_samples(path: str, samples: Iterable[Dict], ts: int = None,
+                   retention_days: float = RETENTION_DAYS) -> int:
+    """写入一次测速的结果并更新汇总，随后执行保留策略；返回写入的样本数
+
+    samples 为 {'ip', 'port', 'ok', 'latency' (毫秒), 'speed' (MB/s), 'colo', 'country'}，同一节点只记录一次。
+    """
+    ts = int(time.time()) if ts is None else ts
+    unique = OrderedDict()
+    for sample in samples:
+        unique.setdefault((sample['ip'], int(sample['port'])), dict(sample, port=int(sample['port'])))
+    if not unique:
+        return 0
+    conn = connect(path)
+    try:
+        with conn:
+            conn.executemany("INSERT INTO samples (ip, port, ts, ok, latency, speed, colo) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             ((s['ip'], s['port'], ts, 1 if s['ok'] else 0, s.get('latency'), s.get('speed'),
+                               s.get('colo') or None) for s in unique.values()))
+            for sample in unique.values():
+                _update_node(conn, sample, ts)
+        compact(conn, unique.keys(), ts - int(retention_days * 86400))
+    finally:
+        conn.close()
+    return len(unique)
+
+def compact(conn: sqlite3.Connection, touched: Iterable[Tuple[str, int]], cutoff: int):
+    """删除 cutoff 之前的样本与节点，并把 touched 中每个节点的样本裁剪到 MAX_SAMPLES_PER_NODE 个"""
+    with conn:
+        expired = conn.execute("DELETE FROM samples WHERE ts < ?", (cutoff,)).rowcount
+        gone = conn.execute("DELETE FROM nodes WHERE last_seen < ?", (cutoff,)).rowcount
+        trimmed = 0
+        for ip, port in touched:
+            trimmed += conn.execute(
+                "DELETE FROM samples WHERE ip = ? AND port = ? AND ts < "
+                "(SELECT ts FROM samples WHERE ip = ? AND port = ? ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                (ip, port, ip, port, MAX_SAMPLES_PER_NODE - 1)).rowcount
+    if expired or gone or trimmed:
+        conn.execute("PRAGMA incremental_vacuum")
+        logger.info(f"测速历史压缩: 删除 {expired} 条过期样本、{trimmed} 条超出数量上限的样本、{gone} 个长期未出现的节点")
+
+def best_nodes(path: str, country: str, days: float = 7, limit: int = 20,
+               min_success_rate: float = 0.0) -> List[Dict]:
+    """返回某国家在最近 days 天内测速成功过、速度 EWMA 最高的 limit 个节点汇总"""
+    cutoff = int(time.time() - days * 86400)
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(NODE_COLUMNS)} FROM nodes "
+            "WHERE country = ? AND ewma_speed IS NOT NULL AND last_ok >= ? AND successes >= ? * tests "
+            "ORDER BY ewma_speed DESC LIMIT ?", (country.upper(), cutoff, min_success_rate, limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(zip(NODE_COLUMNS, row)) for row in rows]
+
+def node_summaries(path: str, keys: Iterable[Tuple[str, int]] = None) -> Dict[Tuple[str, int], Dict]:
+    """读取节点汇总，keys 为空时返回全部节点"""
+    conn = connect(path)
+    try:
+        query = f"SELECT {', '.join(NODE_COLUMNS)} FROM nodes"
+        if keys is None:
+            rows = conn.execute(query).fetchall()
+        else:
+            rows = [row for ip, port in keys
+                    for row in conn.execute(query + " WHERE ip = ? AND port = ?", (ip, port)).fetchall()]
+    finally:
+        conn.close()
+    return {(row[0], row[1]): dict(zip(NODE_COLUMNS, row)) for row in rows}
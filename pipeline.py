@@ -0,0 +1,452 @@
+"""可导入的节点处理流水线：来源下载与解析、GeoIP 国家补全、国家过滤以及 ip.txt / ips.txt 输出
+
+导入本模块没有副作用（不配置日志、不查找测速脚本、不注册 atexit），bs4 与 geoip2 在第一次使用时才导入。
+Pipeline 对象持有 GeoIP reader 与网段缓存，长驻进程（守护模式、API 服务）可以在多次运行之间复用。
+"""
+import csv
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import country_store
+import encoding_detect
+import geo_enrich
+import http_client
+import source_parser
+from countries import COUNTRY_LABELS, standardize_country
+from source_parser import is_valid_ip, is_valid_port
+
+logger = logging.getLogger(__name__)
+
+Node = Tuple[str, int, str]
+
+IP_LIST_FILE = "ip.txt"
+IPS_FILE = "ips.txt"
+GEOIP_DB_PATH = Path("GeoLite2-Country.mmdb")
+COUNTRY_CACHE_DB = "country_cache.sqlite3"
+COUNTRY_CACHE_TTL = 30 * 24 * 3600
+DESIRED_COUNTRIES = ['TW', 'JP', 'HK', 'SG', 'KR', 'IN', 'KP', 'VN', 'TH', 'MM', 'US']
+WEB_PORTS = [443, 2053, 2083, 2087, 2096, 8443]
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://www.google.com/"
+}
+WEB_IPV4_PATTERN = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)')
+
+def write_text_atomic(path: str, text: str, encoding: str = "utf-8"):
+    """先写临时文件再 os.replace，读者只会看到旧文件或完整的新文件"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding=encoding, newline="") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+class Pipeline:
+    """节点处理流水线
+
+    desired_countries 为空表示不按国家过滤。reader_factory 返回 GeoIP reader（例如先下载数据库再打开），
+    只在第一次未命中网段缓存时调用；未给出时直接以 mmap 打开 geoip_db_path。
+    """
+
+    def __init__(self, desired_countries: Iterable[str] = None, geoip_db_path=GEOIP_DB_PATH,
+                 country_cache_db: str = COUNTRY_CACHE_DB, country_cache_ttl: int = COUNTRY_CACHE_TTL,
+                 legacy_country_cache: str = None, reader_factory: Callable = None,
+                 headers: Dict[str, str] = None, keep_sources_dir: str = None):
+        self.desired_countries = set(DESIRED_COUNTRIES if desired_countries is None else desired_countries)
+        self.geoip_db_path = geoip_db_path
+        self.country_cache_db = country_cache_db
+        self.country_cache_ttl = country_cache_ttl
+        self.legacy_country_cache = legacy_country_cache
+        self.reader_factory = reader_factory
+        self.headers = HEADERS if headers is None else headers
+        self.keep_sources_dir = keep_sources_dir
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._country_cache: Optional[geo_enrich.PrefixCache] = None
+        self._cache_epoch: Optional[int] = None
+        self._pending_countries: Dict[str, str] = {}
+        # 来源正文摘要与解析结果 {URL 或文件: (sha1, 结果)}；正文未变化时直接复用，不再解码与解析
+        self._parsed_sources: Dict[str, Tuple[str, list]] = {}
+
+    # ---- GeoIP ----
+
+    def reader(self):
+        """返回 GeoIP reader，首次调用时才创建"""
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = self.reader_factory() if self.reader_factory else geo_enrich.open_reader(self.geoip_db_path)
+                self._revalidate_country_cache()
+            return self._reader
+
+    def close(self):
+        """写入未保存的网段缓存；reader 由本对象打开时一并关闭"""
+        self.flush_country_cache()
+        with self._reader_lock:
+            if self._reader is not None and self.reader_factory is None:
+                self._reader.close()
+            self._reader = None
+
+    def _build_epoch(self) -> Optional[int]:
+        """当前 mmdb 的构建时间；reader 尚未打开时只读取数据库文件的元数据"""
+        if self._reader is not None:
+            return country_store.reader_build_epoch(self._reader)
+        return geo_enrich.read_build_epoch(self.geoip_db_path) if self.geoip_db_path else None
+
+    @property
+    def country_cache(self) -> geo_enrich.PrefixCache:
+        """网段缓存，第一次访问时从 SQLite 存储加载，之后常驻内存"""
+        if self._country_cache is None:
+            self._cache_epoch = self._build_epoch()
+            try:
+                self._country_cache = country_store.load_prefix_cache(
+                    self.country_cache_db, self._cache_epoch,
+                    self.country_cache_ttl, legacy_json=self.legacy_country_cache)
+            except Exception as e:
+                logger.warning(f"无法加载国家缓存: {e}")
+                self._country_cache = {}
+        return self._country_cache
+
+    def _revalidate_country_cache(self):
+        """reader 打开后核对构建时间：加载缓存时数据库文件尚不存在或随后被更新时，按新版本就地重新加载"""
+        epoch = country_store.reader_build_epoch(self._reader)
+        if self._country_cache is None or epoch is None or epoch == self._cache_epoch:
+            return
+        logger.info(f"GeoIP 数据库版本与国家缓存不一致 ({self._cache_epoch} → {epoch})，重新加载国家缓存")
+        try:
+            fresh = country_store.load_prefix_cache(self.country_cache_db, epoch, self.country_cache_ttl,
+                                                    legacy_json=self.legacy_country_cache)
+        except Exception as e:
+            logger.warning(f"无法加载国家缓存: {e}")
+            fresh = {}
+        # 就地替换，正在进行的查询随后使用新版本的缓存
+        self._country_cache.clear()
+        self._country_cache.update(fresh)
+        self._cache_epoch = epoch
+
+    def flush_country_cache(self):
+        """批量写入本次新增的网段，已有记录不重写"""
+        if not self._pending_countries:
+            return
+        try:
+            country_store.save_entries(self.country_cache_db, self._pending_countries, self._build_epoch())
+            self._pending_countries.clear()
+        except Exception as e:
+            logger.warning(f"无法保存国家缓存: {e}")
+
+    def lookup_countries(self, ips: List[str]) -> List[str]:
+        """按网段缓存批量查询国家代码，结果与 ips 一一对应"""
+        countries = geo_enrich.lookup_countries_parallel(self.geoip_db_path, self.reader, ips,
+                                                         self.country_cache, self._pending_countries)
+        return [countries.get(ip, '') for ip in ips]
+
+    def resolve_countries(self, nodes: List[Node]) -> Tuple[List[Node], int]:
+        """为数据源未提供有效国家信息的节点查询 GeoIP，返回 (ip, port, 最终国家) 列表及补充的节点数"""
+        ips_to_query = [ip for ip, _, country in nodes if not country or country not in COUNTRY_LABELS]
+        ip_country_map = {}
+        supplemented = 0
+        if ips_to_query:
+            logger.info(f"批量查询 {len(ips_to_query)} 个 IP 的国家信息（缺失或无效）")
+            countries = self.lookup_countries(ips_to_query)
+            ip_country_map = dict(zip(ips_to_query, countries))
+            supplemented = sum(1 for country in countries if country)
+        resolved = []
+        for ip, port, country in nodes:
+            if not country or country not in COUNTRY_LABELS:
+                country = ip_country_map.get(ip, '')
+            resolved.append((ip, port, country))
+        return resolved, supplemented
+
+    def is_desired(self, country: str) -> bool:
+        return not self.desired_countries or bool(country and country in self.desired_countries)
+
+    # ---- 来源 ----
+
+    def decode(self, raw_data: bytes, name: str) -> Tuple[Optional[str], Optional[str]]:
+        """将来源正文解码为文本（BOM → 严格 UTF-8 → 本进程内该来源检测过的编码 → 样本统计检测），
+        返回 (文本, 编码)，失败返回 (None, None)
+        """
+        try:
+            content, encoding = encoding_detect.decode_bytes(raw_data, name)
+        except Exception as e:
+            logger.error(f"无法解码 {name}: {e}")
+            return None, None
+        logger.info(f"{name} 编码: {encoding}")
+        return content, encoding
+
+    def parse(self, content: str, source: str = None) -> List[Node]:
+        """解析 JSON 或分隔符文本中的节点，返回去重后的 (ip, port, country) 列表
+
+        给出 source（URL 或文件路径）时复用该来源缓存的表结构，跳过分隔符与国家列推断。
+        """
+        nodes, invalid = source_parser.parse_nodes(content, standardize_country, source)
+        if invalid:
+            logger.info(f"发现 {invalid} 个无效条目")
+        return nodes
+
+    def _unchanged(self, name: str, body: bytes) -> Tuple[str, Optional[list]]:
+        digest = hashlib.sha1(body).hexdigest()
+        cached = self._parsed_sources.get(name)
+        if cached is not None and cached[0] == digest:
+            logger.info(f"{name} 内容未变化，复用上次解析的 {len(cached[1])} 条结果")
+            return digest, list(cached[1])
+        return digest, None
+
+    def parse_file(self, file_path: str) -> List[Node]:
+        if not os.path.exists(file_path):
+            logger.error(f"文件 {file_path} 不存在")
+            return []
+        start_time = time.time()
+        with open(file_path, "rb") as f:
+            raw_data = f.read()
+        digest, nodes = self._unchanged(file_path, raw_data)
+        if nodes is not None:
+            return nodes
+        content, encoding = self.decode(raw_data, file_path)
+        if content is None:
+            return []
+        nodes = self.parse(content, file_path)
+        self._parsed_sources[file_path] = (digest, nodes)
+        logger.info(f"文件 {file_path} 解析完成 (耗时: {time.time() - start_time:.2f} 秒)")
+        return nodes
+
+    def fetch_source(self, url: str, idx: int = 0) -> List[Node]:
+        """下载单个 URL 数据源并直接在内存中解析：只解码一次，不经过临时文件
+
+        设置了 keep_sources_dir 时另将原始正文保存为 source_<idx>.csv 以便排查问题。
+        """
+        start_time = time.time()
+        try:
+            body, meta = http_client.fetch_cached(url, timeout=60, headers=self.headers)
+        except Exception as e:
+            logger.error(f"无法下载 URL {url}: {e}")
+            return []
+        logger.info(f"下载完成 ({url}): {len(body)} 字节{'（缓存）' if meta['from_cache'] else ''}")
+        if self.keep_sources_dir:
+            try:
+                os.makedirs(self.keep_sources_dir, exist_ok=True)
+                source_path = os.path.join(self.keep_sources_dir, f"source_{idx}.csv")
+                with open(source_path, "wb") as f:
+                    f.write(body)
+                logger.info(f"已保存来源正文: {source_path}")
+            except OSError as e:
+                logger.warning(f"无法保存来源正文 {url}: {e}")
+        digest, nodes = self._unchanged(url, body)
+        if nodes is not None:
+            return nodes
+        content, encoding = self.decode(body, url)
+        del body
+        if content is None:
+            return []
+        nodes = self.parse(content, url)
+        self._parsed_sources[url] = (digest, nodes)
+        logger.info(f"从 {url} 提取到 {len(nodes)} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
+        return nodes
+
+    def fetch_web_page(self, url: str) -> List[str]:
+        """抓取单个网页并返回其中的 IPv4 地址"""
+        logger.info(f"正在从网页提取 IP: {url}")
+        try:
+            from bs4 import BeautifulSoup
+            body, meta = http_client.fetch_cached(url, retries=3, backoff_factor=1, headers=self.headers, timeout=30)
+            digest, ips = self._unchanged(url, body)
+            if ips is not None:
+                return ips
+            soup = BeautifulSoup(body, 'html.parser', from_encoding=meta.get('encoding'))
+            ips = sorted(set(WEB_IPV4_PATTERN.findall(soup.get_text())))
+            self._parsed_sources[url] = (digest, ips)
+            logger.info(f"从 {url} 提取到 {len(ips)} 个唯一 IP")
+            return ips
+        except Exception as e:
+            logger.error(f"无法从 {url} 提取 IP: {e}")
+            return []
+
+    def fetch_web(self, urls: List[str], ports: List[int] = WEB_PORTS) -> List[Node]:
+        """从指定网页提取IP并分配端口"""
+        nodes = []
+        if not urls:
+            return nodes
+        with ThreadPoolExecutor(max_workers=min(len(urls), http_client.MAX_CONCURRENCY)) as executor:
+            pages = list(executor.map(self.fetch_web_page, urls))
+
+        for ips in pages:
+            for ip in ips:
+                if is_valid_ip(ip):
+                    for port in ports:
+                        nodes.append((ip, port, ''))  # 国家信息留空，依赖GeoIP查询
+                else:
+                    logger.debug(f"无效 IP 地址: {ip}")
+
+        unique_nodes = list(dict.fromkeys(nodes))
+        logger.info(f"从网页共提取 {len(unique_nodes)} 个唯一 IP:端口对")
+        return unique_nodes
+
+    def fetch_all(self, urls: List[str], web_urls: List[str] = (), web_ports: List[int] = WEB_PORTS) -> List[Node]:
+        """并行处理所有在线来源（URL 数据源和网页），返回合并去重后的节点列表"""
+        nodes = []
+        url_futures = []
+        web_future = None
+
+        with ThreadPoolExecutor(max_workers=http_client.MAX_CONCURRENCY) as executor:
+            if urls:
+                logger.info(f"从 INPUT_URLS 开始提取节点: {urls}")
+                url_futures = [executor.submit(self.fetch_source, url, idx) for idx, url in enumerate(urls)]
+            if web_urls:
+                logger.info(f"从 WEB_URLS 开始提取节点: {web_urls}")
+                web_future = executor.submit(self.fetch_web, list(web_urls), web_ports)
+
+            for future in url_futures:
+                nodes.extend(future.result())
+            if web_future is not None:
+                result = web_future.result()
+                nodes.extend(result)
+                logger.info(f"从 WEB_URLS 提取到 {len(result)} 个节点")
+
+        return list(dict.fromkeys(nodes))
+
+    def iter_sources(self, urls: List[str], web_urls: List[str] = (),
+                     web_ports: List[int] = WEB_PORTS) -> Iterator[List[Node]]:
+        """并发拉取所有在线来源，每个来源一完成解析就立即产出其节点批次"""
+        with ThreadPoolExecutor(max_workers=http_client.MAX_CONCURRENCY) as executor:
+            futures = {}
+            for idx, url in enumerate(urls or []):
+                futures[executor.submit(self.fetch_source, url, idx)] = url
+            for url in web_urls:
+                futures[executor.submit(self.fetch_web, [url], web_ports)] = url
+            for future in as_completed(futures):
+                try:
+                    nodes = future.result()
+                except Exception as e:
+                    logger.error(f"处理来源 {futures[future]} 失败: {e}")
+                    continue
+                if nodes:
+                    yield nodes
+
+    # ---- 过滤与输出 ----
+
+    def select(self, nodes: List[Node], node_countries: Dict[Tuple[str, int], str] = None) -> List[Tuple[str, int]]:
+        """补全国家并按目标国家过滤，返回保留的 (ip, port)；若传入 node_countries，则同时记录每个保留节点的最终国家"""
+        kept = {}
+        country_counts = defaultdict(int)
+        filtered_counts = defaultdict(int)
+        logger.info(f"开始处理 {len(nodes)} 个节点...")
+
+        from_source = sum(1 for _, _, country in nodes if country and country in COUNTRY_LABELS)
+        logger.info(f"数据源为 {from_source} 个节点提供了有效国家信息（包括城市映射）")
+
+        resolved, supplemented = self.resolve_countries(nodes)
+        for ip, port, final_country in resolved:
+            if not self.is_desired(final_country):
+                filtered_counts[final_country or 'UNKNOWN'] += 1
+                continue
+            kept[(ip, port)] = None
+            if final_country:
+                country_counts[final_country] += 1
+            if node_countries is not None:
+                node_countries[(ip, port)] = final_country
+
+        logger.info(f"过滤结果: 保留 {len(kept)} 个节点，过滤掉 {sum(filtered_counts.values())} 个节点")
+        logger.info(f"通过 GeoIP 数据库补充国家信息: {supplemented} 个节点")
+        logger.info(f"保留的国家分布: {dict(country_counts)}")
+        logger.info(f"过滤掉的国家分布: {dict(filtered_counts)}")
+        self.flush_country_cache()
+        return list(kept)
+
+    def iter_candidates(self, batches: Iterable[List[Node]],
+                        node_countries: Dict[Tuple[str, int], str]) -> Iterator[List[Tuple[str, int]]]:
+        """流式国家补全与过滤：逐批查询 GeoIP，只产出目标国家中首次出现的 (ip, port)"""
+        seen = set()
+        total = kept = 0
+        try:
+            for batch in batches:
+                batch = [node for node in batch if (node[0], node[1]) not in seen]
+                seen.update((ip, port) for ip, port, _ in batch)
+                total += len(batch)
+                resolved, _ = self.resolve_countries(batch)
+                candidates = []
+                for ip, port, country in resolved:
+                    if self.is_desired(country):
+                        node_countries[(ip, port)] = country
+                        candidates.append((ip, port))
+                kept += len(candidates)
+                if candidates:
+                    yield candidates
+        finally:
+            logger.info(f"流式过滤: 共 {total} 个唯一节点，保留 {kept} 个目标国家节点")
+            self.flush_country_cache()
+
+    def write_ip_list(self, nodes: List[Node], path: str = IP_LIST_FILE,
+                      node_countries: Dict[Tuple[str, int], str] = None) -> Optional[str]:
+        """按国家过滤节点并写入 ip.txt（每行 "IP 端口"），没有保留节点时返回 None"""
+        if not nodes:
+            logger.error(f"没有有效的节点来生成 {path}")
+            return None
+        start_time = time.time()
+        kept = self.select(nodes, node_countries)
+        if not kept:
+            logger.error(f"没有有效的节点来生成 {path}")
+            return None
+        write_text_atomic(path, "".join(f"{ip} {port}\n" for ip, port in kept))
+        logger.info(f"生成 {path}，包含 {len(kept)} 个节点 (耗时: {time.time() - start_time:.2f} 秒)")
+        return path
+
+    def read_result_countries(self, csv_file: str,
+                              node_countries: Dict[Tuple[str, int], str] = None) -> List[Node]:
+        """读取测速结果 ip.csv 的 (ip, port, 国家)；国家依次取 node_countries、国际代码列，都没有时才查询 GeoIP"""
+        node_countries = node_countries or {}
+        rows = []
+        with open(csv_file, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            code_col = header.index('国际代码') if '国际代码' in header else -1
+            for row in reader:
+                if len(row) < 2:
+                    continue
+                ip, port = row[0], row[1]
+                if not is_valid_ip(ip) or not is_valid_port(port):
+                    continue
+                country = node_countries.get((ip, int(port)), '')
+                if not country and 0 <= code_col < len(row) and row[code_col].strip().upper() in COUNTRY_LABELS:
+                    country = row[code_col].strip().upper()
+                rows.append((ip, int(port), country))
+        missing = [ip for ip, _, country in rows if not country]
+        if missing:
+            logger.info(f"{len(rows) - len(missing)} 个节点沿用已有国家代码，{len(missing)} 个节点查询 GeoIP")
+            looked_up = dict(zip(missing, self.lookup_countries(missing)))
+            rows = [(ip, port, country or looked_up.get(ip, '')) for ip, port, country in rows]
+            self.flush_country_cache()
+        return rows
+
+    def write_ips_file(self, csv_file: str, path: str = IPS_FILE,
+                       node_countries: Dict[Tuple[str, int], str] = None) -> Optional[int]:
+        """由测速结果生成带国家标签的 ips.txt（"IP:端口#🇯🇵 日本-1"），返回节点数；没有目标国家节点时返回 None"""
+        start_time = time.time()
+        if not os.path.exists(csv_file):
+            logger.info(f"{csv_file} 不存在")
+            return None
+        try:
+            rows = self.read_result_countries(csv_file, node_countries)
+        except Exception as e:
+            logger.error(f"无法读取 {csv_file}: {e}")
+            return None
+        final_nodes = [(ip, port, country) for ip, port, country in rows if self.is_desired(country)]
+        if not final_nodes:
+            logger.info(f"没有符合条件的节点（DESIRED_COUNTRIES: {sorted(self.desired_countries)}）")
+            return None
+        country_count = defaultdict(int)
+        labeled_nodes = []
+        for ip, port, country in sorted(final_nodes, key=lambda x: x[2] or 'ZZ'):
+            country_count[country] += 1
+            emoji, name = COUNTRY_LABELS.get(country, ('🌐', '未知'))
+            labeled_nodes.append((ip, port, f"{emoji} {name}-{country_count[country]}"))
+
+        write_text_atomic(path, "".join(f"{ip}:{port}#{label}\n" for ip, port, label in labeled_nodes), "utf-8-sig")
+        logger.info(f"生成 {path}，{len(labeled_nodes)} 个数据节点 (耗时: {time.time() - start_time:.2f} 秒)")
+        logger.info(f"国家分布: {dict(country_count)}")
+        return len(labeled_nodes)
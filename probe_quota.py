@@ -0,0 +1,63 @@
+"""按国家配额分波测速：候选按预期质量排序，每个国家只测到通过速度下限的节点数达到配额为止
+
+每一波为尚未满额的国家各取 "剩余配额 × 波次系数" 个排名最前的候选交给现有的测速流程（iptest 或内置引擎），
+根据结果更新各国家已通过的节点数，满额的国家不再测速。预期质量取自测速历史汇总或上一次 ip.csv：
+速度 EWMA × 成功率；没有记录的节点按恰好达到速度下限估计，从未成功的节点排在最后。
+"""
+import logging
+import math
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WAVE_FACTOR = 1.5
+
+Node = Tuple[str, int]
+
+def expected_quality(state: Optional[Dict], speed_limit: float) -> float:
+    if not state or not state.get('tests'):
+        return speed_limit
+    if not state.get('successes') or state.get('ewma_speed') is None:
+        return -float(state['tests'])
+    return state['ewma_speed'] * state['successes'] / state['tests']
+
+def build_queues(candidates: List[Node], node_countries: Dict[Node, str], states: Dict[Node, Dict],
+                 speed_limit: float, countries: List[str] = None) -> Dict[str, List[Node]]:
+    """按国家分组并按预期质量从高到低排序（同分保持原顺序）；countries 非空时只保留这些国家"""
+    queues = defaultdict(list)
+    for key in dict.fromkeys(candidates):
+        country = node_countries.get(key, '')
+        if countries and country not in countries:
+            continue
+        queues[country].append(key)
+    for country, nodes in queues.items():
+        nodes.sort(key=lambda key: expected_quality(states.get(key), speed_limit), reverse=True)
+    return dict(queues)
+
+def next_wave(queues: Dict[str, List[Node]], passed: Dict[str, int], quota: int,
+              factor: float = WAVE_FACTOR) -> List[Node]:
+    """从每个未满额国家的队列头部取出下一波要测速的节点（会修改 queues）"""
+    wave = []
+    for country, nodes in queues.items():
+        remaining = quota - passed.get(country, 0)
+        if remaining <= 0 or not nodes:
+            continue
+        take = max(1, math.ceil(remaining * factor))
+        wave.extend(nodes[:take])
+        del nodes[:take]
+    return wave
+
+def requeue(queues: Dict[str, List[Node]], nodes: List[Node], node_countries: Dict[Node, str]):
+    """把本波取出但没有实际测速的节点按原顺序放回各自国家队列的头部"""
+    by_country = defaultdict(list)
+    for key in nodes:
+        by_country[node_countries.get(key, '')].append(key)
+    for country, keys in by_country.items():
+        queues.setdefault(country, [])[:0] = keys
+
+def log_progress(wave_no: int, wave: List[Node], queues: Dict[str, List[Node]], passed: Dict[str, int], quota: int):
+    full = sorted(country or 'UNKNOWN' for country in queues if passed.get(country, 0) >= quota)
+    skipped = sum(len(nodes) for country, nodes in queues.items() if passed.get(country, 0) >= quota)
+    logger.info(f"配额测速第 {wave_no} 波: 测速 {len(wave)} 个节点，已满额国家 {full or '无'}，"
+                f"满额国家跳过剩余 {skipped} 个候选，各国家通过数 {dict(passed)}")
@@ -0,0 +1,65 @@
+"""自适应复测调度：根据节点的历史稳定性与速度距下限的远近，为每个节点确定复测间隔
+
+节点状态取自测速历史 (node_history 汇总) ，没有历史记录的节点用该节点上一次的测速结果与测速时间作为种子。
+速度 EWMA 距 speedlimit 越远、方差越小，结论越确定，复测间隔越长（MIN_INTERVAL 到 MAX_INTERVAL 之间按
+(1 + z)^2 增长，z = |速度 - 下限| / 标准差）；从未成功的节点按测试次数指数退避。
+到期节点按 "超期程度 / (1 + z)" 排序，探测预算优先花在排名最不确定的节点上，新节点排在最前。
+"""
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 3600
+MAX_INTERVAL = 7 * 86400
+SPEED_NOISE_FLOOR = 2.0  # MB/s，样本较少时假定的最小标准差
+
+Node = Tuple[str, int]
+
+def seed_states(results: Dict[Node, Tuple[Optional[float], float]]) -> Dict[Node, Dict]:
+    """把上一次结果 {(ip, port): (速度, 测速时间)} 转为与历史汇总相同字段的节点状态（视为一次成功的测速）"""
+    return {key: {'tests': 1, 'successes': 1, 'ewma_speed': speed, 'ewma_speed_var': None, 'last_seen': tested_at}
+            for key, (speed, tested_at) in results.items() if speed is not None}
+
+def retest_interval(state: Optional[Dict], speed_limit: float,
+                    min_interval: float = MIN_INTERVAL, max_interval: float = MAX_INTERVAL) -> Tuple[float, float]:
+    """返回 (复测间隔秒数, 确定度 z)；没有状态的节点间隔为 0"""
+    if not state or not state.get('tests'):
+        return 0.0, 0.0
+    tests, successes = state['tests'], state.get('successes') or 0
+    if not successes or state.get('ewma_speed') is None:
+        # 从未测速成功：每多失败一次，间隔翻倍
+        return min(max_interval, min_interval * 2 ** min(tests - 1, 16)), float(tests)
+    std = max(math.sqrt(state.get('ewma_speed_var') or 0.0), SPEED_NOISE_FLOOR / math.sqrt(successes))
+    z = abs(state['ewma_speed'] - speed_limit) / std
+    z *= successes / tests  # 时好时坏的节点结论不可靠
+    return min(max_interval, max(min_interval, min_interval * (1 + z) ** 2)), z
+
+def plan_retests(candidates: List[Node], states: Dict[Node, Dict], speed_limit: float, now: float,
+                 budget: int = 0, min_interval: float = MIN_INTERVAL,
+                 max_interval: float = MAX_INTERVAL) -> Tuple[List[Node], List[Node]]:
+    """返回 (本轮需要测速的节点, 沿用上次结果的节点)；budget > 0 时最多测速 budget 个节点"""
+    due, reuse = [], []
+    new = deferred = 0
+    for key in dict.fromkeys(candidates):
+        state = states.get(key)
+        interval, z = retest_interval(state, speed_limit, min_interval, max_interval)
+        if not interval:
+            new += 1
+            due.append((math.inf, key))
+            continue
+        age = now - (state.get('last_seen') or 0)
+        if age >= interval:
+            due.append((age / interval / (1 + z), key))
+        else:
+            reuse.append(key)
+    due.sort(key=lambda item: item[0], reverse=True)
+    probe = [key for _, key in due]
+    if budget > 0 and len(probe) > budget:
+        deferred = len(probe) - budget
+        reuse.extend(probe[budget:])
+        probe = probe[:budget]
+    logger.info(f"复测调度: {len(candidates)} 个候选，{len(probe)} 个测速（其中新节点 {min(new, len(probe))} 个），"
+                f"{len(reuse) - deferred} 个未到复测时间，{deferred} 个超出探测预算推迟到下一轮")
+    return probe, reuse
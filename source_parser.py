@@ -0,0 +1,406 @@
+"""批量解析数据源文本为 (ip, port, country) 节点记录
+
+表结构（分隔符、IP/端口/国家列）对整份内容只推断一次。规整的 CSV 按列批量校验与转换，
+其余内容用一次 findall 逐行处理；IPv4 用整数范围检查代替每次重新编译的正则，国家标准化结果按字段值缓存。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from itertools import repeat
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DELIMITERS = [',', ';', '\t', ' ', '|', '-']
+IP_HEADER_NAMES = {'ip', 'address', 'ip_address', 'ip地址', 'ip address'}
+PORT_HEADER_NAMES = {'port', '端口', 'port_number', '端口号'}
+COUNTRY_HEADER_NAMES = {'country', '国家', 'country_code', 'countrycode', '国际代码', 'nation', 'location',
+                        'region', 'geo', 'area', 'cc', 'iso_code', 'country_name', 'dc city', 'dc_city',
+                        'city', 'dc location', 'dc_location'}
+JSON_COUNTRY_KEYS = ['country', 'countryCode', 'country_code', 'location', 'nation', 'region', 'geo', 'area',
+                     'dc city', 'dc_city', 'city', 'dc location', 'dc_location']
+SCHEMA_SAMPLE_LINES = 20
+SCHEMA_CACHE_NAME = "schemas.json"
+SCHEMA_CACHE_FILE = os.path.join(".source_cache", SCHEMA_CACHE_NAME)
+
+IPV6_PATTERN = re.compile(r'^(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}$')
+IP_PORT_PATTERN = re.compile(
+    r'(((\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|\[(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}\]|(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}))[ :,\t](\d{1,5})'
+)
+IPV4_OCTET = r'(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)'
+# 每行产生一个元组：(整行, IPv4, 端口, "")，或不符合常见形式时为 ("", "", "", 原始行)
+ROW_PATTERN = re.compile(
+    rf'^[^\S\n]*((?:({IPV4_OCTET}(?:\.{IPV4_OCTET}){{3}})[ :,\t]([0-9]{{1,5}}))[^\n]*)$|^([^\n]*)$',
+    re.MULTILINE
+)
+
+IP_LIKE_PATTERN = re.compile(r'\d{1,3}(?:\.\d{1,3}){3}|[0-9a-fA-F]{0,4}:[0-9a-fA-F]{0,4}:')
+SHAPE_PATTERN = re.compile(r'(\d+)|[^\W\d_]+')
+
+_schema_lock = threading.Lock()
+_schemas: Optional[Dict[str, Dict]] = None
+
+def is_ipv4_octet(part: str) -> bool:
+    """1-3 位 ASCII 数字且不大于 255（允许前导零，与原正则一致）"""
+    return 0 < len(part) <= 3 and part.isascii() and part.isdigit() and int(part) <= 255
+
+def is_valid_ipv4(ip: str) -> bool:
+    parts = ip.split('.')
+    return len(parts) == 4 and all(is_ipv4_octet(part) for part in parts)
+
+def is_valid_ip(ip: str) -> bool:
+    return is_valid_ipv4(ip) or bool(IPV6_PATTERN.match(ip.strip('[]')))
+
+def is_valid_port(port: str) -> bool:
+    try:
+        port_num = int(port)
+        return 0 <= port_num <= 65535
+    except (ValueError, TypeError):
+        return False
+
+def detect_delimiter(lines: List[str]) -> str:
+    sample_lines = lines[:5]
+    counts = {d: 0 for d in DELIMITERS}
+    for line in sample_lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        for d in DELIMITERS:
+            if d in line:
+                counts[d] += line.count(d)
+    max_count = max(counts.values())
+    if max_count > 0:
+        delimiter = max(counts, key=counts.get)
+        logger.info(f"检测到分隔符: '{delimiter}'")
+        return delimiter
+    logger.warning("无法检测分隔符，假定为逗号")
+    return ','
+
+def find_country_column(lines: List[str], delimiter: str, standardize: Callable[[str], str]) -> Tuple[int, int, int]:
+    """在前 SCHEMA_SAMPLE_LINES 行中逐列统计可识别为国家的字段，匹配率不低于 30% 的列作为国家列"""
+    country_col = -1
+    ip_col, port_col = 0, 1
+    sample_lines = [line for line in lines[:SCHEMA_SAMPLE_LINES] if line.strip() and not line.startswith('#')]
+    if not sample_lines:
+        return ip_col, port_col, country_col
+
+    col_matches = defaultdict(int)
+    total_rows = len(sample_lines)
+    for line in sample_lines:
+        for col, field in enumerate(line.split(delimiter)):
+            if standardize(field.strip()):
+                col_matches[col] += 1
+
+    if col_matches:
+        for col, count in col_matches.items():
+            logger.info(f"列 {col + 1}: 匹配 {count} 行 (匹配率: {count / total_rows:.2%})")
+        country_col = max(col_matches, key=col_matches.get)
+        match_rate = col_matches[country_col] / total_rows
+        if match_rate >= 0.3:
+            logger.info(f"选择国家列: 第 {country_col + 1} 列 (匹配率: {match_rate:.2%})")
+        else:
+            country_col = -1
+    else:
+        logger.info("未找到任何匹配国家代码、城市或 IATA 代码列")
+
+    return ip_col, port_col, country_col
+
+def infer_schema(lines: List[str], standardize: Callable[[str], str]) -> Tuple[str, int, int, int, int]:
+    """推断分隔符与列位置，返回 (分隔符, ip 列, 端口列, 国家列, 数据起始行)"""
+    delimiter = detect_delimiter(lines) or ','
+    ip_col, port_col, country_col = 0, 1, -1
+    start = 0
+    if lines and lines[0].strip() and not lines[0].startswith('#'):
+        header = lines[0].strip().split(delimiter)
+        logger.info(f"检测到表头: {header}")
+        for idx, col in enumerate(header):
+            col_lower = col.strip().lower()
+            if col_lower in IP_HEADER_NAMES:
+                ip_col = idx
+            elif col_lower in PORT_HEADER_NAMES:
+                port_col = idx
+            elif col_lower in COUNTRY_HEADER_NAMES:
+                country_col = idx
+        if country_col != -1:
+            logger.info(f"检测到国家列: 第 {country_col + 1} 列 (字段名: {header[country_col]})")
+            start = 1
+        else:
+            logger.info("表头中不包含国家相关列，尝试逐行逐列搜索")
+            ip_col, port_col, country_col = find_country_column(lines, delimiter, standardize)
+            if country_col >= 0:
+                logger.info(f"通过逐行搜索确定国家列: 第 {country_col + 1} 列")
+            else:
+                logger.info("无法确定国家列，设为 -1")
+    return delimiter, ip_col, port_col, country_col, start
+
+def configure_schema_cache(path: str):
+    """设置表结构缓存文件路径（空字符串表示只在内存中缓存）"""
+    global SCHEMA_CACHE_FILE, _schemas
+    with _schema_lock:
+        SCHEMA_CACHE_FILE = path
+        _schemas = None
+
+def _load_schemas() -> Dict[str, Dict]:
+    global _schemas
+    if _schemas is None:
+        _schemas = {}
+        if SCHEMA_CACHE_FILE and os.path.exists(SCHEMA_CACHE_FILE):
+            try:
+                with open(SCHEMA_CACHE_FILE, "r", encoding="utf-8") as f:
+                    _schemas = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"表结构缓存损坏，将重新推断: {e}")
+    return _schemas
+
+def get_schema(source: str) -> Optional[Dict]:
+    """返回该来源缓存的表结构（delimiter、ip/port/country 列等），没有则返回 None"""
+    with _schema_lock:
+        schema = _load_schemas().get(source)
+        return dict(schema) if schema else None
+
+def _store_schema(source: str, schema: Dict):
+    with _schema_lock:
+        schemas = _load_schemas()
+        if schemas.get(source) == schema:
+            return
+        schemas[source] = schema
+        if not SCHEMA_CACHE_FILE:
+            return
+        try:
+            os.makedirs(os.path.dirname(SCHEMA_CACHE_FILE) or ".", exist_ok=True)
+            temp_path = f"{SCHEMA_CACHE_FILE}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(schemas, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, SCHEMA_CACHE_FILE)
+        except OSError as e:
+            logger.warning(f"无法写入表结构缓存: {e}")
+
+def _drop_schema(source: str):
+    with _schema_lock:
+        _load_schemas().pop(source, None)
+
+def header_fingerprint(first_line: str) -> str:
+    """首行指纹：表头按原文计算；首行已是数据时按结构计算（数字串记为 0、字母串记为 a），
+    这样每天内容变化不会使无表头来源的缓存失效，而列名或分隔符变化会。
+    """
+    line = first_line.strip()
+    if IP_LIKE_PATTERN.search(line):
+        line = SHAPE_PATTERN.sub(lambda m: '0' if m.group(1) else 'a', line)
+    return hashlib.sha1(line.encode('utf-8')).hexdigest()[:16]
+
+def _parse_json(content: str, standardize: Callable[[str], str]) -> List[Tuple[str, int, str]]:
+    """内容为 JSON 时解析节点；不是 JSON 返回 None"""
+    stripped = content.lstrip()
+    if not stripped or stripped[0] not in '[{':
+        return None
+    try:
+        data = json.loads(stripped)
+    except json.JSONDecodeError as e:
+        logger.info(f"JSON 解析失败: {e}")
+        return None
+    if isinstance(data, dict):
+        data = [data]
+    nodes = []
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        ip = item.get('ip', '') or item.get('IP Address', '') or item.get('ip_address', '')
+        port = item.get('port', '') or item.get('Port', '')
+        country = ''
+        for key in JSON_COUNTRY_KEYS:
+            if item.get(key, ''):
+                country = standardize(item[key])
+                break
+        if isinstance(ip, str) and is_valid_ip(ip) and is_valid_port(str(port)):
+            nodes.append((ip, int(port), country))
+    logger.info(f"从 JSON 解析出 {len(nodes)} 个节点，其中 {sum(1 for _, _, c in nodes if c)} 个有国家信息")
+    return list(dict.fromkeys(nodes))
+
+def _leading_ip_port(line: str) -> Tuple[str, str]:
+    """用完整正则匹配行首的 "IP<分隔>端口"（含 IPv6、方括号形式），返回 (ip, 端口字符串)，不匹配返回 None"""
+    match = IP_PORT_PATTERN.match(line)
+    if match is None:
+        return None
+    server = match.group(1).strip('[]')
+    if not is_valid_ip(server):
+        return None
+    return server, match.group(4)
+
+def parse_nodes(content: str, standardize: Callable[[str], str],
+                source: str = None) -> Tuple[List[Tuple[str, int, str]], int]:
+    """解析 JSON 或分隔符文本，返回 (去重后的节点列表, 无效行数)
+
+    给出 source 时按 (来源, 首行指纹) 复用持久化的表结构，跳过分隔符检测与国家列搜索；
+    指纹变化或缓存的表结构解析不出任何节点时重新推断并更新缓存。
+    不记录编码：误检测的编码一旦持久化，会在之后每次运行中继续生效。
+    """
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    lines = content.splitlines()
+    if not lines:
+        logger.error("内容为空")
+        return [], 0
+    logger.info(f"数据源样本 (前 5 行): {lines[:5]}")
+
+    nodes = _parse_json(content, standardize)
+    if nodes is not None:
+        return nodes, 0
+
+    fingerprint = header_fingerprint(lines[0]) if source else ''
+    schema = get_schema(source) if source else None
+    if schema and schema.get('fingerprint') == fingerprint:
+        layout = (schema['delimiter'], schema['ip_col'], schema['port_col'], schema['country_col'], schema['start'])
+        logger.info(f"使用缓存的表结构: {source} (分隔符 '{layout[0]}'，国家列 {layout[3] + 1 if layout[3] >= 0 else '无'})")
+        nodes, invalid = _parse_with_layout(lines, layout, standardize)
+        if not nodes and invalid:
+            logger.info(f"缓存的表结构未解析出节点，重新推断: {source}")
+            _drop_schema(source)
+            schema = None
+    else:
+        if schema:
+            logger.info(f"来源首行已变化，重新推断表结构: {source}")
+        schema = None
+    if schema is None:
+        layout = infer_schema(lines, standardize)
+        nodes, invalid = _parse_with_layout(lines, layout, standardize)
+    if source and nodes:
+        delimiter, ip_col, port_col, country_col, start = layout
+        _store_schema(source, {
+            'fingerprint': fingerprint, 'delimiter': delimiter,
+            'ip_col': ip_col, 'port_col': port_col, 'country_col': country_col, 'start': start,
+            'updated_at': (schema or {}).get('updated_at') or int(time.time()),
+        })
+    del lines
+
+    logger.info(f"解析出 {len(nodes)} 个节点，其中 {sum(map(bool, map(itemgetter(2), nodes)))} 个有国家信息")
+    unique_nodes = list(dict.fromkeys(nodes))
+    logger.info(f"去重后: {len(unique_nodes)} 个节点")
+    return unique_nodes, invalid
+
+def _parse_with_layout(lines: List[str], layout: Tuple[str, int, int, int, int],
+                       standardize: Callable[[str], str]) -> Tuple[List[Tuple[str, int, str]], int]:
+    """按给定表结构解析：先尝试按列批量解析，数据不规整时回退到逐行解析"""
+    delimiter, ip_col, port_col, country_col, start = layout
+    data_lines = lines[start:]
+    while data_lines and not data_lines[-1].strip():
+        data_lines.pop()
+
+    country_memo: Dict[str, str] = {}
+    nodes = None
+    if ip_col == 0 and port_col == 1:
+        nodes = _parse_columnar(data_lines, delimiter, country_col, standardize, country_memo)
+    if nodes is not None:
+        logger.info(f"按列批量解析 {len(nodes)} 行")
+        return nodes, 0
+    return _parse_rows('\n'.join(data_lines), delimiter, ip_col, port_col, country_col, standardize, country_memo)
+
+def _memoize_countries(values: Iterable[str], memo: Dict[str, str], standardize: Callable[[str], str]):
+    """对尚未缓存的不同字段值各调用一次 standardize"""
+    for value in set(values).difference(memo):
+        memo[value] = standardize(value.strip())
+
+def _parse_columnar(lines: List[str], delimiter: str, country_col: int,
+                    standardize: Callable[[str], str], memo: Dict[str, str]) -> List[Tuple[str, int, str]]:
+    """整块按列解析：要求每行都是 "IPv4<分隔符>端口<分隔符>..." 且字段数相同，否则返回 None
+
+    校验全部在列上批量完成：字段数用 str.count 逐行计数，IPv4 只校验所有不同的八位组字符串，
+    端口只校验所有不同的端口字符串，国家标准化也只对每列的不同取值各做一次。
+    满足这些条件的行在逐行解析中必然走同一条路径，因此结果与 _parse_rows 相同。
+    """
+    if not lines:
+        return None
+    ncols = lines[0].count(delimiter) + 1
+    if ncols < 2 or set(map(str.count, lines, repeat(delimiter))) != {ncols - 1}:
+        return None
+    flat = delimiter.join(lines).split(delimiter)
+    ips = flat[0::ncols]
+    if set(map(str.count, ips, repeat('.'))) != {3}:
+        return None
+    if not all(is_ipv4_octet(part) for part in set('.'.join(ips).split('.'))):
+        return None
+    port_values = {}
+    for value in set(flat[1::ncols]):
+        if not (len(value) <= 5 and value.isascii() and value.isdigit()) or int(value) > 65535:
+            return None
+        port_values[value] = int(value)
+    ports = list(map(port_values.__getitem__, flat[1::ncols]))
+
+    if 0 <= country_col < ncols:
+        column = flat[country_col::ncols]
+        _memoize_countries(column, memo, standardize)
+        countries = list(map(memo.__getitem__, column))
+    else:
+        countries = [''] * len(ips)
+    # 国家列无法识别的行按字段顺序找第一个可识别的字段；IP 与端口列只含数字和点，不可能是国家
+    missing = [i for i, country in enumerate(countries) if not country] if '' in countries else []
+    for col in range(2, ncols):
+        if not missing:
+            break
+        column = flat[col::ncols]
+        values = [column[i] for i in missing]
+        _memoize_countries(values, memo, standardize)
+        still_missing = []
+        for i, value in zip(missing, values):
+            country = memo[value]
+            if country:
+                countries[i] = country
+            else:
+                still_missing.append(i)
+        missing = still_missing
+    return list(zip(ips, ports, countries))
+
+def _parse_rows(content: str, delimiter: str, ip_col: int, port_col: int, country_col: int,
+                standardize: Callable[[str], str], memo: Dict[str, str]) -> Tuple[List[Tuple[str, int, str]], int]:
+    """逐行解析任意格式，返回 (节点列表, 无效行数)
+
+    整份文本只做一次 ROW_PATTERN.findall：行首为合法 IPv4 + 端口的行由正则在 C 层完成切分与范围校验，
+    其余行（IPv6、方括号、注释、字段错位等）回退到完整规则。
+    """
+    min_fields = max(ip_col, port_col, country_col) + 1
+    nodes = []
+    append = nodes.append
+    invalid = 0
+
+    for line, server, port_str, other in ROW_PATTERN.findall(content):
+        if not server:
+            line = other.strip()
+            if not line or line[0] == '#':
+                continue
+            leading = _leading_ip_port(line)
+            fields = line.split(delimiter)
+            if leading is not None:
+                server, port_str = leading
+            else:
+                if len(fields) < min_fields:
+                    invalid += 1
+                    continue
+                server = fields[ip_col].strip('[]')
+                port_str = fields[port_col].strip()
+                if not (is_valid_ip(server) and is_valid_port(port_str)):
+                    invalid += 1
+                    continue
+        else:
+            fields = line.split(delimiter)
+        port = int(port_str)
+        if port > 65535:
+            invalid += 1
+            continue
+        country = ''
+        if 0 <= country_col < len(fields):
+            field = fields[country_col]
+            country = memo.get(field)
+            if country is None:
+                country = memo[field] = standardize(field.strip())
+        if not country:
+            for field in fields:
+                country = memo.get(field)
+                if country is None:
+                    country = memo[field] = standardize(field.strip())
+                if country:
+                    break
+        append((server, port, country))
+    return nodes, invalid
@@ -0,0 +1,69 @@
+"""按网段抽样测速：候选按网络前缀分组，每组先测少数代表节点，只有代表通过的网段才测其余节点
+
+来源中的节点高度聚集（同一 /24 往往有大量 IP 且属于同一数据中心），整段不可用或偏慢时，
+只需测几个代表即可排除整段。代表在组内按地址均匀选取，避免只测到相邻的几个地址。
+"""
+import ipaddress
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+IPV4_PREFIX = 24
+IPV6_PREFIX = 48
+REPRESENTATIVES = 2
+
+Node = Tuple[str, int]
+
+def group_by_prefix(candidates: Iterable[Node], ipv4_prefix: int = IPV4_PREFIX,
+                    ipv6_prefix: int = IPV6_PREFIX) -> Dict[str, List[Node]]:
+    """{网段 CIDR: [(ip, port), ...]}，组内按地址排序；无法解析的地址各自成组"""
+    groups = defaultdict(list)
+    for ip, port in dict.fromkeys(candidates):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            groups[ip].append((ip, port))
+            continue
+        length = ipv4_prefix if address.version == 4 else ipv6_prefix
+        groups[str(ipaddress.ip_network((address, length), strict=False))].append((ip, port))
+    for nodes in groups.values():
+        nodes.sort(key=lambda node: (_address_key(node[0]), node[1]))
+    return dict(groups)
+
+def _address_key(ip: str) -> Tuple[int, int]:
+    try:
+        address = ipaddress.ip_address(ip)
+        return address.version, int(address)
+    except ValueError:
+        return 0, 0
+
+def split_representatives(groups: Dict[str, List[Node]], per_prefix: int = REPRESENTATIVES
+                          ) -> Tuple[List[Node], Dict[str, List[Node]]]:
+    """返回 (各网段的代表节点, {网段: 其余节点})；代表在组内按位置均匀选取"""
+    representatives, remaining = [], {}
+    for prefix, nodes in groups.items():
+        count = min(max(1, per_prefix), len(nodes))
+        if count == 1:
+            picks = {0}
+        else:
+            picks = {round(i * (len(nodes) - 1) / (count - 1)) for i in range(count)}
+        representatives.extend(nodes[i] for i in sorted(picks))
+        remaining[prefix] = [node for i, node in enumerate(nodes) if i not in picks]
+    return representatives, remaining
+
+def live_prefixes(groups: Dict[str, List[Node]], passed: Iterable[Node]) -> Set[str]:
+    """至少有一个节点通过测速的网段"""
+    passed = set(passed)
+    return {prefix for prefix, nodes in groups.items() if any(node in passed for node in nodes)}
+
+def log_report(groups: Dict[str, List[Node]], remaining: Dict[str, List[Node]], live: Set[str],
+               representatives: int, expanded: int):
+    total = sum(len(nodes) for nodes in groups.values())
+    pruned = sum(len(nodes) for prefix, nodes in remaining.items() if prefix not in live)
+    tested = representatives + expanded
+    logger.info(f"网段抽样: {total} 个候选分布在 {len(groups)} 个网段，测速代表 {representatives} 个，"
+                f"{len(live)} 个网段的代表通过，扩展测速 {expanded} 个节点")
+    logger.info(f"网段抽样共测速 {tested}/{total} 个节点，剪除 {len(groups) - len(live)} 个网段中的 {pruned} 个节点 "
+                f"({pruned / total:.0%} 的测速工作量)" if total else "网段抽样: 没有候选节点")
@@ -0,0 +1,173 @@
+"""native_probe 的回环测试：本地监听端口与已关闭端口的延迟探测、采样汇总、ip.csv 输出与下载测速计时"""
+import csv
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import native_probe  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def closed_port() -> int:
+    """绑定后立即关闭，得到一个当前没有监听的本地端口"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class Listener:
+    """本地 TCP 监听端口，接受连接后按 handler 处理（默认立即关闭）"""
+
+    def __init__(self, handler=None):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.handler = handler
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                if self.handler:
+                    self.handler(conn)
+
+    def close(self):
+        self.sock.close()
+
+def http_handler(body: bytes, delay: float = 0.0, cf_ray: str = "8f00000000000000-HKG"):
+    def handle(conn: socket.socket):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return
+            request += chunk
+        time.sleep(delay)
+        head = (f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\nCF-RAY: {cf_ray}\r\n"
+                f"Connection: close\r\n\r\n").encode("ascii")
+        conn.sendall(head + body)
+    return handle
+
+class SummarizeSamplesTest(unittest.TestCase):
+    def test_loss_median_jitter(self):
+        result = native_probe.summarize_samples("127.0.0.1", 443, [10.0, None, 20.0, 14.0])
+        self.assertEqual(result['samples'], 4)
+        self.assertEqual(result['received'], 3)
+        self.assertAlmostEqual(result['loss'], 0.25)
+        self.assertEqual(result['min'], 10.0)
+        self.assertEqual(result['median'], 14.0)
+        # 相邻成功采样差值 |20-10|、|14-20| 的平均
+        self.assertAlmostEqual(result['jitter'], 8.0)
+        self.assertTrue(result['tls'])
+
+    def test_single_sample_has_zero_jitter(self):
+        result = native_probe.summarize_samples("127.0.0.1", 80, [5.0])
+        self.assertEqual((result['loss'], result['median'], result['jitter']), (0.0, 5.0, 0.0))
+        self.assertFalse(result['tls'])
+
+    def test_all_lost(self):
+        for rtts in ([None, None], []):
+            result = native_probe.summarize_samples("127.0.0.1", 80, rtts)
+            self.assertEqual(result['received'], 0)
+            self.assertEqual(result['loss'], 1.0)
+            self.assertIsNone(result['median'])
+            self.assertIsNone(result['jitter'])
+
+class ProbeLatencyTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = Listener()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_listener_and_closed_port(self):
+        dead = closed_port()
+        results = native_probe.probe_latency(
+            [("127.0.0.1", dead), ("127.0.0.1", self.listener.port)], concurrency=2, samples=3, timeout=1.0)
+        self.assertEqual([r['port'] for r in results], [self.listener.port, dead])  # 可达节点排在前面
+        alive, closed = results
+        self.assertEqual((alive['received'], alive['loss']), (3, 0.0))
+        self.assertGreaterEqual(alive['median'], alive['min'])
+        self.assertGreaterEqual(alive['jitter'], 0.0)
+        self.assertLess(alive['median'], 1000.0)
+        self.assertEqual((closed['received'], closed['loss'], closed['median']), (0, 1.0, None))
+
+    def test_concurrency_limit_covers_all_nodes(self):
+        nodes = [("127.0.0.1", self.listener.port)] * 20 + [("127.0.0.1", closed_port())]
+        results = native_probe.probe_latency(nodes, concurrency=4, samples=1, timeout=1.0)
+        self.assertEqual(len(results), len(nodes))
+        self.assertEqual(sum(1 for r in results if r['received']), 20)
+
+class WriteResultsCsvTest(unittest.TestCase):
+    def test_columns_match_ip_csv(self):
+        results = [
+            dict(native_probe.summarize_samples("1.1.1.1", 443, [12.4, 13.0]), speed=25.456, colo="HKG"),
+            native_probe.summarize_samples("2.2.2.2", 80, [30.0]),
+            native_probe.summarize_samples("3.3.3.3", 443, [None]),
+        ]
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "ip.csv")
+            count = native_probe.write_results_csv(path, results, {("1.1.1.1", 443): "HK"}, {"HK": "中国香港"})
+            with open(path, "r", encoding="utf-8-sig", newline="") as f:
+                rows = list(csv.reader(f))
+        self.assertEqual(count, 2)
+        self.assertEqual(rows[0], native_probe.CSV_HEADER)
+        self.assertEqual(rows[1], ["1.1.1.1", "443", "true", "HKG", "", "HK", "中国香港", "", "13 ms", "25.46"])
+        self.assertEqual(rows[2], ["2.2.2.2", "80", "false", "", "", "", "", "", "30 ms", ""])
+        self.assertTrue(all(len(row) == len(native_probe.CSV_HEADER) for row in rows))
+
+    def test_header_matches_iptest_output(self):
+        path = os.path.join(ROOT, "ip.csv")
+        if not os.path.exists(path):
+            self.skipTest("仓库中没有 ip.csv")
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            header = next(csv.reader(f))
+        self.assertEqual(header, native_probe.CSV_HEADER)
+
+class MeasureDownloadTest(unittest.TestCase):
+    def test_download_speed_and_colo(self):
+        body = b"x" * (1024 * 1024)
+        listener = Listener(http_handler(body))
+        try:
+            result = native_probe.measure_download("127.0.0.1", listener.port, "example.com/__down", tls=False,
+                                                   duration=5, timeout=2)
+        finally:
+            listener.close()
+        self.assertEqual(result['error'], "")
+        self.assertEqual(result['bytes'], len(body))
+        self.assertEqual(result['colo'], "HKG")
+        self.assertGreater(result['speed'], 0)
+
+    def test_body_in_header_chunk_is_timed(self):
+        # 整个正文与响应头一起在延迟之后到达：速度不能超过 正文大小 / 延迟
+        body = b"x" * (64 * 1024)
+        delay = 0.3
+        listener = Listener(http_handler(body, delay=delay))
+        try:
+            result = native_probe.measure_download("127.0.0.1", listener.port, "example.com/__down", tls=False,
+                                                   duration=5, timeout=2)
+        finally:
+            listener.close()
+        self.assertEqual(result['error'], "")
+        self.assertLessEqual(result['speed'], len(body) / delay / (1024 * 1024))
+
+    def test_closed_port_reports_error(self):
+        result = native_probe.measure_download("127.0.0.1", closed_port(), "example.com/", tls=False, timeout=1)
+        self.assertIsNone(result['speed'])
+        self.assertTrue(result['error'])
+
+if __name__ == "__main__":
+    unittest.main()
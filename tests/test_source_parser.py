@@ -0,0 +1,178 @@
+"""source_parser.parse_nodes 与原逐行解析器 (extract_ip_ports_from_content) 的结果一致性测试
+
+原实现按行用正则匹配并对每个字段调用 standardize_country，这里保留一份精简副本作为参照，
+对各种常见来源格式比较两者输出的节点列表（含顺序与国家）。
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import unittest
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import source_parser  # noqa: E402
+from countries import standardize_country  # noqa: E402
+
+LEGACY_IP_PORT_PATTERN = re.compile(
+    r'(((\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|\[(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}\]|(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}))[ :,\t](\d{1,5})'
+)
+LEGACY_IPV4_PATTERN = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
+LEGACY_IPV6_PATTERN = re.compile(r'^(?:[0-9a-fA-F]{0,4}:){1,7}[0-9a-fA-F]{0,4}$')
+LEGACY_COUNTRY_HEADERS = ['country', '国家', 'country_code', 'countrycode', '国际代码', 'nation', 'location', 'region',
+                          'geo', 'area', 'Country', 'cc', 'iso_code', 'country_name', 'dc city', 'dc_city', 'city',
+                          'dc location', 'dc_location']
+
+def legacy_is_valid_ip(ip: str) -> bool:
+    return bool(LEGACY_IPV4_PATTERN.match(ip) or LEGACY_IPV6_PATTERN.match(ip.strip('[]')))
+
+def legacy_find_country_column(lines, delimiter, standardize):
+    sample_lines = [line for line in lines[:20] if line.strip() and not line.startswith('#')]
+    if not sample_lines:
+        return 0, 1, -1
+    col_matches = defaultdict(int)
+    for line in sample_lines:
+        for col, field in enumerate(line.split(delimiter)):
+            if standardize(field.strip()):
+                col_matches[col] += 1
+    if not col_matches:
+        return 0, 1, -1
+    country_col = max(col_matches, key=col_matches.get)
+    return 0, 1, country_col if col_matches[country_col] / len(sample_lines) >= 0.3 else -1
+
+def legacy_find_country(fields, country_col, standardize):
+    country = ''
+    if country_col != -1 and country_col < len(fields):
+        country = standardize(fields[country_col].strip())
+    if not country:
+        for field in fields:
+            country = standardize(field.strip())
+            if country:
+                break
+    return country
+
+def legacy_parse(content: str, standardize):
+    """原 ip-filter-speedtest-api.py 中 extract_ip_ports_from_content 的解析逻辑（去掉日志）"""
+    pairs = []
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    lines = content.splitlines()
+    if not lines:
+        return []
+    try:
+        data = json.loads(content)
+        for item in data:
+            ip = item.get('ip', '') or item.get('IP Address', '') or item.get('ip_address', '')
+            port = item.get('port', '') or item.get('Port', '')
+            country = standardize(next((item[key] for key in source_parser.JSON_COUNTRY_KEYS if item.get(key, '')), ''))
+            if legacy_is_valid_ip(ip) and source_parser.is_valid_port(str(port)):
+                pairs.append((ip, int(port), country))
+        return list(dict.fromkeys(pairs))
+    except json.JSONDecodeError:
+        pass
+
+    delimiter = source_parser.detect_delimiter(lines)
+    ip_col, port_col, country_col = 0, 1, -1
+    lines_to_process = lines
+    if lines and lines[0].strip() and not lines[0].startswith('#'):
+        header = lines[0].strip().split(delimiter)
+        for idx, col in enumerate(header):
+            col_lower = col.strip().lower()
+            if col_lower in ['ip', 'address', 'ip_address', 'ip地址', 'ip address']:
+                ip_col = idx
+            elif col_lower in ['port', '端口', 'port_number', '端口号']:
+                port_col = idx
+            elif col_lower in LEGACY_COUNTRY_HEADERS:
+                country_col = idx
+        if country_col != -1:
+            lines_to_process = lines[1:]
+        else:
+            ip_col, port_col, country_col = legacy_find_country_column(lines, delimiter, standardize)
+
+    for line in lines_to_process:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(delimiter)
+        match = LEGACY_IP_PORT_PATTERN.match(line)
+        if match:
+            port = match.group(4)
+            if source_parser.is_valid_port(port):
+                pairs.append((match.group(1).strip('[]'), int(port), legacy_find_country(fields, country_col, standardize)))
+            continue
+        if len(fields) < max(ip_col, port_col, country_col) + 1:
+            continue
+        server, port_str = fields[ip_col].strip('[]'), fields[port_col].strip()
+        country = legacy_find_country(fields, country_col, standardize)
+        if legacy_is_valid_ip(server) and source_parser.is_valid_port(port_str):
+            pairs.append((server, int(port_str), country))
+    return list(dict.fromkeys(pairs))
+
+def random_ip(rng: random.Random) -> str:
+    return f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+def build_sources():
+    rng = random.Random(7)
+    countries = ["HK", "JP", "SG", "US", "Tokyo", "Hong Kong", "LAX", "unknown", ""]
+    rows = [(random_ip(rng), rng.choice((443, 2053, 8443)), rng.choice(countries)) for _ in range(300)]
+    rows += rows[:20]  # 重复节点
+    sources = {
+        "csv_header": "ip,port,country\n" + "\n".join(f"{ip},{port},{c}" for ip, port, c in rows),
+        "csv_crlf": "IP地址,端口,国家\r\n" + "\r\n".join(f"{ip},{port},{c}" for ip, port, c in rows) + "\r\n\r\n",
+        "colon_tag": "\n".join(f"{ip}:{port}#{c}" for ip, port, c in rows),
+        "space": "\n".join(f"{ip} {port} {c}".strip() for ip, port, c in rows),
+        "tab_no_country": "\n".join(f"{ip}\t{port}" for ip, port, _ in rows),
+        "ip_csv": "IP地址,端口,TLS,数据中心,地区,国际代码,国家,城市,网络延迟,下载速度MB/s\n" + "\n".join(
+            f"{ip},{port},true,HKG,亚太,{c},x,y,{rng.randint(20, 400)} ms,{rng.uniform(1, 30):.2f}" for ip, port, c in rows),
+        "swapped_columns": "country,port,ip\n" + "\n".join(f"{c},{port},{ip}" for ip, port, c in rows),
+        "mixed": "\n".join([
+            "# 注释行", "", "1.2.3.4:443#HK", "[2606:4700::1]:2053,JP", "2606:4700::2 8443 US",
+            "5.6.7.8,99999,SG", "not a node", "9.9.9.9,443", "010.001.002.003,443,Tokyo",
+            "  4.4.4.4,2096,Hong Kong  ", "8.8.8.8,abc,US", "1.2.3.4:443#HK",
+        ]),
+        "json": json.dumps([{"ip": ip, "port": port, "country": c} for ip, port, c in rows[:50]]
+                           + [{"ip": "bad", "port": 1}, {"IP Address": "1.1.1.1", "Port": "443", "city": "Tokyo"}]),
+        "empty": "",
+    }
+    return sources
+
+class ParseNodesRegressionTest(unittest.TestCase):
+    def setUp(self):
+        source_parser.configure_schema_cache('')
+
+    def test_matches_legacy_parser(self):
+        for name, content in build_sources().items():
+            with self.subTest(source=name):
+                nodes, _ = source_parser.parse_nodes(content, standardize_country)
+                self.assertEqual(nodes, legacy_parse(content, standardize_country))
+
+    def test_cached_schema_matches_legacy_parser(self):
+        for name, content in build_sources().items():
+            with self.subTest(source=name):
+                expected = legacy_parse(content, standardize_country)
+                source_parser.parse_nodes(content, standardize_country, source=name)
+                nodes, _ = source_parser.parse_nodes(content, standardize_country, source=name)
+                self.assertEqual(nodes, expected)
+
+    def test_concurrent_parsing(self):
+        sources = build_sources()
+        expected = {name: legacy_parse(content, standardize_country) for name, content in sources.items()}
+        results, errors = {}, []
+
+        def worker(name):
+            try:
+                results[name] = source_parser.parse_nodes(sources[name], standardize_country, source=name)[0]
+            except Exception as e:  # noqa: BLE001
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(name,)) for name in sources]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, expected)
+
+if __name__ == "__main__":
+    unittest.main()